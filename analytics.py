@@ -0,0 +1,280 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import event, inspect, select, insert, update, delete, func, literal, and_, or_, DateTime
+from sqlalchemy.orm import Session
+from database import engine
+from models import RidershipRollup, RollupState, RollupDirtyBucket, Trip, TapHistory
+from periodic import PeriodicJob
+
+# How often the background job folds new trips and taps into the rollups (0 disables it)
+ROLLUP_INTERVAL_SECONDS = float(os.getenv("ROLLUP_INTERVAL_SECONDS", "60"))
+# Every refresh recomputes the hours from this far behind the high-water mark,
+# so trips and taps committed a little after their timestamp are still counted.
+# Writes of older facts mark their hours dirty instead (mark_dirty).
+ROLLUP_LATE_WINDOW_SECONDS = float(os.getenv("ROLLUP_LATE_WINDOW_SECONDS", "300"))
+
+ROLLUP_NAME = "ridership"
+GRANULARITIES = ("hour", "day")
+DIMENSIONS = ("station", "route", "operator", "transit_mode")
+HOUR = timedelta(hours=1)
+
+# One refresh at a time per process (the background job and /admin/analytics/refresh)
+_refresh_lock = threading.Lock()
+
+
+def _floor_day(value):
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _floor_hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _bucket(column, unit, dialect_name):
+    if dialect_name == "postgresql":
+        return func.date_trunc(unit, column, type_=DateTime)
+    # Same text layout SQLAlchemy uses for SQLite DateTime columns
+    layout = "%Y-%m-%d %H:00:00.000000" if unit == "hour" else "%Y-%m-%d 00:00:00.000000"
+    return func.strftime(layout, column, type_=DateTime)
+
+
+def _hour_ranges(since, hours):
+    """[start, end) ranges covering `since` onwards plus the given hours, adjacent hours merged."""
+    ranges = []
+    for hour in sorted(hour for hour in hours if since is None or hour < since):
+        if ranges and ranges[-1][1] == hour:
+            ranges[-1][1] = hour + HOUR
+        else:
+            ranges.append([hour, hour + HOUR])
+    if since is not None:
+        ranges.append([since, None])
+    return ranges
+
+
+def _in_ranges(column, ranges):
+    """None (no restriction) for a full rebuild, else a filter on the [start, end) ranges."""
+    if ranges is None:
+        return None
+    return or_(*[
+        and_(column >= start, column < end) if end is not None else column >= start
+        for start, end in ranges
+    ])
+
+
+def _hourly_rows(conn, ranges):
+    """Aggregate the trips and taps within `ranges` (everything if None) per hour."""
+    dialect_name = conn.dialect.name
+    trip_hour = _bucket(Trip.start_time, "hour", dialect_name)
+    trips = (
+        select(trip_hour, Trip.entry_location, Trip.route, Trip.operator, Trip.transit_mode,
+               func.count(), func.sum(Trip.fare))
+        .group_by(trip_hour, Trip.entry_location, Trip.route, Trip.operator, Trip.transit_mode)
+    )
+    tap_hour = _bucket(TapHistory.tap_time, "hour", dialect_name)
+    taps = (
+        select(tap_hour, TapHistory.location, TapHistory.transit_mode, func.count())
+        .group_by(tap_hour, TapHistory.location, TapHistory.transit_mode)
+    )
+    if ranges is not None:
+        trips = trips.where(_in_ranges(Trip.start_time, ranges))
+        taps = taps.where(_in_ranges(TapHistory.tap_time, ranges))
+
+    rows = [
+        {"granularity": "hour", "bucket_start": bucket, "station": station, "route": route,
+         "operator": operator, "transit_mode": mode, "trips": count, "taps": 0, "revenue": revenue or 0.0}
+        for bucket, station, route, operator, mode, count, revenue in conn.execute(trips)
+    ]
+    rows.extend(
+        {"granularity": "hour", "bucket_start": bucket, "station": station, "route": "",
+         "operator": "", "transit_mode": mode, "trips": 0, "taps": count, "revenue": 0.0}
+        for bucket, station, mode, count in conn.execute(taps)
+    )
+    return rows
+
+
+def _rebuild_days(conn, day_ranges):
+    """Recompute the daily rows of these days from the hourly rollups already written."""
+    dialect_name = conn.dialect.name
+    day = _bucket(RidershipRollup.bucket_start, "day", dialect_name)
+    hourly = RidershipRollup.granularity == "hour"
+    stale = delete(RidershipRollup).where(RidershipRollup.granularity == "day")
+    within = _in_ranges(RidershipRollup.bucket_start, day_ranges)
+    if within is not None:
+        stale = stale.where(within)
+        hourly = and_(hourly, within)
+    conn.execute(stale)
+    dims = [getattr(RidershipRollup, name) for name in DIMENSIONS]
+    conn.execute(insert(RidershipRollup).from_select(
+        ["granularity", "bucket_start", *DIMENSIONS, "trips", "taps", "revenue"],
+        select(literal("day"), day, *dims, func.sum(RidershipRollup.trips), func.sum(RidershipRollup.taps),
+               func.sum(RidershipRollup.revenue))
+        .where(hourly)
+        .group_by(day, *dims),
+    ))
+
+
+def refresh_rollups(bind=engine, rebuild=False):
+    """Fold trips and taps into the hourly and daily rollups.
+
+    Only the hours from (high-water mark - late window) onwards and the hours
+    mark_dirty() flagged are recomputed, so a refresh reads minutes of facts
+    rather than days. The facts are aggregated before the write transaction
+    opens; it only swaps the affected buckets and moves the high-water mark,
+    so tap writers never wait on the aggregation. `rebuild` starts over from
+    the first trip.
+    """
+    with _refresh_lock:
+        now = datetime.now()
+        with bind.connect() as conn:
+            with conn.begin():
+                if conn.dialect.name == "sqlite":
+                    # One snapshot for the state, the marks and the facts (see dashboard_counters.reconcile)
+                    conn.exec_driver_sql("BEGIN")
+                high_water = conn.execute(
+                    select(RollupState.high_water).where(RollupState.name == ROLLUP_NAME)
+                ).scalar()
+                marks = conn.execute(select(RollupDirtyBucket.id, RollupDirtyBucket.bucket_start)).all()
+                since, ranges = None, None
+                if not rebuild and high_water is not None:
+                    since = _floor_hour(high_water - timedelta(seconds=ROLLUP_LATE_WINDOW_SECONDS))
+                    ranges = _hour_ranges(since, {_floor_hour(mark.bucket_start) for mark in marks})
+                hourly = _hourly_rows(conn, ranges)
+
+        with bind.begin() as conn:
+            # Take the write lock first; nothing below reads the fact tables
+            state = conn.execute(
+                update(RollupState).where(RollupState.name == ROLLUP_NAME).values(high_water=now, updated_at=now)
+            ).rowcount
+            if not state:
+                conn.execute(insert(RollupState).values(name=ROLLUP_NAME, high_water=now, updated_at=now))
+            stale = delete(RidershipRollup).where(RidershipRollup.granularity == "hour")
+            if ranges is not None:
+                stale = stale.where(_in_ranges(RidershipRollup.bucket_start, ranges))
+            conn.execute(stale)
+            if hourly:
+                conn.execute(insert(RidershipRollup), hourly)
+            day_ranges = None
+            if ranges is not None:
+                day_ranges = [[_floor_day(start), _floor_day(end - HOUR) + timedelta(days=1) if end else None]
+                              for start, end in ranges]
+            _rebuild_days(conn, day_ranges)
+            # Marks added after the snapshot above stay for the next refresh
+            if marks:
+                conn.execute(delete(RollupDirtyBucket).where(RollupDirtyBucket.id.in_([mark.id for mark in marks])))
+    return {
+        "since": since.isoformat() if since else None,
+        "dirty_hours": len({mark.bucket_start for mark in marks}),
+        "high_water": now.isoformat(),
+        "hourly_rows": len(hourly),
+    }
+
+
+def mark_dirty(conn, moments):
+    """Flag the hours of these fact timestamps for the next refresh to recompute.
+
+    For writers that add, change or remove facts older than the late window
+    (backfills, bulk uploads, edits and deletes of old trips and taps).
+    """
+    hours = {_floor_hour(moment) for moment in moments}
+    if hours:
+        now = datetime.now()
+        conn.execute(insert(RollupDirtyBucket), [{"bucket_start": hour, "marked_at": now} for hour in sorted(hours)])
+
+
+def high_water_mark(db):
+    return db.execute(select(RollupState.high_water).where(RollupState.name == ROLLUP_NAME)).scalar()
+
+
+def query_rollups(db, granularity="hour", start=None, end=None, group_by=(), **filters):
+    """Sum the rollups per bucket (and per `group_by` dimension) within [start, end).
+
+    `filters` maps dimension names to the value to match; None means any.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of: {', '.join(GRANULARITIES)}")
+    unknown = [name for name in list(group_by) + list(filters) if name not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Unknown dimension(s): {', '.join(unknown)}")
+
+    keys = [RidershipRollup.bucket_start] + [getattr(RidershipRollup, name) for name in group_by]
+    query = select(
+        *keys,
+        func.sum(RidershipRollup.trips).label("trips"),
+        func.sum(RidershipRollup.taps).label("taps"),
+        func.sum(RidershipRollup.revenue).label("revenue"),
+    ).where(RidershipRollup.granularity == granularity)
+    if start is not None:
+        query = query.where(RidershipRollup.bucket_start >= start)
+    if end is not None:
+        query = query.where(RidershipRollup.bucket_start < end)
+    for name, value in filters.items():
+        if value is not None:
+            query = query.where(getattr(RidershipRollup, name) == value)
+    query = query.group_by(*keys).order_by(*keys)
+
+    return [
+        {
+            "bucket_start": row.bucket_start,
+            **{name: getattr(row, name) for name in group_by},
+            "trips": row.trips,
+            "taps": row.taps,
+            "revenue": round(row.revenue or 0.0, 2),
+        }
+        for row in db.execute(query)
+    ]
+
+
+# Per fact model: the column that picks the bucket, and every column the rollups read
+_ROLLUP_COLUMNS = {
+    Trip: ("start_time", ("start_time", "entry_location", "route", "operator", "transit_mode", "fare")),
+    TapHistory: ("tap_time", ("tap_time", "location", "transit_mode")),
+}
+
+
+def _fact_times(instance, changed_only):
+    """Bucket timestamps a flushed trip or tap touches: both the old and new
+    one when an update moved it, none for an update no rollup reads."""
+    time_column, columns = _ROLLUP_COLUMNS[type(instance)]
+    if not changed_only:
+        return [instance.__dict__.get(time_column)]
+    attrs = inspect(instance).attrs
+    if not any(attrs[column].history.has_changes() for column in columns):
+        return []
+    return attrs[time_column].history.sum()
+
+
+@event.listens_for(Session, "after_flush")
+def _mark_backdated_facts(session, flush_context):
+    """Mark the hours of trips and taps added, changed or deleted behind the late window.
+
+    Live taps and trips are stamped with the current time, so the hot path
+    never issues the extra INSERT.
+    """
+    horizon = datetime.now() - timedelta(seconds=ROLLUP_LATE_WINDOW_SECONDS)
+    backdated = []
+    flushed = [(instance, False) for instance in list(session.new) + list(session.deleted)]
+    flushed.extend((instance, True) for instance in session.dirty)
+    for instance, changed_only in flushed:
+        if type(instance) not in _ROLLUP_COLUMNS:
+            continue
+        for moment in _fact_times(instance, changed_only):
+            if isinstance(moment, datetime) and moment.tzinfo is not None:
+                moment = moment.astimezone().replace(tzinfo=None)
+            if isinstance(moment, datetime) and moment < horizon:
+                backdated.append(moment)
+    if backdated:
+        mark_dirty(session.connection(), backdated)
+
+
+def ensure_rollups(bind):
+    """Bring the rollups up to date at startup so reads don't wait for the first scheduled refresh.
+
+    Builds everything on a fresh database; afterwards it only recomputes the
+    late window behind the last refresh and the hours marked dirty.
+    """
+    return refresh_rollups(bind)
+
+
+# Shared refresher started by main.py
+rollup_refresher = PeriodicJob("rollup-refresher", ROLLUP_INTERVAL_SECONDS, refresh_rollups)
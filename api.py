@@ -1,17 +1,36 @@
-from fastapi import APIRouter, HTTPException, Depends, Header
+from fastapi import APIRouter, HTTPException, Depends, Header, Request, Response
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import datetime
 from database import SessionLocal, engine
-from models import Customer, Card, Trip, Case, TapHistory, FareDispute
-from pydantic import BaseModel, ConfigDict, EmailStr, validator
+from models import Customer, Card, Trip, Case, TapHistory, FareDispute, CardTransaction
+from id_allocator import id_allocator
+from bulk_upload import iter_lines, iter_records, validation_messages, insert_tap_chunk, InvalidHeader, BULK_CHUNK_SIZE, MAX_REPORTED_ERRORS
+from pagination import paginate, clamp_limit, InvalidCursor, DEFAULT_PAGE_SIZE
+from streaming import iter_statement, iter_array, iter_object, streaming_response, STREAM_FORMATS
+from cache import entity_cache
+from balance_ledger import credit, debit, current_balance, InsufficientBalance, BalanceChange
+from transaction_ledger import record, ledger_tail, balance_as_of
+from projections import TRIP_FIELDS, TAP_FIELDS, labelled, project_all
+from dashboard_counters import read_counters
+from analytics import query_rollups, high_water_mark
+from report_engines import tap_report, fare_report, REPORT_ENGINE
+from customer_overview import customer_overview, OVERVIEW_SECTION_LIMIT
+from case_queries import filter_cases, case_sort, agent_queue, PRIORITY_ORDER
+from search import search
+from card_sampling import sample_cards
+from tap_ingest import tap_ingestor, TAP_INGEST_MODE, MIN_FARE, CardNotFound, IngestQueueFull, IngestTimeout
+from profiling import ProfiledRoute
+from pydantic import BaseModel, ConfigDict, EmailStr, ValidationError, validator
 from fastapi import Body
-from sqlalchemy import func
+from sqlalchemy import func, select
+from starlette.concurrency import run_in_threadpool
 import uuid
 import os
 import re
 
-router = APIRouter()
+# ProfiledRoute lets ProfilingMiddleware profile the threadpool thread a sync endpoint runs on
+router = APIRouter(route_class=ProfiledRoute)
 
 # API Key authentication
 API_KEY = os.getenv("API_KEY", "mysecretkey")
@@ -97,6 +116,15 @@ class CardResponse(CardBase):
     
     model_config = ConfigDict(from_attributes=True)
 
+class CardTransactionResponse(BaseModel):
+    sequence: int
+    created_at: datetime
+    kind: str
+    amount: float
+    reference: Optional[str] = None
+    
+    model_config = ConfigDict(from_attributes=True)
+
 class TripBase(BaseModel):
     start_time: datetime
     end_time: datetime
@@ -129,9 +157,14 @@ class CaseBase(BaseModel):
     notes: str
 
 class CaseCreate(CaseBase):
-    pass
+    @validator('priority')
+    def validate_priority(cls, v):
+        # The agent queue reads one index prefix per priority (case_queries.py)
+        if v not in PRIORITY_ORDER:
+            raise ValueError(f"priority must be one of: {', '.join(PRIORITY_ORDER)}")
+        return v
 
-class CaseUpdate(CaseBase):
+class CaseUpdate(CaseCreate):
     pass
 
 class CaseResponse(CaseBase):
@@ -174,19 +207,81 @@ class FareDisputeResponse(FareDisputeBase):
     id: int
     model_config = ConfigDict(from_attributes=True)
 
+def keyset_page(response: Response, query, id_column, limit, cursor, skip, sort_column=None, descending=False):
+    """Run a keyset-paginated list query and put the page cursors on the response headers"""
+    try:
+        page = paginate(query, id_column, limit=limit, cursor=cursor, skip=skip,
+                        sort_column=sort_column, descending=descending)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    page.apply_headers(response)
+    return page.items
+
+def check_stream_format(stream: Optional[str]):
+    if stream is not None and stream not in STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail="stream must be 'json' or 'ndjson'")
+
+# Search across customers, cards and cases
+@router.get("/search")
+def search_entities(q: str, types: Optional[str] = None, limit: int = 20, cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    """Ranked, typo-tolerant search by name, email, phone, card ID or case notes"""
+    entities = [name.strip() for name in types.split(",") if name.strip()] if types else None
+    try:
+        return search(db, q, entities=entities, limit=limit, cursor=cursor)
+    except ValueError as e:
+        # Unknown types, too-short queries and InvalidCursor
+        raise HTTPException(status_code=400, detail=str(e))
+
 # Customer endpoints
 @router.get("/customers/", response_model=List[CustomerResponse])
-def get_customers(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
-    customers = db.query(Customer).offset(skip).limit(limit).all()
-    return customers
+def get_customers(response: Response, skip: int = 0, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+    return keyset_page(response, db.query(Customer), Customer.id, limit, cursor, skip)
 
 @router.get("/customers/{customer_id}", response_model=CustomerResponse)
 def get_customer(customer_id: str, db: Session = Depends(get_db)):
-    customer = db.query(Customer).filter(Customer.id == customer_id).first()
+    customer = entity_cache.get_customer(db, customer_id)
     if customer is None:
         raise HTTPException(status_code=404, detail="Customer not found")
     return customer
 
+@router.get("/customers/{customer_id}/overview")
+def get_customer_overview(
+    customer_id: str,
+    limit: int = OVERVIEW_SECTION_LIMIT,
+    sections: Optional[str] = None,
+    cards_cursor: Optional[str] = None,
+    trips_cursor: Optional[str] = None,
+    tap_history_cursor: Optional[str] = None,
+    open_cases_cursor: Optional[str] = None,
+    fare_disputes_cursor: Optional[str] = None,
+):
+    """Customer, cards, recent trips and taps, open cases and fare disputes in one response.
+
+    Every section holds at most `limit` rows plus the cursors for its
+    neighbouring pages; pass `<section>_cursor` (usually with `sections=<section>`)
+    to fetch the next page of one section.
+    """
+    cursors = {
+        "cards": cards_cursor,
+        "trips": trips_cursor,
+        "tap_history": tap_history_cursor,
+        "open_cases": open_cases_cursor,
+        "fare_disputes": fare_disputes_cursor,
+    }
+    try:
+        overview = customer_overview(
+            customer_id,
+            limit=limit,
+            cursors={name: cursor for name, cursor in cursors.items() if cursor},
+            sections=[name.strip() for name in sections.split(",") if name.strip()] if sections else None,
+        )
+    except ValueError as e:
+        # Unknown section names and InvalidCursor
+        raise HTTPException(status_code=400, detail=str(e))
+    if overview is None:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    return overview
+
 @router.post("/customers/", response_model=CustomerResponse)
 def create_customer(customer: CustomerCreate, db: Session = Depends(get_db)):
     try:
@@ -202,7 +297,7 @@ def create_customer(customer: CustomerCreate, db: Session = Depends(get_db)):
             )
         
         db_customer = Customer(
-            id=f"C{str(len(db.query(Customer).all()) + 1).zfill(3)}",
+            id=id_allocator.next_id("customer"),
             **customer.dict(),
             join_date=datetime.now()
         )
@@ -226,6 +321,7 @@ def update_customer(customer_id: str, customer: CustomerUpdate, db: Session = De
         setattr(db_customer, key, value)
     
     db.commit()
+    entity_cache.invalidate_customer(customer_id)
     db.refresh(db_customer)
     return db_customer
 
@@ -235,19 +331,37 @@ def delete_customer(customer_id: str, db: Session = Depends(get_db)):
     if db_customer is None:
         raise HTTPException(status_code=404, detail="Customer not found")
     
+    card_ids = [card.id for card in db_customer.cards]
     db.delete(db_customer)
     db.commit()
+    entity_cache.invalidate_customer(customer_id)
+    entity_cache.invalidate_card(*card_ids)
     return {"message": "Customer deleted successfully"}
 
 # Card endpoints
 @router.get("/cards/", response_model=List[CardResponse])
-def get_cards(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
-    cards = db.query(Card).offset(skip).limit(limit).all()
-    return cards
+def get_cards(response: Response, skip: int = 0, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
+    return keyset_page(response, db.query(Card), Card.id, limit, cursor, skip)
+
+# Declared before /cards/{card_id}, which would otherwise match "random" as a card ID
+@router.get("/cards/random")
+def get_random_card(
+    n: Optional[int] = None,
+    status: Optional[str] = None,
+    type: Optional[str] = None,
+    min_balance: Optional[float] = None,
+    db: Session = Depends(get_db),
+    api_key: str = Depends(verify_api_key)
+):
+    """Get a random card, or a list of `n` distinct random cards, matching the filters"""
+    cards = sample_cards(db, clamp_limit(n or 1), status=status, card_type=type, min_balance=min_balance)
+    if not cards:
+        raise HTTPException(status_code=404, detail="No cards found in database")
+    return cards if n is not None else cards[0]
 
 @router.get("/cards/{card_id}", response_model=CardResponse)
 def get_card(card_id: str, db: Session = Depends(get_db)):
-    card = db.query(Card).filter(Card.id == card_id).first()
+    card = entity_cache.get_card(db, card_id)
     if card is None:
         raise HTTPException(status_code=404, detail="Card not found")
     return card
@@ -298,10 +412,15 @@ def update_card(card_id: str, card: CardUpdate, db: Session = Depends(get_db)):
     if db_card is None:
         raise HTTPException(status_code=404, detail="Card not found")
     
+    previous_balance = db_card.balance
     for key, value in card.dict().items():
         setattr(db_card, key, value)
     
+    if db_card.balance != previous_balance:
+        db.flush()
+        record(db, db_card.id, [("adjustment", db_card.balance - previous_balance, None)], db_card.balance)
     db.commit()
+    entity_cache.invalidate_card(card_id, card.id)
     db.refresh(db_card)
     return db_card
 
@@ -313,13 +432,17 @@ def delete_card(card_id: str, db: Session = Depends(get_db)):
     
     db.delete(db_card)
     db.commit()
+    entity_cache.invalidate_card(card_id)
     return {"message": "Card deleted successfully"}
 
 # Trip endpoints
 @router.get("/trips/", response_model=List[TripResponse])
-def get_trips(skip: int = 0, db: Session = Depends(get_db)):
-    trips = db.query(Trip).offset(skip).all()
-    return trips
+def get_trips(response: Response, skip: int = 0, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, stream: Optional[str] = None, db: Session = Depends(get_db)):
+    check_stream_format(stream)
+    if stream:
+        # Full export straight from a server-side cursor
+        return streaming_response(iter_array(iter_statement(select(Trip.__table__).order_by(Trip.id)), stream), stream)
+    return keyset_page(response, db.query(Trip), Trip.id, limit, cursor, skip)
 
 @router.get("/trips/{trip_id}", response_model=TripResponse)
 def get_trip(trip_id: str, db: Session = Depends(get_db)):
@@ -340,7 +463,7 @@ def create_trip(trip: TripCreate, db: Session = Depends(get_db)):
     else:
         # Auto-generate ID for manually created trips (e.g., T001, T002)
         db_trip = Trip(
-            id=f"T{str(len(db.query(Trip).all()) + 1).zfill(3)}",
+            id=id_allocator.next_id("trip"),
             **trip_data
         )
     
@@ -374,9 +497,42 @@ def delete_trip(trip_id: str, db: Session = Depends(get_db)):
 
 # Case endpoints
 @router.get("/cases/", response_model=List[CaseResponse])
-def get_cases(db: Session = Depends(get_db)):
-    cases = db.query(Case).order_by(Case.created_date.desc()).all()
-    return cases
+def get_cases(
+    response: Response,
+    skip: int = 0,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    stream: Optional[str] = None,
+    case_status: Optional[str] = None,
+    priority: Optional[str] = None,
+    assigned_agent: Optional[str] = None,
+    category: Optional[str] = None,
+    customer_id: Optional[str] = None,
+    card_id: Optional[str] = None,
+    sort: str = "created_date",
+    order: str = "desc",
+    db: Session = Depends(get_db)
+):
+    check_stream_format(stream)
+    try:
+        sort_column, descending = case_sort(sort, order)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    filters = dict(case_status=case_status, priority=priority, assigned_agent=assigned_agent,
+                   category=category, customer_id=customer_id, card_id=card_id)
+    if stream:
+        stmt = filter_cases(select(Case.__table__), **filters).order_by(
+            *[column.desc() if descending else column.asc() for column in (sort_column, Case.id)]
+        )
+        return streaming_response(iter_array(iter_statement(stmt), stream), stream)
+    # Newest cases first unless another sort is asked for; cursors carry the sort key
+    return keyset_page(response, filter_cases(db.query(Case), **filters), Case.id, limit, cursor, skip,
+                       sort_column=sort_column, descending=descending)
+
+@router.get("/cases/queue")
+def get_case_queue(assigned_agent: Optional[str] = None, limit: int = 10, db: Session = Depends(get_db)):
+    """Next open cases per agent, most urgent priority first and oldest first within a priority"""
+    return {"limit": clamp_limit(limit), "queues": agent_queue(db, assigned_agent, clamp_limit(limit))}
 
 @router.get("/cases/{case_id}", response_model=CaseResponse)
 def get_case(case_id: str, db: Session = Depends(get_db)):
@@ -388,7 +544,7 @@ def get_case(case_id: str, db: Session = Depends(get_db)):
 @router.post("/cases/", response_model=CaseResponse)
 def create_case(case: CaseCreate, db: Session = Depends(get_db)):
     db_case = Case(
-        id=f"CS{str(len(db.query(Case).all()) + 1).zfill(3)}",
+        id=id_allocator.next_id("case"),
         **case.dict(),
         created_date=datetime.now(),
         last_updated=datetime.now()
@@ -424,16 +580,17 @@ def delete_case(case_id: str, db: Session = Depends(get_db)):
 # Tap History endpoints
 @router.get("/tap-history/", response_model=List[TapHistoryResponse])
 def get_tap_history(
+    response: Response,
     skip: int = 0,
-    limit: int = 100,
+    limit: int = DEFAULT_PAGE_SIZE,
     customer_id: Optional[str] = None,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
     query = db.query(TapHistory)
     if customer_id:
         query = query.filter(TapHistory.customer_id == customer_id)
-    tap_history = query.offset(skip).limit(limit).all()
-    return tap_history
+    return keyset_page(response, query, TapHistory.id, limit, cursor, skip)
 
 @router.get("/tap-history/{tap_id}", response_model=TapHistoryResponse)
 def get_tap_entry(tap_id: str, db: Session = Depends(get_db)):
@@ -445,7 +602,7 @@ def get_tap_entry(tap_id: str, db: Session = Depends(get_db)):
 @router.post("/tap-history/", response_model=TapHistoryResponse)
 def create_tap_entry(tap_entry: TapHistoryCreate, db: Session = Depends(get_db)):
     db_tap_entry = TapHistory(
-        id=f"TH{str(len(db.query(TapHistory).all()) + 1).zfill(6)}",
+        id=id_allocator.next_id("tap"),
         **tap_entry.dict()
     )
     db.add(db_tap_entry)
@@ -453,6 +610,66 @@ def create_tap_entry(tap_entry: TapHistoryCreate, db: Session = Depends(get_db))
     db.refresh(db_tap_entry)
     return db_tap_entry
 
+@router.post("/tap-history/bulk")
+async def bulk_upload_tap_history(request: Request, format: Optional[str] = None):
+    """Bulk upload taps as NDJSON (one JSON object per line) or CSV with a header row.
+
+    The body is parsed as it streams in and inserted in chunks, so the whole
+    payload is never held in memory. Invalid rows are reported by row number,
+    as are the rows of a chunk the database failed to store; `inserted` counts
+    only committed rows.
+    """
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "csv" if "csv" in content_type else "ndjson"
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'csv'")
+
+    inserted = 0
+    total_rows = 0
+    error_count = 0
+    errors = []
+    chunk = []
+
+    def report(row_errors):
+        nonlocal error_count
+        error_count += len(row_errors)
+        errors.extend(row_errors[:max(MAX_REPORTED_ERRORS - len(errors), 0)])
+
+    records = iter_records(iter_lines(request.stream()), format)
+    try:
+        async for row_number, record, parse_error in records:
+            total_rows = row_number
+            if parse_error:
+                report([{"row": row_number, "errors": [{"field": None, "message": parse_error}]}])
+                continue
+            try:
+                chunk.append((row_number, TapHistoryCreate(**record)))
+            except ValidationError as e:
+                report([{"row": row_number, "errors": validation_messages(e)}])
+                continue
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                count, chunk_errors = await run_in_threadpool(insert_tap_chunk, chunk)
+                inserted += count
+                report(chunk_errors)
+                chunk = []
+    except InvalidHeader as e:
+        # The header is the first line, so nothing has been inserted yet
+        raise HTTPException(status_code=400, detail=str(e))
+    if chunk:
+        count, chunk_errors = await run_in_threadpool(insert_tap_chunk, chunk)
+        inserted += count
+        report(chunk_errors)
+
+    return {
+        "status": "success" if error_count == 0 else "partial",
+        "total_rows": total_rows,
+        "inserted": inserted,
+        "failed": error_count,
+        "errors": errors,
+        "errors_truncated": error_count > len(errors)
+    }
+
 @router.put("/tap-history/{tap_id}", response_model=TapHistoryResponse)
 def update_tap_entry(tap_id: str, tap_entry: TapHistoryUpdate, db: Session = Depends(get_db)):
     db_tap_entry = db.query(TapHistory).filter(TapHistory.id == tap_id).first()
@@ -478,9 +695,8 @@ def delete_tap_entry(tap_id: str, db: Session = Depends(get_db)):
 
 # Fare Dispute endpoints
 @router.get("/fare-disputes/", response_model=List[FareDisputeResponse])
-def get_fare_disputes(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    disputes = db.query(FareDispute).offset(skip).limit(limit).all()
-    return disputes
+def get_fare_disputes(response: Response, skip: int = 0, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    return keyset_page(response, db.query(FareDispute), FareDispute.id, limit, cursor, skip)
 
 @router.post("/fare-disputes/", response_model=FareDisputeResponse)
 def create_fare_dispute(dispute: FareDisputeCreate, db: Session = Depends(get_db)):
@@ -525,7 +741,7 @@ class IssueCardRequest(BaseModel):
     customer_id: str
     issue_date: str
     balance: float = 0.0  # Add balance field with default value
-    load_product: Optional[str] = None  # Add load_product field
+    load_product: Optional[str] = None  # Accepted from the POS; cards don't store products (see add_product_api)
 
 @router.post("/api/cards/issue", response_model=StandardResponse)
 def issue_card_api(card_data: IssueCardRequest, db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
@@ -562,7 +778,6 @@ def issue_card_api(card_data: IssueCardRequest, db: Session = Depends(get_db), a
             type=card_data.card_type,
             status="Active",
             balance=card_data.balance,  # Use provided balance instead of hardcoded 0.0
-            product=card_data.load_product if hasattr(card_data, 'load_product') else None,  # Add product field
             customer_id=card_data.customer_id,
             issue_date=datetime.fromisoformat(card_data.issue_date.replace('Z', '+00:00'))
         )
@@ -614,8 +829,11 @@ def add_product_api(card_id: str, req: ProductAddRequest, db: Session = Depends(
     timestamp = datetime.now()
     
     try:
-        card = db.query(Card).filter(Card.id == card_id).first()
-        if not card:
+        if req.value > 0:
+            change = credit(db, card_id, req.value, kind="product", reference=transaction_id)
+        else:
+            change = current_balance(db, card_id)
+        if change is None:
             return StandardResponse(
                 status="error",
                 timestamp=timestamp,
@@ -624,11 +842,8 @@ def add_product_api(card_id: str, req: ProductAddRequest, db: Session = Depends(
                 data={"card_id": card_id}
             )
         
-        if req.value > 0:
-            card.balance += req.value
-        
         db.commit()
-        db.refresh(card)
+        entity_cache.invalidate_card(card_id)
         
         return StandardResponse(
             status="success",
@@ -636,9 +851,9 @@ def add_product_api(card_id: str, req: ProductAddRequest, db: Session = Depends(
             transactionId=transaction_id,
             message=f"Product {req.product} added to card {card_id}",
             data={
-                "card_id": card.id,
-                "product": card.product,
-                "new_balance": card.balance,
+                "card_id": card_id,
+                "product": req.product,
+                "new_balance": change.balance,
                 "value_added": req.value
             }
         )
@@ -662,8 +877,11 @@ def reload_card_api(card_id: str, req: ReloadRequest, db: Session = Depends(get_
     timestamp = datetime.now()
     
     try:
-        card = db.query(Card).filter(Card.id == card_id).first()
-        if not card:
+        if req.amount > 0:
+            change = credit(db, card_id, req.amount, kind="reload", reference=transaction_id)
+        else:
+            change = current_balance(db, card_id)
+        if change is None:
             return StandardResponse(
                 status="error",
                 timestamp=timestamp,
@@ -681,9 +899,8 @@ def reload_card_api(card_id: str, req: ReloadRequest, db: Session = Depends(get_
                 data={"card_id": card_id, "amount": req.amount}
             )
         
-        card.balance += req.amount
         db.commit()
-        db.refresh(card)
+        entity_cache.invalidate_card(card_id)
         
         return StandardResponse(
             status="success",
@@ -691,10 +908,10 @@ def reload_card_api(card_id: str, req: ReloadRequest, db: Session = Depends(get_
             transactionId=transaction_id,
             message=f"Card {card_id} reloaded with ${req.amount}",
             data={
-                "card_id": card.id,
+                "card_id": card_id,
                 "amount_reloaded": req.amount,
-                "new_balance": card.balance,
-                "previous_balance": card.balance - req.amount
+                "new_balance": change.balance,
+                "previous_balance": change.balance - req.amount
             }
         )
         
@@ -707,34 +924,17 @@ def reload_card_api(card_id: str, req: ReloadRequest, db: Session = Depends(get_
             data={"card_id": card_id}
         )
 
-@router.get("/cards/random")
-def get_random_card(db: Session = Depends(get_db), api_key: str = Depends(verify_api_key)):
-    """Get a random card from the database"""
-    import random
-    cards = db.query(Card).all()
-    if not cards:
-        raise HTTPException(status_code=404, detail="No cards found in database")
-    
-    random_card = random.choice(cards)
-    return {
-        "id": random_card.id,
-        "card_number": random_card.id,
-        "balance": random_card.balance,
-        "status": random_card.status,
-        "type": random_card.type
-    }
-
 @router.get("/cards/{card_id}/balance")
 def get_card_balance(card_id: str, db: Session = Depends(get_db)):
     """Get card balance"""
-    card = db.query(Card).filter(Card.id == card_id).first()
+    card = entity_cache.get_card(db, card_id)
     if not card:
         raise HTTPException(status_code=404, detail="Card not found")
     return {
-        "card_id": card.id,
-        "balance": card.balance,
-        "status": card.status,
-        "type": card.type
+        "card_id": card["id"],
+        "balance": card["balance"],
+        "status": card["status"],
+        "type": card["type"]
     }
 
 # --- Original endpoints for backward compatibility ---
@@ -769,38 +969,34 @@ def issue_card(card_data: IssueCardRequest, db: Session = Depends(get_db)):
 @router.post("/cards/{card_id}/products")
 def add_product(card_id: str, req: ProductAddRequest, db: Session = Depends(get_db)):
     """Add a product to a card - Original endpoint"""
-    card = db.query(Card).filter(Card.id == card_id).first()
-    if not card:
+    change = credit(db, card_id, req.value, kind="product") if req.value > 0 else current_balance(db, card_id)
+    if change is None:
         raise HTTPException(status_code=404, detail="Card not found")
     
-    if req.value > 0:
-        card.balance += req.value
-    
     db.commit()
-    db.refresh(card)
+    entity_cache.invalidate_card(card_id)
     return {
         "message": f"Product {req.product} added to card {card_id}",
-        "card_id": card.id,
-        "new_balance": card.balance
+        "card_id": card_id,
+        "new_balance": change.balance
     }
 
 @router.post("/cards/{card_id}/reload")
 def reload_card(card_id: str, req: ReloadRequest, db: Session = Depends(get_db)):
     """Reload funds onto a card - Original endpoint"""
-    card = db.query(Card).filter(Card.id == card_id).first()
-    if not card:
+    change = credit(db, card_id, req.amount, kind="reload") if req.amount > 0 else current_balance(db, card_id)
+    if change is None:
         raise HTTPException(status_code=404, detail="Card not found")
     
     if req.amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be positive")
     
-    card.balance += req.amount
     db.commit()
-    db.refresh(card)
+    entity_cache.invalidate_card(card_id)
     return {
         "message": f"Card {card_id} reloaded with ${req.amount}",
-        "card_id": card.id,
-        "new_balance": card.balance
+        "card_id": card_id,
+        "new_balance": change.balance
     }
 
 class PaymentSimRequest(BaseModel):
@@ -811,71 +1007,179 @@ class PaymentSimRequest(BaseModel):
 @router.post("/payment/simulate")
 def simulate_payment(req: PaymentSimRequest, db: Session = Depends(get_db)):
     """Simulate a payment transaction"""
-    card = db.query(Card).filter(Card.id == req.card_id).first()
-    if not card:
-        raise HTTPException(status_code=404, detail="Card not found")
-    
-    if card.balance < req.amount:
+    try:
+        change = debit(db, req.card_id, req.amount, kind="payment")
+    except InsufficientBalance as e:
         return {
             "success": False,
             "message": "Insufficient balance",
-            "current_balance": card.balance,
+            "current_balance": e.balance,
             "required_amount": req.amount
         }
+    if change is None:
+        raise HTTPException(status_code=404, detail="Card not found")
     
-    card.balance -= req.amount
     db.commit()
-    db.refresh(card)
+    entity_cache.invalidate_card(req.card_id)
     
     return {
         "success": True,
         "message": f"Payment of ${req.amount} by {req.method} successful",
-        "card_id": card.id,
-        "new_balance": card.balance,
+        "card_id": req.card_id,
+        "new_balance": change.balance,
         "payment_method": req.method
     }
 
 @router.get("/cards/{card_id}/transactions")
-def get_card_transactions(card_id: str, db: Session = Depends(get_db)):
+def get_card_transactions(card_id: str, stream: Optional[str] = None, db: Session = Depends(get_db)):
     """Get transaction history for a card"""
-    card = db.query(Card).filter(Card.id == card_id).first()
-    if not card:
-        raise HTTPException(status_code=404, detail="Card not found")
+    check_stream_format(stream)
+    
+    if stream:
+        card = entity_cache.get_card(db, card_id)
+        if not card:
+            raise HTTPException(status_code=404, detail="Card not found")
+        trips_stmt = select(*labelled(TRIP_FIELDS)).where(Trip.card_id == card_id).order_by(Trip.start_time.desc())
+        taps_stmt = select(*labelled(TAP_FIELDS)).where(
+            TapHistory.customer_id == card["customer_id"]
+        ).order_by(TapHistory.tap_time.desc())
+        snapshot, ledger_entries = ledger_tail(db, card_id)
+        return streaming_response(iter_object(
+            {"card_id": card_id, "card_balance": card["balance"], "ledger_snapshot": snapshot},
+            [("ledger", ledger_entries),
+             ("trips", iter_statement(trips_stmt)), ("tap_history", iter_statement(taps_stmt))],
+            stream
+        ), stream)
     
-    # Get trips for this card
-    trips = db.query(Trip).filter(Trip.card_id == card_id).order_by(Trip.start_time.desc()).all()
+    # The card and its trips in one query; a card without trips comes back as one row of NULL trip columns
+    rows = db.execute(
+        select(Card.balance, Card.customer_id, *labelled(TRIP_FIELDS))
+        .select_from(Card)
+        .outerjoin(Trip, Trip.card_id == Card.id)
+        .where(Card.id == card_id)
+        .order_by(Trip.start_time.desc())
+    ).all()
+    if not rows:
+        raise HTTPException(status_code=404, detail="Card not found")
+    card = rows[0]
+    trips = project_all((row for row in rows if row.trip_id is not None), TRIP_FIELDS)
     
     # Get tap history for this card's customer
-    tap_history = db.query(TapHistory).filter(TapHistory.customer_id == card.customer_id).order_by(TapHistory.tap_time.desc()).all()
+    tap_history = project_all(db.execute(
+        select(*labelled(TAP_FIELDS))
+        .where(TapHistory.customer_id == card.customer_id)
+        .order_by(TapHistory.tap_time.desc())
+    ), TAP_FIELDS)
+    
+    # Balance changes since the latest snapshot; older entries are paged via /cards/{card_id}/ledger
+    snapshot, ledger_entries = ledger_tail(db, card_id)
     
     return {
         "card_id": card_id,
         "card_balance": card.balance,
-        "trips": [{
-            "trip_id": t.id,
-            "start_time": t.start_time,
-            "end_time": t.end_time,
-            "entry_location": t.entry_location,
-            "exit_location": t.exit_location,
-            "fare": t.fare,
-            "route": t.route,
-            "operator": t.operator,
-            "transit_mode": t.transit_mode
-        } for t in trips],
-        "tap_history": [{
-            "tap_id": th.id,
-            "tap_time": th.tap_time,
-            "location": th.location,
-            "device_id": th.device_id,
-            "transit_mode": th.transit_mode,
-            "direction": th.direction,
-            "result": th.result
-        } for th in tap_history]
+        "ledger_snapshot": snapshot,
+        "ledger": ledger_entries,
+        "trips": trips,
+        "tap_history": tap_history
+    }
+
+@router.get("/cards/{card_id}/ledger", response_model=List[CardTransactionResponse])
+def get_card_ledger(card_id: str, response: Response, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    """Page through a card's balance ledger, newest entry first"""
+    query = db.query(CardTransaction).filter(CardTransaction.card_id == card_id)
+    return keyset_page(response, query, CardTransaction.sequence, limit, cursor, 0, descending=True)
+
+@router.get("/cards/{card_id}/balance/as-of")
+def get_card_balance_as_of(card_id: str, at: datetime, db: Session = Depends(get_db)):
+    """Card balance at a point in time, rebuilt from the nearest ledger snapshot"""
+    card = entity_cache.get_card(db, card_id)
+    if not card:
+        raise HTTPException(status_code=404, detail="Card not found")
+    balance = balance_as_of(db, card_id, at)
+    return {
+        "card_id": card_id,
+        "at": at,
+        "balance": balance,
+        "has_history": balance is not None
+    }
+
+@router.get("/analytics/ridership")
+def get_ridership(
+    granularity: str = "hour",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    station: Optional[str] = None,
+    route: Optional[str] = None,
+    operator: Optional[str] = None,
+    transit_mode: Optional[str] = None,
+    group_by: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """Trips, taps and fare revenue per hour or day from the analytics rollups.
+    
+    group_by is a comma-separated list of station, route, operator and transit_mode.
+    Taps carry no route or operator, so filtering on either counts trips only.
+    """
+    dimensions = [name.strip() for name in group_by.split(",") if name.strip()] if group_by else []
+    try:
+        buckets = query_rollups(
+            db, granularity, start, end, dimensions,
+            station=station, route=route, operator=operator, transit_mode=transit_mode
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "granularity": granularity,
+        "start": start,
+        "end": end,
+        "group_by": dimensions,
+        "high_water_mark": high_water_mark(db),
+        "buckets": buckets
     }
 
+@router.get("/reports/taps")
+def get_tap_report(
+    group_by: str = "location",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    engine: str = REPORT_ENGINE,
+):
+    """Tap counts and success rates per location, transit_mode, direction, result or device_id"""
+    try:
+        return tap_report(group_by, start, end, engine)
+    except (ValueError, RuntimeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/reports/fares")
+def get_fare_report(
+    group_by: str = "operator",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    bin_width: float = 1.0,
+    engine: str = REPORT_ENGINE,
+):
+    """Fare totals per operator, route, transit_mode or entry_location plus a fare histogram"""
+    try:
+        return fare_report(group_by, start, end, bin_width, engine)
+    except (ValueError, RuntimeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.get("/reports/summary")
-def get_reports_summary(db: Session = Depends(get_db)):
+def get_reports_summary(fresh: bool = False, db: Session = Depends(get_db)):
     """Get summary reports for dashboard"""
+    if not fresh:
+        # Incrementally maintained totals; ?fresh=true recomputes them with full scans
+        counters = read_counters(db)
+        return {
+            "total_cards": int(counters["total_cards"]),
+            "total_customers": int(counters["total_customers"]),
+            "total_trips": int(counters["total_trips"]),
+            "total_balance": round(counters["total_balance"], 2),
+            "total_cases": int(counters["total_cases"]),
+            "total_tap_entries": int(counters["total_tap_entries"]),
+            "generated_at": datetime.now().isoformat()
+        }
+    
     total_cards = db.query(func.count(Card.id)).scalar()
     total_customers = db.query(func.count(Customer.id)).scalar()
     total_trips = db.query(func.count(Trip.id)).scalar()
@@ -900,36 +1204,56 @@ class CardTapRequest(BaseModel):
     transit_mode: str
     direction: str
 
+async def submit_tap(req: CardTapRequest):
+    """Queue the tap for the background writer and wait (on the event loop) for its commit"""
+    try:
+        return await tap_ingestor.submit_async(req.card_id, req.location, req.device_id, req.transit_mode, req.direction)
+    except CardNotFound:
+        raise HTTPException(status_code=404, detail="Card not found")
+    except IngestQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except IngestTimeout as e:
+        # The tap was withdrawn from the queue, so a retry can't charge twice
+        raise HTTPException(status_code=504, detail=str(e))
+
 @router.post("/simulate/cardTap")
-def simulate_card_tap(req: CardTapRequest, db: Session = Depends(get_db)):
+async def simulate_card_tap(req: CardTapRequest, db: Session = Depends(get_db)):
     """Simulate a card tap event"""
-    card = db.query(Card).filter(Card.id == req.card_id).first()
-    if not card:
-        raise HTTPException(status_code=404, detail="Card not found")
+    if TAP_INGEST_MODE == "batched":
+        # Waiting callers don't hold threadpool threads, so they don't cap the batch size
+        return await submit_tap(req)
+    return await run_in_threadpool(record_tap, req, db)
+
+def record_tap(req: CardTapRequest, db: Session):
+    """Write one tap in its own transaction"""
+    # Lease the tap ID before the balance UPDATE takes the write lock
+    tap_id = id_allocator.next_id("tap")
     
-    # Check if card has sufficient balance for a trip
-    min_fare = 2.50  # Minimum fare for a trip
-    if card.balance < min_fare:
-        result = "Insufficient Balance"
-    else:
+    # Deduct the minimum fare only if the card can cover it
+    try:
+        change = debit(db, req.card_id, MIN_FARE, kind="tap", reference=tap_id)
         result = "Tap Successful"
-        # Deduct minimum fare
-        card.balance -= min_fare
+    except InsufficientBalance as e:
+        change = BalanceChange(req.card_id, e.balance, e.customer_id)
+        result = "Insufficient Balance"
+    if change is None:
+        raise HTTPException(status_code=404, detail="Card not found")
     
     # Create tap history entry
     tap_entry = TapHistory(
-        id=f"TH{str(len(db.query(TapHistory).all()) + 1).zfill(6)}",
+        id=tap_id,
         tap_time=datetime.now(),
         location=req.location,
         device_id=req.device_id,
         transit_mode=req.transit_mode,
         direction=req.direction,
-        customer_id=card.customer_id,
+        customer_id=change.customer_id,
         result=result
     )
     
     db.add(tap_entry)
     db.commit()
+    entity_cache.invalidate_card(req.card_id)
     db.refresh(tap_entry)
     
     return {
@@ -939,7 +1263,7 @@ def simulate_card_tap(req: CardTapRequest, db: Session = Depends(get_db)):
         "location": req.location,
         "transit_mode": req.transit_mode,
         "direction": req.direction,
-        "remaining_balance": card.balance,
+        "remaining_balance": change.balance,
         "tap_time": tap_entry.tap_time.isoformat()
     }
 
@@ -965,17 +1289,18 @@ def sync_card_to_crm(req: CardSyncRequest, db: Session = Depends(get_db)):
         
         # Update card based on action
         if req.action == "reload" and req.amount:
-            card.balance += req.amount
+            credit(db, req.card_id, req.amount, kind="reload", reference=transaction_id)
             message = f"Card {req.card_id} reloaded with ${req.amount}"
         elif req.action == "add_product" and req.product:
-            card.product = req.product
+            # Cards don't store products; the credit is booked against the product in the ledger
             if req.amount:
-                card.balance += req.amount
+                credit(db, req.card_id, req.amount, kind="product", reference=transaction_id)
             message = f"Product {req.product} added to card {req.card_id}"
         else:
             message = f"Card {req.card_id} synced successfully"
         
         db.commit()
+        entity_cache.invalidate_card(req.card_id)
         db.refresh(card)
         
         return StandardResponse(
@@ -988,11 +1313,12 @@ def sync_card_to_crm(req: CardSyncRequest, db: Session = Depends(get_db)):
                 "card_id": card.id,
                 "balance": card.balance,
                 "status": card.status,
-                "product": card.product
+                "product": req.product if req.action == "add_product" else None
             }
         )
         
     except Exception as e:
+        db.rollback()
         return StandardResponse(
             status="error",
             timestamp=timestamp,
@@ -1036,6 +1362,7 @@ def register_card_to_customer(customer_id: str, req: CustomerRegisterRequest, db
         # Link card to customer
         card.customer_id = customer_id
         db.commit()
+        entity_cache.invalidate_card(req.card_id)
         db.refresh(card)
         
         return StandardResponse(
@@ -1069,8 +1396,9 @@ def get_crm_card_status(card_id: str, db: Session = Depends(get_db)):
     timestamp = datetime.now()
     
     try:
-        card = db.query(Card).filter(Card.id == card_id).first()
-        if not card:
+        # Card and customer from the cache, or together in one joined query
+        found = entity_cache.get_card_with_customer(db, card_id)
+        if not found:
             return StandardResponse(
                 status="error",
                 timestamp=timestamp,
@@ -1078,9 +1406,7 @@ def get_crm_card_status(card_id: str, db: Session = Depends(get_db)):
                 message="Card not found",
                 data={"card_id": card_id}
             )
-        
-        # Get customer info
-        customer = db.query(Customer).filter(Customer.id == card.customer_id).first()
+        card, customer = found
         
         return StandardResponse(
             status="success",
@@ -1088,14 +1414,13 @@ def get_crm_card_status(card_id: str, db: Session = Depends(get_db)):
             transactionId=transaction_id,
             message="Card status retrieved successfully",
             data={
-                "card_id": card.id,
-                "balance": card.balance,
-                "status": card.status,
-                "type": card.type,
-                "product": card.product,
-                "issue_date": card.issue_date.isoformat(),
-                "customer_id": card.customer_id,
-                "customer_name": customer.name if customer else None
+                "card_id": card["id"],
+                "balance": card["balance"],
+                "status": card["status"],
+                "type": card["type"],
+                "issue_date": card["issue_date"].isoformat(),
+                "customer_id": card["customer_id"],
+                "customer_name": customer["name"] if customer else None
             }
         )
         
@@ -1115,8 +1440,18 @@ def get_crm_customer_status(customer_id: str, db: Session = Depends(get_db)):
     timestamp = datetime.now()
     
     try:
-        customer = db.query(Customer).filter(Customer.id == customer_id).first()
-        if not customer:
+        # The customer and all their cards in one query; a customer without
+        # cards comes back as one row of NULL card columns
+        rows = db.execute(
+            select(
+                Customer.id, Customer.name, Customer.email, Customer.phone, Customer.join_date,
+                Card.id.label("card_id"), Card.balance, Card.status, Card.type
+            )
+            .select_from(Customer)
+            .outerjoin(Card, Card.customer_id == Customer.id)
+            .where(Customer.id == customer_id)
+        ).all()
+        if not rows:
             return StandardResponse(
                 status="error",
                 timestamp=timestamp,
@@ -1124,9 +1459,8 @@ def get_crm_customer_status(customer_id: str, db: Session = Depends(get_db)):
                 message="Customer not found",
                 data={"customer_id": customer_id}
             )
-        
-        # Get customer's cards
-        cards = db.query(Card).filter(Card.customer_id == customer_id).all()
+        customer = rows[0]
+        cards = [row for row in rows if row.card_id is not None]
         
         return StandardResponse(
             status="success",
@@ -1138,14 +1472,12 @@ def get_crm_customer_status(customer_id: str, db: Session = Depends(get_db)):
                 "name": customer.name,
                 "email": customer.email,
                 "phone": customer.phone,
-                "address": customer.address,
                 "join_date": customer.join_date.isoformat(),
                 "cards": [{
-                    "card_id": card.id,
+                    "card_id": card.card_id,
                     "balance": card.balance,
                     "status": card.status,
-                    "type": card.type,
-                    "product": card.product
+                    "type": card.type
                 } for card in cards],
                 "total_cards": len(cards),
                 "total_balance": sum(card.balance for card in cards)
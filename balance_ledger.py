@@ -0,0 +1,128 @@
+from sqlalchemy import update, select
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from models import Card
+from transaction_ledger import record
+from dashboard_counters import increment
+
+
+class InsufficientBalance(Exception):
+    """Raised by a guarded debit when the card holds less than the amount."""
+
+    def __init__(self, card_id, balance, customer_id, amount):
+        super().__init__(f"Insufficient balance on card {card_id}")
+        self.card_id = card_id
+        self.balance = balance
+        self.customer_id = customer_id
+        self.amount = amount
+
+
+class BalanceChange:
+    """Outcome of a credit or debit: the card's balance right after the UPDATE."""
+
+    __slots__ = ("card_id", "balance", "customer_id")
+
+    def __init__(self, card_id, balance, customer_id):
+        self.card_id = card_id
+        self.balance = balance
+        self.customer_id = customer_id
+
+
+# Every balance change is a single UPDATE ... SET balance = balance +/- :x
+# RETURNING balance, evaluated by the database under its row lock, so
+# concurrent writers can never overwrite each other's changes. Guarded
+# debits add "AND balance >= :x" to the WHERE clause. Each change also moves
+# the dashboard total_balance counter and, when `kind` is given, is appended
+# to the card_transactions ledger, all in the caller's transaction.
+
+def credit_statement(card_id, amount):
+    return (
+        update(Card)
+        .where(Card.id == card_id)
+        .values(balance=Card.balance + amount)
+        .returning(Card.balance, Card.customer_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def debit_statement(card_id, amount, require_funds=True):
+    stmt = update(Card).where(Card.id == card_id)
+    if require_funds:
+        stmt = stmt.where(Card.balance >= amount)
+    return (
+        stmt.values(balance=Card.balance - amount)
+        .returning(Card.balance, Card.customer_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _current_state_statement(card_id):
+    return select(Card.balance, Card.customer_id).where(Card.id == card_id)
+
+
+def _sync_identity_map(db, card_id, balance):
+    """Keep an already-loaded Card in the session in step with the new balance."""
+    card = db.identity_map.get(identity_key(Card, card_id))
+    if card is not None:
+        set_committed_value(card, "balance", balance)
+
+
+def _book(db, card_id, amount, balance, kind, reference):
+    increment(db.connection(), {"total_balance": amount})
+    if kind:
+        record(db, card_id, [(kind, amount, reference)], balance)
+
+
+def credit(db, card_id, amount, kind=None, reference=None):
+    """Add `amount` to the card's balance. Returns a BalanceChange, or None if the card does not exist."""
+    row = db.execute(credit_statement(card_id, amount)).first()
+    if row is None:
+        return None
+    _sync_identity_map(db, card_id, row.balance)
+    _book(db, card_id, amount, row.balance, kind, reference)
+    return BalanceChange(card_id, row.balance, row.customer_id)
+
+
+def debit(db, card_id, amount, require_funds=True, kind=None, reference=None):
+    """Take `amount` off the card's balance.
+
+    Returns a BalanceChange, None if the card does not exist, or raises
+    InsufficientBalance when `require_funds` is set and the balance is too low.
+    """
+    row = db.execute(debit_statement(card_id, amount, require_funds)).first()
+    if row is None:
+        # Only the failure path pays for a second round trip
+        current = db.execute(_current_state_statement(card_id)).first()
+        if current is None:
+            return None
+        raise InsufficientBalance(card_id, current.balance, current.customer_id, amount)
+    _sync_identity_map(db, card_id, row.balance)
+    _book(db, card_id, -amount, row.balance, kind, reference)
+    return BalanceChange(card_id, row.balance, row.customer_id)
+
+
+def current_balance(db, card_id):
+    """Balance and owner without changing anything; None if the card does not exist."""
+    row = db.execute(_current_state_statement(card_id)).first()
+    return BalanceChange(card_id, row.balance, row.customer_id) if row is not None else None
+
+
+async def credit_async(db, card_id, amount, kind=None, reference=None):
+    row = (await db.execute(credit_statement(card_id, amount))).first()
+    if row is None:
+        return None
+    _sync_identity_map(db.sync_session, card_id, row.balance)
+    await db.run_sync(_book, card_id, amount, row.balance, kind, reference)
+    return BalanceChange(card_id, row.balance, row.customer_id)
+
+
+async def debit_async(db, card_id, amount, require_funds=True, kind=None, reference=None):
+    row = (await db.execute(debit_statement(card_id, amount, require_funds))).first()
+    if row is None:
+        current = (await db.execute(_current_state_statement(card_id))).first()
+        if current is None:
+            return None
+        raise InsufficientBalance(card_id, current.balance, current.customer_id, amount)
+    _sync_identity_map(db.sync_session, card_id, row.balance)
+    await db.run_sync(_book, card_id, -amount, row.balance, kind, reference)
+    return BalanceChange(card_id, row.balance, row.customer_id)
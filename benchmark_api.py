@@ -0,0 +1,333 @@
+"""Load-test the API hot paths against a freshly seeded database.
+
+Usage: python benchmark_api.py [--database-url sqlite:////tmp/crm-benchmark.db]
+       [--customers 1000] [--skip-seed] [--mix mixed,tap_storm,reads]
+       [--requests 2000] [--concurrency 16] [--server] [--output results.json]
+       [--baseline previous.json]
+
+Seeds the database through generate_data (which clears it first, so point
+--database-url at a scratch database), then drives each mix of requests
+through the app in-process over an ASGI transport, or through a local
+uvicorn with --server. Every mix reports p50/p95/p99 latency, throughput and,
+in-process, SQL statements per request for each endpoint as JSON. With
+--baseline the p95 and throughput of a previous run are printed alongside.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from contextvars import ContextVar
+from datetime import datetime
+
+DEFAULT_DATABASE_URL = f"sqlite:///{os.path.join(tempfile.gettempdir(), 'crm-benchmark.db')}"
+
+# Relative weight of each scenario in a mix
+MIXES = {
+    "mixed": {"tap": 50, "balance": 25, "reload": 10, "summary": 10, "export": 5},
+    "tap_storm": {"tap": 1},
+    "reads": {"balance": 6, "summary": 2, "export": 2},
+}
+
+# Scenario name -> endpoint label used in the report
+ENDPOINTS = {
+    "tap": "POST /simulate/cardTap",
+    "balance": "GET /cards/{card_id}/balance",
+    "reload": "POST /api/cards/{card_id}/reload",
+    "summary": "GET /reports/summary",
+    "export": "GET /trips/ (keyset page)",
+}
+
+EXPORT_PAGE_SIZE = 200
+TAP_LOCATIONS = ["Central Station", "Downtown", "University", "Airport Terminal", "Tech Park"]
+
+# Statements issued on behalf of the request in flight (in-process runs only)
+_statements = ContextVar("benchmark_statements", default=None)
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    counter = _statements.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Worker:
+    """One simulated client; keeps its own place in the export walk."""
+
+    def __init__(self, client, cards, rng, api_key):
+        self.client = client
+        self.cards = cards
+        self.rng = rng
+        self.api_key = api_key
+        self.export_cursor = None
+
+    async def run(self, scenario):
+        card_id = self.rng.choice(self.cards)
+        if scenario == "tap":
+            return await self.client.post("/simulate/cardTap", json={
+                "card_id": card_id,
+                "location": self.rng.choice(TAP_LOCATIONS),
+                "device_id": f"Gate {self.rng.randint(100, 999)}",
+                "transit_mode": "SubWay",
+                "direction": self.rng.choice(["Entry", "Exit"]),
+            })
+        if scenario == "balance":
+            return await self.client.get(f"/cards/{card_id}/balance")
+        if scenario == "reload":
+            return await self.client.post(f"/api/cards/{card_id}/reload",
+                                          json={"amount": self.rng.choice([5, 10, 20])},
+                                          headers={"X-API-Key": self.api_key})
+        if scenario == "summary":
+            return await self.client.get("/reports/summary")
+        if scenario == "export":
+            params = {"limit": EXPORT_PAGE_SIZE}
+            if self.export_cursor:
+                params["cursor"] = self.export_cursor
+            response = await self.client.get("/trips/", params=params)
+            # Walk the whole table page by page, then start over
+            self.export_cursor = response.headers.get("X-Next-Cursor")
+            return response
+        raise ValueError(f"Unknown scenario {scenario!r}")
+
+
+async def run_mix(client, name, cards, args, count_statements):
+    weights = MIXES[name]
+    rng = random.Random(f"{args.seed}:{name}")
+    plan = rng.choices(list(weights), weights=list(weights.values()), k=args.warmup + args.requests)
+    samples = {scenario: [] for scenario in weights}
+    errors = {scenario: 0 for scenario in weights}
+    position = 0
+
+    async def drive(worker):
+        nonlocal position
+        while position < len(plan):
+            index, position = position, position + 1
+            scenario = plan[index]
+            counter = [0]
+            token = _statements.set(counter)
+            started = time.perf_counter()
+            try:
+                response = await worker.run(scenario)
+                failed = response.status_code >= 400
+            except Exception:
+                failed = True
+            finally:
+                _statements.reset(token)
+            elapsed = time.perf_counter() - started
+            if index < args.warmup:
+                continue
+            samples[scenario].append((elapsed, counter[0]))
+            errors[scenario] += failed
+
+    workers = [
+        Worker(client, cards, random.Random(f"{args.seed}:{name}:{i}"), args.api_key)
+        for i in range(args.concurrency)
+    ]
+    started = time.perf_counter()
+    await asyncio.gather(*[drive(worker) for worker in workers])
+    duration = time.perf_counter() - started
+
+    endpoints = {}
+    for scenario, timings in samples.items():
+        latencies = sorted(elapsed * 1000 for elapsed, _ in timings)
+        statements = [count for _, count in timings]
+        endpoints[ENDPOINTS[scenario]] = {
+            "requests": len(timings),
+            "errors": errors[scenario],
+            "p50_ms": _rounded(percentile(latencies, 0.50)),
+            "p95_ms": _rounded(percentile(latencies, 0.95)),
+            "p99_ms": _rounded(percentile(latencies, 0.99)),
+            "mean_ms": _rounded(sum(latencies) / len(latencies) if latencies else None),
+            "max_ms": _rounded(latencies[-1] if latencies else None),
+            "throughput_rps": round(len(timings) / duration, 2),
+            "statements_per_request": (
+                round(sum(statements) / len(statements), 2) if count_statements and statements else None
+            ),
+        }
+    return {
+        "requests": args.requests,
+        "errors": sum(errors.values()),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(args.requests / duration, 2),
+        "endpoints": endpoints,
+    }
+
+
+def _rounded(value):
+    return round(value, 3) if value is not None else None
+
+
+def seed_database(args):
+    from generate_data import main as generate_main
+    # Keep stdout for the JSON report
+    with redirect_stdout(sys.stderr):
+        generate_main(customers=args.customers, trips_per_card=args.trips_per_card,
+                      cases_per_customer=args.cases_per_customer, taps_per_customer=args.taps_per_customer,
+                      workers=args.workers, seed=args.seed)
+
+
+def pick_cards(args):
+    """ACTIVE cards for the workers to tap, read and reload."""
+    from database import SessionLocal
+    from card_sampling import sample_cards
+    db = SessionLocal()
+    try:
+        cards = [card["id"] for card in sample_cards(db, n=args.cards, status="ACTIVE")]
+    finally:
+        db.close()
+    if not cards:
+        raise SystemExit("No ACTIVE cards to benchmark against; seed the database first")
+    return cards
+
+
+async def run_in_process(args, cards):
+    import httpx
+    from sqlalchemy import event
+    from database import engine, async_engine
+    from main import app
+
+    engines = [engine] + ([async_engine.sync_engine] if async_engine is not None else [])
+    for bound in engines:
+        event.listen(bound, "before_cursor_execute", _count_statement)
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    try:
+        # ASGITransport does not send lifespan events; run startup and shutdown ourselves
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+                return {name: await run_mix(client, name, cards, args, True) for name in args.mix}
+    finally:
+        for bound in engines:
+            event.remove(bound, "before_cursor_execute", _count_statement)
+
+
+async def run_against_server(args, cards):
+    import httpx
+    base_url = f"http://127.0.0.1:{args.port}"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port),
+         "--workers", str(args.server_workers), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ),
+    )
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    await client.get("/reports/summary")
+                    break
+                except httpx.TransportError:
+                    if server.poll() is not None or time.monotonic() > deadline:
+                        raise SystemExit("uvicorn did not start")
+                    await asyncio.sleep(0.2)
+            # Statement counts are only visible in-process
+            return {name: await run_mix(client, name, cards, args, False) for name in args.mix}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def print_comparison(report, baseline):
+    print(f"{'mix':<10}{'endpoint':<36}{'p95 ms':>10}{'baseline':>10}{'rps':>10}{'baseline':>10}")
+    for mix, result in report["mixes"].items():
+        previous = baseline.get("mixes", {}).get(mix, {}).get("endpoints", {})
+        for endpoint, stats in result["endpoints"].items():
+            before = previous.get(endpoint, {})
+            print(f"{mix:<10}{endpoint:<36}{_cell(stats['p95_ms'])}{_cell(before.get('p95_ms'))}"
+                  f"{_cell(stats['throughput_rps'])}{_cell(before.get('throughput_rps'))}")
+
+
+def _cell(value):
+    return f"{value:>10.2f}" if value is not None else f"{'-':>10}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", default=os.getenv("BENCHMARK_DATABASE_URL", DEFAULT_DATABASE_URL),
+                        help="Database to seed and benchmark; it is cleared unless --skip-seed")
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--trips-per-card", default="2-4")
+    parser.add_argument("--cases-per-customer", default="1-2")
+    parser.add_argument("--taps-per-customer", default="2-6")
+    parser.add_argument("--workers", type=int, default=1, help="Processes used to seed the data")
+    parser.add_argument("--skip-seed", action="store_true", help="Benchmark the data already in the database")
+    parser.add_argument("--mix", default=",".join(MIXES), help=f"Comma-separated mixes: {', '.join(MIXES)}")
+    parser.add_argument("--requests", type=int, default=2000, help="Measured requests per mix")
+    parser.add_argument("--warmup", type=int, default=100, help="Unmeasured requests before each mix")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--cards", type=int, default=500, help="Cards the clients spread requests over")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--server", action="store_true", help="Run against a local uvicorn instead of in-process")
+    parser.add_argument("--server-workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="Previous JSON report to compare against")
+    args = parser.parse_args()
+    args.mix = [name.strip() for name in args.mix.split(",") if name.strip()]
+    unknown = [name for name in args.mix if name not in MIXES]
+    if unknown:
+        parser.error(f"unknown mix(es): {', '.join(unknown)}")
+    args.api_key = os.getenv("API_KEY", "mysecretkey")
+
+    # Must be set before anything imports database.py
+    os.environ["DATABASE_URL"] = args.database_url
+    if not args.skip_seed:
+        seed_database(args)
+    cards = pick_cards(args)
+
+    runner = run_against_server if args.server else run_in_process
+    mixes = asyncio.run(runner(args, cards))
+
+    from database import engine
+    from tap_ingest import TAP_INGEST_MODE
+    report = {
+        "meta": {
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "mode": "uvicorn" if args.server else "in-process",
+            "database": engine.dialect.name,
+            "customers": None if args.skip_seed else args.customers,
+            "concurrency": args.concurrency,
+            "tap_ingest_mode": TAP_INGEST_MODE,
+            "async_db": os.getenv("USE_ASYNC_DB", "false").lower() == "true",
+            "python": platform.python_version(),
+            "git_commit": _git_commit(),
+        },
+        "mixes": mixes,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(report, json.load(f))
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Compare the SQL and NumPy report engines on the configured database.
+
+Usage: python benchmark_reports.py [--repeat 5] [--chunk-size 100000]
+
+Runs every tap and fare report with both engines, checks that they return
+the same result and prints the median time of each. The NumPy engine answers
+from an in-memory column snapshot, so the one-off snapshot load is timed
+separately from the per-report aggregation.
+"""
+import argparse
+import json
+import statistics
+import time
+from report_engines import (
+    TAP_DIMENSIONS, FARE_DIMENSIONS, tap_columns, trip_columns,
+    sql_tap_report, numpy_tap_report, sql_fare_report, numpy_fare_report,
+)
+
+
+def _timed(func, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return result, timings
+
+
+def _strip_engine(report):
+    return {key: value for key, value in report.items() if key != "engine"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    loads = {}
+    for name, table in (("tap_history", tap_columns), ("trips", trip_columns)):
+        started = time.perf_counter()
+        snapshot = table.load(chunk_size=args.chunk_size)
+        loads[name] = {"rows": snapshot.rows, "load_ms": round((time.perf_counter() - started) * 1000, 2)}
+    taps, trips = tap_columns.snapshot, trip_columns.snapshot
+
+    cases = [
+        (f"taps by {dimension}",
+         lambda d=dimension: sql_tap_report(d),
+         lambda d=dimension: numpy_tap_report(d, table=taps))
+        for dimension in TAP_DIMENSIONS
+    ] + [
+        (f"fares by {dimension}",
+         lambda d=dimension: sql_fare_report(d),
+         lambda d=dimension: numpy_fare_report(d, table=trips))
+        for dimension in FARE_DIMENSIONS
+    ]
+
+    results = []
+    for name, sql_report, numpy_report in cases:
+        sql_result, sql_timings = _timed(sql_report, args.repeat)
+        numpy_result, numpy_timings = _timed(numpy_report, args.repeat)
+        results.append({
+            "report": name,
+            "sql_median_ms": round(statistics.median(sql_timings) * 1000, 2),
+            "sql_best_ms": round(min(sql_timings) * 1000, 2),
+            "numpy_median_ms": round(statistics.median(numpy_timings) * 1000, 2),
+            "numpy_best_ms": round(min(numpy_timings) * 1000, 2),
+            "results_match": _strip_engine(sql_result) == _strip_engine(numpy_result),
+        })
+
+    if args.json:
+        print(json.dumps({"snapshot_loads": loads, "reports": results}, indent=2))
+        return
+    for name, load in loads.items():
+        print(f"NumPy snapshot of {name}: {load['rows']} rows loaded in {load['load_ms']:.2f}ms")
+    print(f"{'report':<26}{'sql median':>12}{'numpy median':>14}{'speedup':>9}  match")
+    for row in results:
+        speedup = row["sql_median_ms"] / row["numpy_median_ms"] if row["numpy_median_ms"] else 0
+        print(f"{row['report']:<26}{row['sql_median_ms']:>10.2f}ms{row['numpy_median_ms']:>12.2f}ms"
+              f"{speedup:>8.2f}x  {'yes' if row['results_match'] else 'NO'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import csv
+import json
+import os
+from sqlalchemy import select, insert
+from sqlalchemy.exc import SQLAlchemyError
+from pydantic import ValidationError
+from database import engine
+from models import Customer, TapHistory
+from id_allocator import id_allocator
+from dashboard_counters import increment
+from analytics import mark_dirty
+
+# Rows inserted per executemany batch
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+# Per-row errors kept in the response; the total count is always reported
+MAX_REPORTED_ERRORS = int(os.getenv("BULK_MAX_REPORTED_ERRORS", "1000"))
+# Longest accepted line; longer ones are skipped and reported as row errors
+MAX_LINE_BYTES = int(os.getenv("BULK_MAX_LINE_BYTES", "65536"))
+
+
+class InvalidHeader(ValueError):
+    """The CSV header line can't be read, so no row can be."""
+
+
+async def iter_lines(stream, max_bytes=MAX_LINE_BYTES):
+    """Yield raw lines from an async byte stream without buffering the whole body.
+
+    A line longer than `max_bytes` is dropped as it streams in and yielded
+    as None, so a body without newlines can't grow the buffer without limit.
+    """
+    buffer = b""
+    skipping = False
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if skipping or len(line) > max_bytes:
+                skipping = False
+                yield None
+            else:
+                yield line
+        if len(buffer) > max_bytes:
+            buffer = b""
+            skipping = True
+    if skipping:
+        yield None
+    elif buffer:
+        yield buffer
+
+
+def _decode(line):
+    if line is None:
+        raise ValueError(f"Line is longer than {MAX_LINE_BYTES} bytes")
+    try:
+        return line.decode("utf-8").rstrip("\r")
+    except UnicodeDecodeError as e:
+        raise ValueError(f"Line is not valid UTF-8 (byte {e.start})")
+
+
+async def iter_records(lines, fmt):
+    """Yield (row_number, dict or None, error) for each NDJSON object or CSV row.
+
+    Raises InvalidHeader if the CSV header line is too long or not UTF-8.
+    """
+    header = None
+    row_number = 0
+    async for raw in lines:
+        if raw is not None and not raw.strip():
+            continue
+        if fmt == "csv" and header is None:
+            try:
+                header = next(csv.reader([_decode(raw)]))
+            except ValueError as e:
+                raise InvalidHeader(f"Invalid CSV header: {e}")
+            continue
+        row_number += 1
+        try:
+            line = _decode(raw)
+            if fmt == "csv":
+                values = next(csv.reader([line]))
+                if len(values) != len(header):
+                    raise ValueError(f"Expected {len(header)} columns, got {len(values)}")
+                record = dict(zip(header, values))
+            else:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("Each line must be a JSON object")
+            yield row_number, record, None
+        except ValueError as e:
+            yield row_number, None, str(e)
+
+
+def validation_messages(error: ValidationError):
+    return [
+        {"field": ".".join(str(part) for part in err["loc"]), "message": err["msg"]}
+        for err in error.errors()
+    ]
+
+
+def insert_tap_chunk(chunk):
+    """Insert one chunk of validated taps in a single transaction.
+
+    `chunk` is a list of (row_number, TapHistoryCreate). Rows that reference an
+    unknown customer are reported back instead of failing the whole chunk.
+    The customer check runs in the insert's transaction, so a customer can't
+    be deleted between the two. If the database fails the chunk is rolled
+    back and every row in it is reported as not stored.
+    Returns (inserted_count, errors).
+    """
+    customer_ids = {tap.customer_id for _, tap in chunk}
+    # Allocated up front: a counter-table lease can't wait on this transaction's lock
+    ids = [id_allocator.next_id("tap") for _ in chunk]
+    try:
+        with engine.begin() as conn:
+            if conn.dialect.name == "sqlite":
+                # Take the write lock before the check (pysqlite would only open
+                # the transaction at the INSERT)
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+            # FOR SHARE keeps the matched customers from being deleted until commit
+            known = set(conn.execute(
+                select(Customer.id).where(Customer.id.in_(customer_ids)).with_for_update(read=True)
+            ).scalars())
+            errors = []
+            rows = []
+            for tap_id, (row_number, tap) in zip(ids, chunk):
+                if tap.customer_id not in known:
+                    errors.append({
+                        "row": row_number,
+                        "errors": [{"field": "customer_id", "message": f"Customer '{tap.customer_id}' not found"}],
+                    })
+                    continue
+                rows.append({"id": tap_id, **tap.dict()})
+            if rows:
+                conn.execute(insert(TapHistory), rows)
+                increment(conn, {"total_tap_entries": len(rows)})
+                # Uploaded taps are usually historical; have the rollups pick them up
+                mark_dirty(conn, [row["tap_time"] for row in rows])
+    except SQLAlchemyError as e:
+        print(f"Bulk tap chunk of {len(chunk)} rows failed: {e}")
+        message = f"Database error ({type(e).__name__}); row not stored"
+        return 0, [{"row": row_number, "errors": [{"field": None, "message": message}]} for row_number, _ in chunk]
+    return len(rows), errors
@@ -0,0 +1,322 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import select
+from models import Card, Customer
+from projections import CARD_FIELDS, CUSTOMER_FIELDS, labelled, project
+
+# memory (in-process LRU), redis (shared, any Redis-compatible server) or none
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+# How long an invalidated key refuses read-through fills; must outlast a cache-miss DB read
+CACHE_TOMBSTONE_SECONDS = float(os.getenv("CACHE_TOMBSTONE_SECONDS", "2"))
+
+# Written over invalidated keys so an older read can't re-cache the row (see EntityCache)
+TOMBSTONE = {"__tombstone__": True}
+
+
+class CacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class NullCache:
+    """Backend used when caching is turned off; every lookup misses."""
+
+    name = "none"
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def add(self, key, value, ttl):
+        return True
+
+    def set_many(self, keys, value, ttl):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+    def size(self):
+        return 0
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with a per-entry TTL."""
+
+    name = "memory"
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl):
+        """Set `key` only if it is absent or expired; True if it was set."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def set_many(self, keys, value, ttl):
+        with self._lock:
+            for key in keys:
+                self._set(key, value, ttl)
+
+    def _set(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def size(self):
+        return len(self._entries)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode(obj):
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+class RedisCache:
+    """Shared backend for multi-worker deployments, backed by any Redis-compatible server."""
+
+    name = "redis"
+
+    def __init__(self, url=CACHE_URL, prefix="crm:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND=redis requires the 'redis' package")
+        self._client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self._client.get(self.prefix + key)
+        return json.loads(raw, object_hook=_decode) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(self.prefix + key, json.dumps(value, default=_encode), px=int(ttl * 1000))
+
+    def add(self, key, value, ttl):
+        return bool(self._client.set(self.prefix + key, json.dumps(value, default=_encode), px=int(ttl * 1000), nx=True))
+
+    def set_many(self, keys, value, ttl):
+        raw = json.dumps(value, default=_encode)
+        with self._client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.set(self.prefix + key, raw, px=int(ttl * 1000))
+            pipe.execute()
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        for key in self._client.scan_iter(match=self.prefix + "*"):
+            self._client.delete(key)
+
+    def size(self):
+        return sum(1 for _ in self._client.scan_iter(match=self.prefix + "*"))
+
+
+def make_backend(name=CACHE_BACKEND, max_entries=CACHE_MAX_ENTRIES, prefix="crm:"):
+    if name == "redis":
+        return RedisCache(prefix=prefix)
+    if name == "none":
+        return NullCache()
+    return LRUCache(max_entries)
+
+
+def card_to_dict(card):
+    # Same keys as the CARD_FIELDS rows cached by put_card_with_customer
+    return {name: getattr(card, name) for name in CARD_FIELDS}
+
+
+def customer_to_dict(customer):
+    return {column.key: getattr(customer, column.key) for column in Customer.__table__.columns}
+
+
+def card_with_customer_statement(card_id):
+    """One query for a card and its owner; project() the row with the "card_" / "customer_" prefixes."""
+    return (
+        select(*labelled(CARD_FIELDS, "card_"), *labelled(CUSTOMER_FIELDS, "customer_"))
+        .select_from(Card)
+        .outerjoin(Customer, Customer.id == Card.customer_id)
+        .where(Card.id == card_id)
+    )
+
+
+class EntityCache:
+    """Read-through cache of Card and Customer rows keyed by ID.
+
+    Values are plain column dicts, never ORM instances, so they can be shared
+    across sessions and threads. Every path that changes a card or customer
+    must call invalidate_card / invalidate_customer after committing; the TTL
+    bounds staleness if an invalidation is ever missed.
+
+    Invalidation overwrites the entry with a short-lived TOMBSTONE rather than
+    deleting it, and read-through fills only add() to absent keys. A reader
+    whose SELECT ran before a write committed therefore can't re-cache the old
+    row after the writer's invalidation; the key is refilled once the
+    tombstone expires.
+    """
+
+    def __init__(self, backend, ttl=CACHE_TTL_SECONDS, tombstone_ttl=CACHE_TOMBSTONE_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+        self.tombstone_ttl = tombstone_ttl
+        self.stats = CacheStats()
+
+    def _lookup(self, key):
+        value = self.backend.get(key)
+        if value is not None and "__tombstone__" in value:
+            value = None
+        self.stats.incr("hits" if value is not None else "misses")
+        return value
+
+    def _fill(self, key, value):
+        self.backend.add(key, value, self.ttl)
+
+    def get_card(self, db, card_id):
+        """Return the card's column dict, loading it from `db` on a miss, or None."""
+        key = f"card:{card_id}"
+        value = self._lookup(key)
+        if value is None:
+            card = db.query(Card).filter(Card.id == card_id).first()
+            if card is None:
+                return None
+            value = card_to_dict(card)
+            self._fill(key, value)
+        return value
+
+    def get_customer(self, db, customer_id):
+        key = f"customer:{customer_id}"
+        value = self._lookup(key)
+        if value is None:
+            customer = db.query(Customer).filter(Customer.id == customer_id).first()
+            if customer is None:
+                return None
+            value = customer_to_dict(customer)
+            self._fill(key, value)
+        return value
+
+    def get_card_with_customer(self, db, card_id):
+        """(card, customer) dicts, loading both with one joined query on a miss; None if no card."""
+        found = self.peek_card_with_customer(card_id)
+        if found is None:
+            row = db.execute(card_with_customer_statement(card_id)).first()
+            if row is None:
+                return None
+            found = self.put_card_with_customer(row)
+        return found
+
+    def peek_card_with_customer(self, card_id):
+        """Cache-only half of get_card_with_customer; None unless both entries are cached."""
+        card = self._lookup(f"card:{card_id}")
+        if card is None:
+            return None
+        customer = self._lookup(f"customer:{card['customer_id']}")
+        if customer is None:
+            return None
+        return card, customer
+
+    def put_card_with_customer(self, row):
+        """Cache the card and owner from a card_with_customer_statement() row and return them."""
+        card = project(row, CARD_FIELDS, "card_")
+        self.put("card", card["id"], card)
+        customer = None
+        if row._mapping["customer_id"] is not None:
+            customer = project(row, CUSTOMER_FIELDS, "customer_")
+            self.put("customer", customer["id"], customer)
+        return card, customer
+
+    def peek(self, kind, entity_id):
+        """Cache-only lookup for callers that load misses themselves (e.g. async routes)."""
+        return self._lookup(f"{kind}:{entity_id}")
+
+    def put(self, kind, entity_id, value):
+        """Read-through fill; a no-op while the key is cached or tombstoned."""
+        self._fill(f"{kind}:{entity_id}", value)
+
+    def invalidate_card(self, *card_ids):
+        self.stats.incr("invalidations", len(card_ids))
+        self.backend.set_many([f"card:{card_id}" for card_id in card_ids], TOMBSTONE, self.tombstone_ttl)
+
+    def invalidate_customer(self, *customer_ids):
+        self.stats.incr("invalidations", len(customer_ids))
+        self.backend.set_many([f"customer:{customer_id}" for customer_id in customer_ids], TOMBSTONE,
+                              self.tombstone_ttl)
+
+    def clear(self):
+        self.backend.clear()
+
+    def snapshot(self):
+        return {"backend": self.backend.name, "entries": self.backend.size(), "ttl_seconds": self.ttl,
+                "tombstone_seconds": self.tombstone_ttl,
+                **self.stats.snapshot()}
+
+
+# Shared cache for Card/Customer lookups
+entity_cache = EntityCache(make_backend())
@@ -0,0 +1,58 @@
+import random
+from sqlalchemy import select, inspect, text, update, func
+from models import Card
+
+# Every card carries a uniform random sample_key in [0, 1). Picking a random
+# point and reading the next n keys from the (filter, sample_key) index
+# returns n random cards in O(log N + n), however large the table is.
+
+
+def _random_key_sql(dialect_name):
+    if dialect_name == "postgresql":
+        return func.random()
+    # SQLite random() is a signed 64-bit integer
+    return func.abs(func.random()) / 9223372036854775808.0
+
+
+def ensure_sample_keys(bind):
+    """Add cards.sample_key to databases created before it existed and key any unkeyed rows.
+
+    Must run before ensure_indexes(), which creates the sample_key indexes.
+    """
+    columns = {column["name"] for column in inspect(bind).get_columns(Card.__tablename__)}
+    with bind.begin() as conn:
+        if "sample_key" not in columns:
+            conn.execute(text(f"ALTER TABLE {Card.__tablename__} ADD COLUMN sample_key FLOAT"))
+        # Rows written outside SQLAlchemy (raw SQL, COPY) miss the column default
+        keyed = conn.execute(
+            update(Card).where(Card.sample_key.is_(None)).values(sample_key=_random_key_sql(conn.dialect.name))
+        )
+    return keyed.rowcount
+
+
+def sample_cards(db, n=1, status=None, card_type=None, min_balance=None):
+    """Up to n distinct random cards matching the filters, without scanning the table.
+
+    Reads n rows onwards from a random sample_key, wrapping around to the
+    start of the key range if the end is reached first. A card's chance of
+    being picked is proportional to the key gap before it, so picks are not
+    exactly uniform: fine for choosing test cards, not for statistics.
+    """
+    query = select(Card.id, Card.balance, Card.status, Card.type)
+    if status is not None:
+        query = query.where(Card.status == status)
+    if card_type is not None:
+        query = query.where(Card.type == card_type)
+    if min_balance is not None:
+        query = query.where(Card.balance >= min_balance)
+
+    start = random.random()
+    rows = db.execute(query.where(Card.sample_key >= start).order_by(Card.sample_key).limit(n)).all()
+    if len(rows) < n:
+        rows += db.execute(query.where(Card.sample_key < start).order_by(Card.sample_key).limit(n - len(rows))).all()
+    # Adjacent keys come back in key order; shuffle so callers can't rely on it
+    random.shuffle(rows)
+    return [
+        {"id": row.id, "card_number": row.id, "balance": row.balance, "status": row.status, "type": row.type}
+        for row in rows
+    ]
@@ -0,0 +1,121 @@
+from sqlalchemy import select, union_all, case, func
+from models import Case
+
+# Case statuses an agent still has to act on
+OPEN_CASE_STATUSES = ("Open", "In Progress", "Pending")
+# Queue order: most urgent first. Case writes only accept these priorities
+# (api.py CaseCreate), so every open case lands in one of the queue's tiers.
+PRIORITY_ORDER = ("Critical", "High", "Medium", "Low")
+
+# /cases/ query parameters that filter on equality
+CASE_FILTERS = {
+    "case_status": Case.case_status,
+    "priority": Case.priority,
+    "assigned_agent": Case.assigned_agent,
+    "category": Case.category,
+    "customer_id": Case.customer_id,
+    "card_id": Case.card_id,
+}
+CASE_SORTS = {
+    "created_date": Case.created_date,
+    "last_updated": Case.last_updated,
+    "priority": Case.priority,
+    "case_status": Case.case_status,
+    "assigned_agent": Case.assigned_agent,
+    "category": Case.category,
+}
+SORT_ORDERS = ("asc", "desc")
+
+# Everything the queue returns lives in ix_cases_agent_queue, so the queue
+# is answered from the index alone (a covering index on SQLite, an
+# index-only scan on PostgreSQL).
+QUEUE_COLUMNS = (Case.id, Case.case_status, Case.assigned_agent, Case.priority, Case.created_date)
+
+
+def filter_cases(query, **filters):
+    """Apply the CASE_FILTERS given in `filters` to a Query or select(); None means any."""
+    for name, value in filters.items():
+        if value is not None:
+            query = query.filter(CASE_FILTERS[name] == value)
+    return query
+
+
+def case_sort(sort, order):
+    """(sort column, descending) for the /cases/ sort and order parameters."""
+    if sort not in CASE_SORTS:
+        raise ValueError(f"sort must be one of: {', '.join(CASE_SORTS)}")
+    if order not in SORT_ORDERS:
+        raise ValueError(f"order must be one of: {', '.join(SORT_ORDERS)}")
+    return CASE_SORTS[sort], order == "desc"
+
+
+def _priority_rank():
+    return case(
+        *[(Case.priority == priority, rank) for rank, priority in enumerate(PRIORITY_ORDER)],
+        else_=len(PRIORITY_ORDER),
+    )
+
+
+def _agent_queue_statement(agent, limit):
+    """The oldest `limit` cases of every (open status, priority) pair for one agent.
+
+    Each branch is an equality prefix of ix_cases_agent_queue read in
+    created_date order, so it stops after `limit` index entries however many
+    cases the agent has closed.
+    """
+    tiers = []
+    for status in OPEN_CASE_STATUSES:
+        for priority in PRIORITY_ORDER:
+            tiers.append(
+                select(*QUEUE_COLUMNS)
+                .where(Case.case_status == status, Case.assigned_agent == agent, Case.priority == priority)
+                .order_by(Case.created_date, Case.id)
+                .limit(limit)
+                .subquery()
+            )
+    # SQLite only accepts LIMIT on compound members wrapped in a subquery
+    return union_all(*[select(*tier.c) for tier in tiers])
+
+
+def _queue_key(row):
+    rank = PRIORITY_ORDER.index(row.priority) if row.priority in PRIORITY_ORDER else len(PRIORITY_ORDER)
+    return rank, row.created_date, row.id
+
+
+def _queue_item(row):
+    return {
+        "id": row.id,
+        "case_status": row.case_status,
+        "assigned_agent": row.assigned_agent,
+        "priority": row.priority,
+        "created_date": row.created_date,
+    }
+
+
+def agent_queue(db, assigned_agent=None, limit=10):
+    """Next open cases per agent: most urgent priority first, then oldest first.
+
+    With `assigned_agent` only that agent's queue is read; otherwise every
+    agent with open cases gets one, ranked with a window over the covering
+    index.
+    """
+    if assigned_agent is not None:
+        rows = db.execute(_agent_queue_statement(assigned_agent, limit)).all()
+        return {assigned_agent: [_queue_item(row) for row in sorted(rows, key=_queue_key)[:limit]]}
+
+    position = func.row_number().over(
+        partition_by=Case.assigned_agent,
+        order_by=(_priority_rank(), Case.created_date, Case.id),
+    ).label("position")
+    ranked = (
+        select(*QUEUE_COLUMNS, position)
+        .where(Case.case_status.in_(OPEN_CASE_STATUSES))
+        .subquery()
+    )
+    queues = {}
+    rows = db.execute(
+        select(ranked).where(ranked.c.position <= limit).order_by(ranked.c.assigned_agent, ranked.c.position)
+    )
+    for row in rows:
+        queues.setdefault(row.assigned_agent, []).append(_queue_item(row))
+    return queues
@@ -0,0 +1,108 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from sqlalchemy import select, and_
+from database import SessionLocal
+from models import Customer, Card, Trip, Case, TapHistory, FareDispute
+from pagination import paginate
+from case_queries import OPEN_CASE_STATUSES
+from projections import CUSTOMER_FIELDS, CARD_FIELDS, TRIP_FIELDS, TAP_FIELDS, model_fields, labelled, project
+
+# Rows returned per section unless the caller asks for fewer (MAX_PAGE_SIZE still applies)
+OVERVIEW_SECTION_LIMIT = int(os.getenv("OVERVIEW_SECTION_LIMIT", "20"))
+# Threads shared by every overview request. Each running section holds its
+# own session, so keep this well below the connection pool size.
+OVERVIEW_WORKERS = int(os.getenv("OVERVIEW_WORKERS", "4"))
+
+CASE_FIELDS = model_fields(Case)
+DISPUTE_FIELDS = model_fields(FareDispute)
+
+
+def _owned_card_ids(customer_id):
+    return select(Card.id).where(Card.customer_id == customer_id).scalar_subquery()
+
+
+class Section:
+    """One capped, keyset-paginated list of the overview."""
+
+    def __init__(self, fields, criteria, id_column, sort_column=None, descending=False):
+        self.fields = fields
+        self.criteria = criteria
+        self.id_column = id_column
+        self.sort_column = sort_column
+        self.descending = descending
+
+    def page(self, db, customer_id, limit, cursor):
+        # Plain column rows; no ORM instances are built for the overview
+        query = db.query(*self.fields.values()).filter(self.criteria(customer_id))
+        page = paginate(query, self.id_column, limit=limit, cursor=cursor,
+                        sort_column=self.sort_column, descending=self.descending)
+        return {
+            "items": [{name: getattr(row, column.key) for name, column in self.fields.items()} for row in page.items],
+            "next_cursor": page.next_cursor,
+            "prev_cursor": page.prev_cursor,
+        }
+
+
+SECTIONS = {
+    "cards": Section(CARD_FIELDS, lambda customer_id: Card.customer_id == customer_id, Card.id),
+    "trips": Section(TRIP_FIELDS, lambda customer_id: Trip.card_id.in_(_owned_card_ids(customer_id)),
+                     Trip.id, Trip.start_time, descending=True),
+    "tap_history": Section(TAP_FIELDS, lambda customer_id: TapHistory.customer_id == customer_id,
+                           TapHistory.id, TapHistory.tap_time, descending=True),
+    "open_cases": Section(CASE_FIELDS,
+                          lambda customer_id: and_(Case.customer_id == customer_id,
+                                                   Case.case_status.in_(OPEN_CASE_STATUSES)),
+                          Case.id, Case.created_date, descending=True),
+    "fare_disputes": Section(DISPUTE_FIELDS, lambda customer_id: FareDispute.card_id.in_(_owned_card_ids(customer_id)),
+                             FareDispute.id, FareDispute.dispute_date, descending=True),
+}
+
+_executor = ThreadPoolExecutor(max_workers=OVERVIEW_WORKERS, thread_name_prefix="customer-overview")
+
+
+def _submit(func, *args):
+    # Run in a copy of the request's context so per-request query logging
+    # and metrics still see the statements each section issues
+    return _executor.submit(copy_context().run, _in_session, func, *args)
+
+
+def _in_session(func, *args):
+    # Sessions are not thread-safe, so every concurrent section gets its own
+    db = SessionLocal()
+    try:
+        return func(db, *args)
+    finally:
+        db.close()
+
+
+def _customer(db, customer_id):
+    row = db.execute(select(*labelled(CUSTOMER_FIELDS)).where(Customer.id == customer_id)).first()
+    return project(row, CUSTOMER_FIELDS) if row is not None else None
+
+
+def customer_overview(customer_id, limit=OVERVIEW_SECTION_LIMIT, cursors=None, sections=None):
+    """The customer plus one page of every section, queried concurrently.
+
+    `cursors` maps section names to the cursor of the page wanted; `sections`
+    restricts the response to those sections (all by default). Returns None
+    if the customer does not exist. Raises ValueError for unknown sections
+    and InvalidCursor for bad cursors.
+    """
+    cursors = cursors or {}
+    names = list(SECTIONS) if sections is None else list(sections)
+    unknown = [name for name in names + list(cursors) if name not in SECTIONS]
+    if unknown:
+        raise ValueError(f"Unknown section(s): {', '.join(unknown)}; expected {', '.join(SECTIONS)}")
+
+    customer = _submit(_customer, customer_id)
+    pages = {
+        name: _submit(SECTIONS[name].page, customer_id, limit, cursors.get(name))
+        for name in names
+    }
+    overview = {"customer": customer.result()}
+    results = {name: future.result() for name, future in pages.items()}
+    if overview["customer"] is None:
+        return None
+    overview.update(results)
+    return overview
@@ -0,0 +1,153 @@
+import os
+import random
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import event, select, insert, update, func, bindparam
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
+from database import engine
+from models import DashboardCounter, Card, Customer, Trip, Case, TapHistory
+from periodic import PeriodicJob
+
+# Each counter is spread over this many rows; a write bumps one random shard,
+# so concurrent transactions rarely wait on the same row lock.
+DASHBOARD_COUNTER_SHARDS = int(os.getenv("DASHBOARD_COUNTER_SHARDS", "8"))
+# How often the background job recomputes the totals from scratch (0 disables it)
+DASHBOARD_RECONCILE_SECONDS = float(os.getenv("DASHBOARD_RECONCILE_SECONDS", "300"))
+# total_balance is a float sum; smaller differences are not reported as drift
+BALANCE_TOLERANCE = 0.005
+
+COUNTED_MODELS = {
+    Card: "total_cards",
+    Customer: "total_customers",
+    Trip: "total_trips",
+    Case: "total_cases",
+    TapHistory: "total_tap_entries",
+}
+COUNTERS = tuple(COUNTED_MODELS.values()) + ("total_balance",)
+
+_counters = DashboardCounter.__table__
+
+
+def increment(conn, deltas):
+    """Add `deltas` (counter name -> amount) to the counters in the caller's transaction."""
+    params = [
+        {"counter": name, "counter_shard": random.randrange(DASHBOARD_COUNTER_SHARDS), "delta": delta}
+        for name, delta in deltas.items() if delta
+    ]
+    if params:
+        conn.execute(
+            update(_counters)
+            .where(_counters.c.name == bindparam("counter"), _counters.c.shard == bindparam("counter_shard"))
+            .values(value=_counters.c.value + bindparam("delta")),
+            params,
+        )
+
+
+def read_counters(conn):
+    """Current totals; O(counters x shards) whatever the size of the tables."""
+    totals = dict(conn.execute(
+        select(_counters.c.name, func.sum(_counters.c.value)).group_by(_counters.c.name)
+    ).all())
+    return {name: totals.get(name, 0) for name in COUNTERS}
+
+
+def exact_counts(conn):
+    """The same totals computed with full scans."""
+    totals = {
+        name: conn.execute(select(func.count()).select_from(model)).scalar()
+        for model, name in COUNTED_MODELS.items()
+    }
+    totals["total_balance"] = conn.execute(select(func.sum(Card.balance))).scalar() or 0.0
+    return totals
+
+
+def ensure_counters(bind):
+    """Create any missing counter rows, seeding a fresh table from exact counts."""
+    with bind.begin() as conn:
+        existing = set(conn.execute(select(_counters.c.name, _counters.c.shard)).all())
+        seed = exact_counts(conn) if not existing else {}
+        rows = [
+            {"name": name, "shard": shard, "value": seed.get(name, 0) if shard == 0 else 0}
+            for name in COUNTERS
+            for shard in range(DASHBOARD_COUNTER_SHARDS)
+            if (name, shard) not in existing
+        ]
+        if rows:
+            conn.execute(insert(_counters), rows)
+
+
+def reconcile(bind, repair=True):
+    """Recompute every total from scratch and report how far the counters drifted.
+
+    Counters and exact totals are read in one snapshot: a REPEATABLE READ
+    transaction on PostgreSQL, an explicit BEGIN on SQLite. With `repair` the drift is
+    added back as an ordinary increment, which stays correct even while other
+    writers keep updating the counters.
+    """
+    with bind.connect() as conn:
+        if bind.dialect.name == "postgresql":
+            conn = conn.execution_options(isolation_level="REPEATABLE READ")
+        with conn.begin():
+            if bind.dialect.name == "sqlite":
+                # pysqlite only opens a transaction before writes, so without
+                # this every SELECT below would read its own snapshot
+                conn.exec_driver_sql("BEGIN")
+            exact = exact_counts(conn)
+            counted = read_counters(conn)
+    drift = {}
+    for name in COUNTERS:
+        difference = exact[name] - counted[name]
+        tolerance = BALANCE_TOLERANCE if name == "total_balance" else 0.5
+        if abs(difference) > tolerance:
+            drift[name] = difference
+    if repair and drift:
+        with bind.begin() as conn:
+            increment(conn, drift)
+    return {
+        "checked_at": datetime.now().isoformat(),
+        "exact": exact,
+        "counted": counted,
+        "drift": drift,
+        "repaired": bool(repair and drift),
+    }
+
+
+@event.listens_for(Session, "after_flush")
+def _count_flushed_rows(session, flush_context):
+    """Keep the counters in step with ORM inserts, deletes and Card.balance edits.
+
+    Core statements (balance_ledger, the tap ingestor, bulk uploads) call
+    increment() themselves.
+    """
+    deltas = defaultdict(float)
+    for instance in session.new:
+        name = COUNTED_MODELS.get(type(instance))
+        if name:
+            deltas[name] += 1
+            if name == "total_cards":
+                deltas["total_balance"] += instance.balance or 0
+    for instance in session.deleted:
+        name = COUNTED_MODELS.get(type(instance))
+        if name:
+            deltas[name] -= 1
+            if name == "total_cards":
+                # Never lazy-load here; an unloaded balance is left to reconcile()
+                deltas["total_balance"] -= instance.__dict__.get("balance") or 0
+    for instance in session.dirty:
+        if isinstance(instance, Card):
+            history = get_history(instance, "balance", passive=PASSIVE_NO_INITIALIZE)
+            deltas["total_balance"] += sum(v or 0 for v in history.added) - sum(v or 0 for v in history.deleted)
+    if deltas:
+        increment(session.connection(), deltas)
+
+
+def reconcile_and_report(repair=True):
+    report = reconcile(engine, repair)
+    if report["drift"]:
+        print(f"Dashboard counter drift {'repaired' if report['repaired'] else 'found'}: {report['drift']}")
+    return report
+
+
+# Shared reconciler started by main.py
+counter_reconciler = PeriodicJob("counter-reconciler", DASHBOARD_RECONCILE_SECONDS, reconcile_and_report)
@@ -1,6 +1,9 @@
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from engine_config import engine_options, async_engine_options, configure_engine, install_sqlite_pragmas
+from query_logging import install_query_logging
+from request_metrics import install_request_metrics
 import os
 
 # Check for DATABASE_URL environment variable (for production)
@@ -18,12 +21,18 @@ else:
     SQLALCHEMY_DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
     connect_args = {"check_same_thread": False}
 
-# Create SQLAlchemy engine with proper settings
+# Create SQLAlchemy engine with proper settings; pool sizing, statement
+# timeout and SQLite pragmas come from the DB_* / SQLITE_* env vars
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
-    connect_args=connect_args,
-    echo=True  # Enable SQL logging for debugging
+    # Raw SQL echo for local debugging only; use the sampled query log otherwise
+    echo=os.getenv("DB_ECHO", "false").lower() == "true",
+    **engine_options(SQLALCHEMY_DATABASE_URL, connect_args)
 )
+configure_engine(engine)
+install_query_logging(engine)
+# Per-request DB time and statement counts for /admin/metrics (METRICS_SAMPLE_RATE > 0)
+install_request_metrics(engine)
 
 # Create sessionmaker
 SessionLocal = sessionmaker(
@@ -41,4 +50,38 @@ def get_db():
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close()
+
+# Optional async engine (asyncpg for PostgreSQL, aiosqlite for SQLite).
+# The async routes in routers/async_api.py are only mounted when this is on.
+USE_ASYNC_DB = os.getenv("USE_ASYNC_DB", "false").lower() == "true"
+
+def async_database_url(url):
+    """Map a sync database URL onto the matching async driver"""
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    if url.startswith("postgresql://"):
+        return "postgresql+asyncpg://" + url[len("postgresql://"):]
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    return url
+
+async_engine = None
+AsyncSessionLocal = None
+
+if USE_ASYNC_DB:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+    ASYNC_DATABASE_URL = async_database_url(SQLALCHEMY_DATABASE_URL)
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **async_engine_options(ASYNC_DATABASE_URL))
+    install_sqlite_pragmas(async_engine.sync_engine)
+    install_request_metrics(async_engine.sync_engine)
+    AsyncSessionLocal = async_sessionmaker(
+        async_engine,
+        autoflush=True,
+        expire_on_commit=False
+    )
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db 
\ No newline at end of file
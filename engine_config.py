@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+
+def env_int(name, default):
+    return int(os.getenv(name, str(default)))
+
+
+def env_bool(name, default):
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes", "on")
+
+
+# Pool settings (ignored by SQLite in-memory databases)
+DB_POOL_SIZE = env_int("DB_POOL_SIZE", 5)
+DB_MAX_OVERFLOW = env_int("DB_MAX_OVERFLOW", 10)
+DB_POOL_TIMEOUT = env_int("DB_POOL_TIMEOUT", 30)
+DB_POOL_RECYCLE = env_int("DB_POOL_RECYCLE", 1800)
+DB_POOL_PRE_PING = env_bool("DB_POOL_PRE_PING", True)
+
+# PostgreSQL: abort statements that run longer than this (0 disables)
+DB_STATEMENT_TIMEOUT_MS = env_int("DB_STATEMENT_TIMEOUT_MS", 0)
+
+# SQLite connection pragmas
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = env_int("SQLITE_BUSY_TIMEOUT_MS", 5000)
+
+
+class PoolStats:
+    """Counters for connection checkouts and how long callers waited for one."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkins = 0
+            self.connects = 0
+            self.invalidations = 0
+            self.timeouts = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.checkouts += 0 if timed_out else 1
+            self.timeouts += 1 if timed_out else 0
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self, pool=None):
+        with self._lock:
+            waits = self.checkouts + self.timeouts
+            stats = {
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "checkout_timeouts": self.timeouts,
+                "total_wait_ms": round(self.total_wait * 1000, 3),
+                "avg_wait_ms": round(self.total_wait * 1000 / waits, 3) if waits else 0.0,
+                "max_wait_ms": round(self.max_wait * 1000, 3),
+            }
+        if isinstance(pool, QueuePool):
+            stats.update({
+                "pool_size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+            })
+        return stats
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_stats.record_wait(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_stats.record_wait(time.perf_counter() - started)
+        return connection
+
+
+def is_sqlite(url):
+    return url.startswith("sqlite")
+
+
+def engine_options(url, connect_args=None):
+    """Keyword arguments for create_engine() built from the DB_* settings."""
+    connect_args = dict(connect_args or {})
+    options = {"pool_pre_ping": DB_POOL_PRE_PING}
+    if is_sqlite(url) and ":memory:" in url:
+        options["connect_args"] = connect_args
+        return options
+    options.update({
+        "poolclass": TimedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+    })
+    if not is_sqlite(url) and DB_STATEMENT_TIMEOUT_MS:
+        connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    options["connect_args"] = connect_args
+    return options
+
+
+def async_engine_options(url):
+    """Pool settings for the async engine; the async drivers use their own pool class."""
+    options = {
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+    if "asyncpg" in url and DB_STATEMENT_TIMEOUT_MS:
+        options["connect_args"] = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+    return options
+
+
+def install_sqlite_pragmas(engine):
+    """Set WAL journaling, synchronous level and busy timeout on every new SQLite connection."""
+    if engine.dialect.name != "sqlite":
+        return engine
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+    return engine
+
+
+def configure_engine(engine):
+    """Attach pool statistics and, on SQLite, the connection pragmas."""
+    install_sqlite_pragmas(engine)
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        pool_stats.incr("connects")
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        pool_stats.incr("checkins")
+
+    @event.listens_for(engine, "invalidate")
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        pool_stats.incr("invalidations")
+
+    return engine
+
+
+def sqlite_pragmas(engine):
+    """Current journal mode, synchronous level and busy timeout, for the admin endpoint."""
+    if engine.dialect.name != "sqlite":
+        return None
+    with engine.connect() as conn:
+        return {
+            "journal_mode": conn.exec_driver_sql("PRAGMA journal_mode").scalar(),
+            "synchronous": conn.exec_driver_sql("PRAGMA synchronous").scalar(),
+            "busy_timeout": conn.exec_driver_sql("PRAGMA busy_timeout").scalar(),
+        }
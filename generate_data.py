@@ -1,16 +1,46 @@
-from faker import Faker
-from datetime import datetime, timedelta
+"""Generate sample customers, cards, trips, cases and tap history.
+
+Usage: python generate_data.py [--customers 50] [--trips-per-card 2-4]
+       [--cases-per-customer 2-4] [--taps-per-customer 1-3]
+       [--workers 1] [--seed 42] [--chunk-size 2000]
+
+Customers are generated in chunks of --chunk-size; each chunk is built from
+its own seeded random generator and written with Core bulk inserts (COPY on
+PostgreSQL) in one transaction, so memory stays flat however large the run
+and the same seed produces the same data whatever the number of workers.
+"""
+import argparse
+import csv
+import io
+import math
+import multiprocessing
 import random
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from faker.providers.person.en_US import Provider as PersonProvider
+from faker.providers.internet.en_US import Provider as InternetProvider
+from sqlalchemy import insert
 from database import SessionLocal, engine, Base
-from models import Customer, Card, Trip, Case, TapHistory
-import string
-
-# Initialize Faker
-fake = Faker(['en_US'])
+from models import Customer, Card, Trip, Case, TapHistory, CardTransaction, CardBalanceSnapshot
+from dashboard_counters import ensure_counters, reconcile
+from analytics import refresh_rollups
+from search import ensure_search_index, rebuild_search_index
+from card_sampling import ensure_sample_keys
+from id_allocator import id_allocator
+from cache import entity_cache
 
 # Configuration - MODIFY THESE NUMBERS TO CHANGE DATA GENERATION
+# (or pass them on the command line / to POST /admin/generate-data)
 CONFIG = {
-    'NUM_CUSTOMERS': 50  # Total number of customers to generate
+    'NUM_CUSTOMERS': 50,  # Total number of customers to generate
+    'TRIPS_PER_CARD': (2, 4),  # Every customer has one card
+    'CASES_PER_CUSTOMER': (2, 4),
+    'TAPS_PER_CUSTOMER': (1, 3),
+    'CHUNK_SIZE': 2000,  # Customers generated and inserted per transaction
+    'WORKERS': 1,  # Processes generating chunks in parallel
+    'SEED': 42,
 }
 
 # Lists for generating varied data
@@ -32,8 +62,41 @@ DEVICE_TYPES = ["Reader", "Kiosk", "Gate", "Validator"]
 DIRECTIONS = ["Entry", "Exit"]
 TAP_RESULTS = ["Success", "Failure", "Timeout"]
 
-# Move tap_counter outside the function to ensure uniqueness across all calls
-TAP_COUNTER = 1
+# Exit stations for each entry station, built once instead of per trip
+EXIT_STATIONS = {station: [s for s in STATIONS if s != station] for station in STATIONS}
+
+# Customer names must be unique. Rather than drawing Faker names and retrying
+# on collisions (which needs every earlier name, across every worker), the
+# customer number is mapped onto a (first name, last name) pair by a
+# permutation of all pairs; numbers past the last pair get a numeric suffix.
+FIRST_NAMES = list(PersonProvider.first_names)
+LAST_NAMES = list(PersonProvider.last_names)
+EMAIL_DOMAINS = list(InternetProvider.free_email_domains)
+NAME_PAIRS = len(FIRST_NAMES) * len(LAST_NAMES)
+NAME_STRIDE = next(step for step in range(7919, NAME_PAIRS) if math.gcd(step, NAME_PAIRS) == 1)
+
+# Tables in insert order (parents before children)
+TABLES = [
+    ("customers", Customer.__table__),
+    ("cards", Card.__table__),
+    ("trips", Trip.__table__),
+    ("cases", Case.__table__),
+    ("tap_history", TapHistory.__table__),
+]
+
+
+def parse_count_range(value):
+    """'3' -> (3, 3), '2-4' -> (2, 4); tuples pass through. Raises ValueError."""
+    if isinstance(value, (tuple, list)):
+        low, high = value
+    else:
+        low, _, high = str(value).partition("-")
+        high = high or low
+    low, high = int(low), int(high)
+    if low < 0 or high < low:
+        raise ValueError(f"Invalid count range {value!r}; expected N or MIN-MAX with 0 <= MIN <= MAX")
+    return low, high
+
 
 def get_db():
     db = SessionLocal()
@@ -47,6 +110,8 @@ def clear_existing_data(db):
     """Clear all existing data from the tables"""
     print("Clearing existing data...")
     try:
+        db.query(CardBalanceSnapshot).delete()
+        db.query(CardTransaction).delete()
         db.query(TapHistory).delete()
         db.query(Case).delete()
         db.query(Trip).delete()
@@ -59,221 +124,325 @@ def clear_existing_data(db):
         db.rollback()
         raise
 
-def create_customers(count):
-    """Create specified number of customers"""
-    customers = []
-    used_names = set()
-    used_emails = set()
-    
-    for i in range(count):
-        # Generate unique name
-        while True:
-            name = fake.name()
-            if name not in used_names:
-                used_names.add(name)
-                break
-        
-        # Generate unique email
-        while True:
-            email = fake.email()
-            if email not in used_emails:
-                used_emails.add(email)
-                break
-        
-        customer = Customer(
-            id=f"CUST{str(i+1).zfill(6)}",
-            name=name,
-            email=email,
-            phone=fake.phone_number(),
-            notifications="Email Enabled",
-            join_date=datetime.now() - timedelta(days=random.randint(0, 365))
-        )
-        customers.append(customer)
-    return customers
-
-def create_cards(customers):
-    """Create one card for each customer"""
-    cards = []
-    for i, customer in enumerate(customers):
-        card = Card(
-            id=f"4716{str(i+1).zfill(12)}",
-            type=random.choice(CARD_TYPES),
-            status=random.choice(CARD_STATUSES),
-            balance=round(random.uniform(20, 200), 2),
-            customer_id=customer.id,
-            issue_date=datetime.now() - timedelta(days=random.randint(0, 180))
-        )
-        cards.append(card)
-    return cards
-
-def create_trips(customers, cards):
-    """Create 2-4 trips for each card"""
-    trips = []
-    trip_counter = 1
-    print(f"Creating trips for {len(cards)} cards...")
-    for i, card in enumerate(cards):
-        num_trips = random.randint(2, 4)
-        print(f"Card {i+1}/{len(cards)}: {card.id}: {num_trips} trips")
-        for _ in range(num_trips):
-            start_time = datetime.now() - timedelta(days=random.randint(1, 30), hours=random.randint(1, 23))
-            end_time = start_time + timedelta(minutes=random.randint(15, 120))
-            entry_loc = random.choice(STATIONS)
-            exit_loc = random.choice([s for s in STATIONS if s != entry_loc])
-            trip = Trip(
-                id=f"T{str(trip_counter).zfill(6)}",
-                card_id=card.id,
-                start_time=start_time,
-                end_time=end_time,
-                entry_location=entry_loc,
-                exit_location=exit_loc,
-                fare=round(random.uniform(2, 25), 2),
-                route=random.choice(ROUTES),
-                operator=random.choice(OPERATORS),
-                transit_mode=random.choice(TRANSIT_MODES),
-                adjustable=random.choice(["Yes", "No"])
-            )
-            trips.append(trip)
-            trip_counter += 1
-    print(f"Total trips created: {len(trips)}")
-    return trips
-
-def create_cases(customers, cards):
-    """Create 2-4 cases for each customer (using their card)"""
-    cases = []
-    case_counter = 1
-    for customer in customers:
-        card = next(card for card in cards if card.customer_id == customer.id)
-        num_cases = random.randint(2, 4)
-        for _ in range(num_cases):
-            category = random.choice(CASE_CATEGORIES)
-            created_date = datetime.now() - timedelta(days=random.randint(1, 30))
-            case = Case(
-                id=f"CS{str(case_counter).zfill(6)}",
-                created_date=created_date,
-                last_updated=created_date + timedelta(hours=random.randint(1, 48)),
-                customer_id=customer.id,
-                card_id=card.id,
-                case_status=random.choice(CASE_STATUSES),
-                priority=random.choice(CASE_PRIORITIES),
-                category=category,
-                assigned_agent=random.choice(AGENTS),
-                notes=f"Sample case for {category}"
-            )
-            cases.append(case)
-            case_counter += 1
-    return cases
-
-def create_tap_history(customers, cards, trips):
-    """Create 1-3 tap history entries for each customer (using their card and random trip info)"""
-    tap_history = []
-    tap_counter = 1
-    for customer in customers:
-        card = next(card for card in cards if card.customer_id == customer.id)
-        customer_trips = [trip for trip in trips if trip.card_id == card.id]
-        num_taps = random.randint(1, 3)
-        for _ in range(num_taps):
+
+def _id(prefix, number, width):
+    return f"{prefix}{str(number).zfill(width)}"
+
+
+def _customer_name(number, seed):
+    repeat, slot = divmod(number - 1, NAME_PAIRS)
+    pair = (slot * NAME_STRIDE + seed) % NAME_PAIRS
+    first, last = FIRST_NAMES[pair % len(FIRST_NAMES)], LAST_NAMES[pair // len(FIRST_NAMES)]
+    return first, last, f"{first} {last}" + (f" {repeat + 1}" if repeat else "")
+
+
+def generate_chunk(index, first, last, settings):
+    """Rows for customers numbered first..last-1 and everything they own.
+
+    Returns (rows by table name, number of customers with trips, cases and
+    tap history). IDs are derived from the customer number, so chunks never
+    need to coordinate.
+    """
+    rng = random.Random(f"{settings['seed']}:{index}")
+    now = settings["now"]
+    widths = settings["widths"]
+    trips_per_card = settings["trips_per_card"]
+    cases_per_customer = settings["cases_per_customer"]
+    taps_per_customer = settings["taps_per_customer"]
+    rows = {name: [] for name, _ in TABLES}
+    coverage = {"trips": 0, "cases": 0, "tap_history": 0}
+
+    for number in range(first, last):
+        customer_id = _id("CUST", number, 6)
+        first_name, last_name, name = _customer_name(number, settings["seed"])
+        rows["customers"].append({
+            "id": customer_id,
+            "name": name,
+            "email": f"{first_name}.{last_name}{number}@{rng.choice(EMAIL_DOMAINS)}".lower(),
+            "phone": f"({rng.randint(200, 999)}) {rng.randint(200, 999)}-{rng.randint(0, 9999):04d}",
+            "notifications": "Email Enabled",
+            "join_date": now - timedelta(days=rng.randint(0, 365)),
+        })
+
+        card_id = _id("4716", number, 12)
+        rows["cards"].append({
+            "id": card_id,
+            "type": rng.choice(CARD_TYPES),
+            "status": rng.choice(CARD_STATUSES),
+            "balance": round(rng.uniform(20, 200), 2),
+            "customer_id": customer_id,
+            "issue_date": now - timedelta(days=rng.randint(0, 180)),
+            # Set here rather than by the column default so COPY rows get one too
+            "sample_key": rng.random(),
+        })
+
+        customer_trips = []
+        for k in range(rng.randint(*trips_per_card)):
+            start_time = now - timedelta(days=rng.randint(1, 30), hours=rng.randint(1, 23))
+            entry_loc = rng.choice(STATIONS)
+            trip = {
+                "id": _id("T", (number - 1) * trips_per_card[1] + k + 1, widths["trips"]),
+                "card_id": card_id,
+                "start_time": start_time,
+                "end_time": start_time + timedelta(minutes=rng.randint(15, 120)),
+                "entry_location": entry_loc,
+                "exit_location": rng.choice(EXIT_STATIONS[entry_loc]),
+                "fare": round(rng.uniform(2, 25), 2),
+                "route": rng.choice(ROUTES),
+                "operator": rng.choice(OPERATORS),
+                "transit_mode": rng.choice(TRANSIT_MODES),
+                "adjustable": rng.choice(["Yes", "No"]),
+            }
+            customer_trips.append(trip)
+        rows["trips"].extend(customer_trips)
+        coverage["trips"] += bool(customer_trips)
+
+        num_cases = rng.randint(*cases_per_customer)
+        for k in range(num_cases):
+            category = rng.choice(CASE_CATEGORIES)
+            created_date = now - timedelta(days=rng.randint(1, 30))
+            rows["cases"].append({
+                "id": _id("CS", (number - 1) * cases_per_customer[1] + k + 1, widths["cases"]),
+                "created_date": created_date,
+                "last_updated": created_date + timedelta(hours=rng.randint(1, 48)),
+                "customer_id": customer_id,
+                "card_id": card_id,
+                "case_status": rng.choice(CASE_STATUSES),
+                "priority": rng.choice(CASE_PRIORITIES),
+                "category": category,
+                "assigned_agent": rng.choice(AGENTS),
+                "notes": f"Sample case for {category}",
+            })
+        coverage["cases"] += bool(num_cases)
+
+        num_taps = rng.randint(*taps_per_customer)
+        for k in range(num_taps):
+            # Taps follow one of the customer's own trips when there is one
             if customer_trips:
-                trip = random.choice(customer_trips)
-                tap_time = trip.start_time + timedelta(minutes=random.randint(0, 30))
-                location = random.choice([trip.entry_location, trip.exit_location])
-                transit_mode = trip.transit_mode
+                trip = rng.choice(customer_trips)
+                tap_time = trip["start_time"] + timedelta(minutes=rng.randint(0, 30))
+                location = rng.choice([trip["entry_location"], trip["exit_location"]])
+                transit_mode = trip["transit_mode"]
             else:
-                tap_time = datetime.now() - timedelta(days=random.randint(1, 30), hours=random.randint(1, 23), minutes=random.randint(0, 59))
-                location = random.choice(STATIONS)
-                transit_mode = random.choice(TRANSIT_MODES)
-            device_type = random.choice(DEVICE_TYPES)
-            device_number = random.randint(100, 999)
-            tap = TapHistory(
-                id=f"TH{str(tap_counter).zfill(6)}",
-                tap_time=tap_time,
-                location=location,
-                device_id=f"{device_type} {device_number}",
-                transit_mode=transit_mode,
-                direction=random.choice(DIRECTIONS),
-                customer_id=customer.id,
-                result=random.choice(TAP_RESULTS)
-            )
-            tap_history.append(tap)
-            tap_counter += 1
-    return tap_history
-
-def print_statistics(customers, cards, trips, cases, tap_history):
+                tap_time = now - timedelta(days=rng.randint(1, 30), hours=rng.randint(1, 23), minutes=rng.randint(0, 59))
+                location = rng.choice(STATIONS)
+                transit_mode = rng.choice(TRANSIT_MODES)
+            rows["tap_history"].append({
+                "id": _id("TH", (number - 1) * taps_per_customer[1] + k + 1, widths["tap_history"]),
+                "tap_time": tap_time,
+                "location": location,
+                "device_id": f"{rng.choice(DEVICE_TYPES)} {rng.randint(100, 999)}",
+                "transit_mode": transit_mode,
+                "direction": rng.choice(DIRECTIONS),
+                "customer_id": customer_id,
+                "result": rng.choice(TAP_RESULTS),
+            })
+        coverage["tap_history"] += bool(num_taps)
+    return rows, coverage
+
+
+def bulk_insert(conn, table, rows):
+    """Insert a list of column dicts: COPY on PostgreSQL, executemany elsewhere."""
+    if not rows:
+        return
+    if conn.dialect.name != "postgresql":
+        conn.execute(insert(table), rows)
+        return
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([row[column] for column in columns] for row in rows)
+    buffer.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+
+
+def build_chunk(task):
+    index, first, last, settings = task
+    return generate_chunk(index, first, last, settings)
+
+
+def write_chunk(rows):
+    """Insert one chunk's rows in a single transaction; returns the row count per table."""
+    with engine.begin() as conn:
+        for name, table in TABLES:
+            bulk_insert(conn, table, rows[name])
+    return {name: len(table_rows) for name, table_rows in rows.items()}
+
+
+def insert_chunk(task):
+    """Generate and insert one chunk; returns (counts, coverage)."""
+    rows, coverage = build_chunk(task)
+    return write_chunk(rows), coverage
+
+
+def _ordered_results(pool, func, tasks, window):
+    """pool.map that keeps at most `window` chunks in flight, so finished
+    chunks never pile up in memory waiting for the consumer."""
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.submit(func, task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _run_chunks(tasks, workers):
+    if workers <= 1:
+        for task in tasks:
+            yield insert_chunk(task)
+        return
+    # spawn: every worker opens its own engine instead of sharing the parent's connections
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        if engine.dialect.name == "sqlite":
+            # SQLite allows one writer at a time and concurrent bulk inserts
+            # run past the busy timeout, so workers only build rows and this
+            # process writes them one chunk after another
+            for rows, coverage in _ordered_results(pool, build_chunk, tasks, workers * 2):
+                yield write_chunk(rows), coverage
+        else:
+            yield from _ordered_results(pool, insert_chunk, tasks, workers * 2)
+
+
+def rebuild_derived_data():
+    """Bring everything the bulk load bypassed back in line with the tables."""
+    # Bulk deletes bypass the dashboard counters; bring them back in line
+    reconcile(engine)
+    # Generated trips and taps span past months; rebuild the analytics rollups
+    refresh_rollups(engine, rebuild=True)
+    # The bulk deletes and Core inserts skip the search hooks as well
+    rebuild_search_index(engine)
+    # Generated IDs were not leased from the allocator; re-seed it above them
+    id_allocator.restart(["customer", "trip", "case", "tap"])
+    entity_cache.clear()
+
+
+def print_statistics(counts, coverage, elapsed):
     """Print generation statistics"""
+    customers = counts["customers"] or 1
     print("\n=== Data Generation Statistics ===")
-    print(f"Total Customers: {len(customers)}")
-    print(f"Total Cards: {len(cards)}")
-    print(f"Total Trips: {len(trips)}")
-    print(f"Total Cases: {len(cases)}")
-    print(f"Total Tap History Entries: {len(tap_history)}")
-    print(f"Average Trips per Card: {len(trips)/len(cards):.1f}")
-    print(f"Average Cases per Customer: {len(cases)/len(customers):.1f}")
-    print(f"Average Tap History Entries per Customer: {len(tap_history)/len(customers):.1f}")
-    
-    # Check coverage
-    # Create a mapping of card_id to customer_id
-    card_to_customer = {card.id: card.customer_id for card in cards}
-    customers_with_trips = len(set(card_to_customer.get(trip.card_id) for trip in trips if trip.card_id in card_to_customer))
-    customers_with_cases = len(set(case.customer_id for case in cases))
-    customers_with_tap_history = len(set(tap.customer_id for tap in tap_history))
-    
+    print(f"Total Customers: {counts['customers']}")
+    print(f"Total Cards: {counts['cards']}")
+    print(f"Total Trips: {counts['trips']}")
+    print(f"Total Cases: {counts['cases']}")
+    print(f"Total Tap History Entries: {counts['tap_history']}")
+    print(f"Average Trips per Card: {counts['trips']/(counts['cards'] or 1):.1f}")
+    print(f"Average Cases per Customer: {counts['cases']/customers:.1f}")
+    print(f"Average Tap History Entries per Customer: {counts['tap_history']/customers:.1f}")
+    print(f"Rows per second: {sum(counts.values())/max(elapsed, 1e-9):,.0f} ({elapsed:.1f}s)")
+
     print(f"\n=== Coverage Statistics ===")
-    print(f"Customers with Trips: {customers_with_trips}/{len(customers)} ({customers_with_trips/len(customers)*100:.1f}%)")
-    print(f"Customers with Cases: {customers_with_cases}/{len(customers)} ({customers_with_cases/len(customers)*100:.1f}%)")
-    print(f"Customers with Tap History: {customers_with_tap_history}/{len(customers)} ({customers_with_tap_history/len(customers)*100:.1f}%)")
-    
+    print(f"Customers with Trips: {coverage['trips']}/{counts['customers']} ({coverage['trips']/customers*100:.1f}%)")
+    print(f"Customers with Cases: {coverage['cases']}/{counts['customers']} ({coverage['cases']/customers*100:.1f}%)")
+    print(f"Customers with Tap History: {coverage['tap_history']}/{counts['customers']} ({coverage['tap_history']/customers*100:.1f}%)")
+
     # Verify all customers have data
-    if customers_with_trips == len(customers) and customers_with_cases == len(customers) and customers_with_tap_history == len(customers):
+    if all(covered == counts["customers"] for covered in coverage.values()):
         print("\n✅ SUCCESS: All customers have trips, cases, and tap history!")
     else:
         print("\n⚠️  WARNING: Some customers are missing data!")
 
-def main():
-    """Main function to generate sample data"""
+
+def main(customers=None, trips_per_card=None, cases_per_customer=None, taps_per_customer=None,
+         workers=None, seed=None, chunk_size=None):
+    """Main function to generate sample data; arguments default to CONFIG.
+
+    Count ranges accept N or 'MIN-MAX'. Returns the number of rows written per table.
+    """
+    customers = CONFIG['NUM_CUSTOMERS'] if customers is None else customers
+    workers = CONFIG['WORKERS'] if workers is None else workers
+    chunk_size = CONFIG['CHUNK_SIZE'] if chunk_size is None else chunk_size
+    if customers < 1 or workers < 1 or chunk_size < 1:
+        raise ValueError("customers, workers and chunk_size must be at least 1")
+    settings = {
+        "seed": CONFIG['SEED'] if seed is None else seed,
+        "trips_per_card": parse_count_range(CONFIG['TRIPS_PER_CARD'] if trips_per_card is None else trips_per_card),
+        "cases_per_customer": parse_count_range(CONFIG['CASES_PER_CUSTOMER'] if cases_per_customer is None else cases_per_customer),
+        "taps_per_customer": parse_count_range(CONFIG['TAPS_PER_CUSTOMER'] if taps_per_customer is None else taps_per_customer),
+        # One clock for every worker, so a chunk's dates don't depend on when it ran
+        "now": datetime.now().replace(microsecond=0),
+    }
+    # Zero-pad every ID to the width of the largest one so string order matches numeric order
+    settings["widths"] = {
+        name: max(6, len(str(customers * settings[key][1])))
+        for name, key in (("trips", "trips_per_card"), ("cases", "cases_per_customer"),
+                          ("tap_history", "taps_per_customer"))
+    }
+
     print("\nStarting data generation process...")
     db = get_db()
-    
+
     try:
         # Create tables if they don't exist
         Base.metadata.create_all(bind=engine)
-        
+        ensure_sample_keys(engine)
+        ensure_counters(engine)
+        ensure_search_index(engine)
+
         # Clear existing data
         clear_existing_data(db)
-        
+
         # Generate new data
-        print(f"\nGenerating {CONFIG['NUM_CUSTOMERS']} customers...")
-        customers = create_customers(CONFIG['NUM_CUSTOMERS'])
-        db.add_all(customers)
-        db.commit()
-        
-        print("Generating cards...")
-        cards = create_cards(customers)
-        db.add_all(cards)
-        db.commit()
-        
-        print("Generating trips...")
-        trips = create_trips(customers, cards)
-        db.add_all(trips)
-        db.commit()
-        
-        print("Generating cases...")
-        cases = create_cases(customers, cards)
-        db.add_all(cases)
-        db.commit()
-        
-        print("Generating tap history...")
-        tap_history = create_tap_history(customers, cards, trips)
-        db.add_all(tap_history)
-        db.commit()
-        
+        tasks = [
+            (index, first, min(first + chunk_size, customers + 1), settings)
+            for index, first in enumerate(range(1, customers + 1, chunk_size))
+        ]
+        print(f"\nGenerating {customers} customers in {len(tasks)} chunk(s) with {workers} worker(s)...")
+        counts = {name: 0 for name, _ in TABLES}
+        coverage = {"trips": 0, "cases": 0, "tap_history": 0}
+        started = time.perf_counter()
+        report_every = max(1, len(tasks) // 10)
+        for done, (chunk_counts, chunk_coverage) in enumerate(_run_chunks(tasks, workers), start=1):
+            for name, count in chunk_counts.items():
+                counts[name] += count
+            for name, count in chunk_coverage.items():
+                coverage[name] += count
+            if done % report_every == 0 or done == len(tasks):
+                print(f"  {done}/{len(tasks)} chunks, {counts['tap_history']} taps, {counts['trips']} trips")
+        elapsed = time.perf_counter() - started
+
         # Print statistics
-        print_statistics(customers, cards, trips, cases, tap_history)
-        
+        print_statistics(counts, coverage, elapsed)
+
+        rebuild_derived_data()
+        return counts
+
     except Exception as e:
         print(f"Error generating data: {e}")
         db.rollback()
+        # Don't leave a half-loaded database with stale counters, rollups and
+        # search documents behind: remove the partial data and rebuild
+        try:
+            clear_existing_data(db)
+            rebuild_derived_data()
+            print("Removed the partially generated data.")
+        except Exception as cleanup_error:
+            print(f"Cleanup after the failed run also failed: {cleanup_error}")
+        raise
     finally:
         db.close()
         print("\nData generation completed!")
 
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--customers", type=int, default=CONFIG['NUM_CUSTOMERS'])
+    parser.add_argument("--trips-per-card", default=CONFIG['TRIPS_PER_CARD'], type=parse_count_range,
+                        help="N or MIN-MAX")
+    parser.add_argument("--cases-per-customer", default=CONFIG['CASES_PER_CUSTOMER'], type=parse_count_range,
+                        help="N or MIN-MAX")
+    parser.add_argument("--taps-per-customer", default=CONFIG['TAPS_PER_CUSTOMER'], type=parse_count_range,
+                        help="N or MIN-MAX")
+    parser.add_argument("--workers", type=int, default=CONFIG['WORKERS'])
+    parser.add_argument("--seed", type=int, default=CONFIG['SEED'])
+    parser.add_argument("--chunk-size", type=int, default=CONFIG['CHUNK_SIZE'],
+                        help="Customers per transaction")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main(**vars(_parse_args()))
@@ -0,0 +1,148 @@
+import os
+import re
+import threading
+from sqlalchemy import text
+from database import engine
+from models import IdCounter, Customer, Trip, Case, TapHistory, User
+
+# Number of IDs leased from the database per round trip. Each worker process
+# hands out IDs from its leased block in memory, so the database is only hit
+# once every ID_BLOCK_SIZE creations.
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", "20"))
+
+# name -> (prefix, zero padding width, model the IDs belong to)
+ID_SEQUENCES = {
+    "customer": ("C", 3, Customer),
+    "trip": ("T", 3, Trip),
+    "case": ("CS", 3, Case),
+    "tap": ("TH", 6, TapHistory),
+    "user": ("U", 3, User),
+}
+
+
+class IdAllocator:
+    """Hands out prefixed string IDs (C001, CS001, TH000123, ...) without
+    counting table rows.
+
+    On PostgreSQL every sequence name maps to a database SEQUENCE whose
+    increment is the block size; on SQLite the `id_counters` table is bumped
+    by one block inside a write transaction. Either way a block is leased
+    atomically, so concurrent workers never hand out the same ID. On
+    PostgreSQL the block is as long as the sequence's own increment, which
+    may differ from this process's ID_BLOCK_SIZE if the sequence was
+    created under another setting.
+    """
+
+    def __init__(self, bind, block_size=ID_BLOCK_SIZE):
+        self.bind = bind
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._ranges = {}  # name -> [next_value, end_value_exclusive]
+
+    @property
+    def _is_postgres(self):
+        return self.bind.dialect.name == "postgresql"
+
+    def next_id(self, name):
+        """Return the next formatted ID for the given sequence name."""
+        prefix, width, _ = ID_SEQUENCES[name]
+        return f"{prefix}{str(self.next_value(name)).zfill(width)}"
+
+    def next_value(self, name):
+        with self._lock:
+            current = self._ranges.get(name)
+            if current is None or current[0] >= current[1]:
+                start, size = self._lease_block(name)
+                current = [start, start + size]
+                self._ranges[name] = current
+            value = current[0]
+            current[0] += 1
+            return value
+
+    def reset(self):
+        """Forget every leased block, e.g. after the schema has been reset."""
+        with self._lock:
+            self._ranges.clear()
+
+    def restart(self, names=None):
+        """Drop the stored counters of `names` (default: every sequence) and forget leased blocks.
+
+        The next lease re-seeds each sequence above the highest ID in its
+        table, e.g. after rows were bulk-loaded with IDs of their own.
+        """
+        names = list(ID_SEQUENCES) if names is None else list(names)
+        with self.bind.begin() as conn:
+            if self._is_postgres:
+                for name in names:
+                    conn.execute(text(f"DROP SEQUENCE IF EXISTS id_seq_{name}"))
+            else:
+                counters = IdCounter.__table__
+                conn.execute(counters.delete().where(counters.c.name.in_(names)))
+        self.reset()
+
+    def _lease_block(self, name):
+        """Lease a block of values; returns (first value, block length)."""
+        with self.bind.begin() as conn:
+            if self._is_postgres:
+                return self._lease_block_postgres(conn, name)
+            return self._lease_block_counter_table(conn, name)
+
+    def _lease_block_postgres(self, conn, name):
+        sequence = f"id_seq_{name}"
+        exists = conn.execute(text("SELECT to_regclass(:seq)"), {"seq": sequence}).scalar()
+        if exists is None:
+            start = self._highest_existing_value(conn, name) + 1
+            conn.execute(text(
+                f"CREATE SEQUENCE IF NOT EXISTS {sequence} "
+                f"START WITH {start} INCREMENT BY {self.block_size}"
+            ))
+        # Every nextval() is one increment past the last one, so the increment
+        # stored with the sequence, not ID_BLOCK_SIZE, is the block we own
+        return tuple(conn.execute(
+            text("SELECT nextval(:seq), (SELECT seqincrement FROM pg_sequence WHERE seqrelid = to_regclass(:seq))"),
+            {"seq": sequence},
+        ).one())
+
+    def _lease_block_counter_table(self, conn, name):
+        counters = IdCounter.__table__
+        # The UPDATE takes SQLite's write lock before we read the new value,
+        # so two processes can never lease the same block.
+        updated = conn.execute(
+            counters.update()
+            .where(counters.c.name == name)
+            .values(next_value=counters.c.next_value + self.block_size)
+        ).rowcount
+        if not updated:
+            start = self._highest_existing_value(conn, name) + 1
+            conn.execute(counters.insert().values(name=name, next_value=start + self.block_size))
+            return start, self.block_size
+        # Each lease moves the counter by its own block size, so leases taken
+        # with different ID_BLOCK_SIZE settings still never overlap
+        end = conn.execute(
+            counters.select().with_only_columns(counters.c.next_value).where(counters.c.name == name)
+        ).scalar()
+        return end - self.block_size, self.block_size
+
+    def _highest_existing_value(self, conn, name):
+        """Seed a new counter above the IDs already in the table.
+
+        This runs once per sequence (the first time it is used against a
+        database) so IDs created before the allocator existed are not reused.
+        """
+        prefix, _, model = ID_SEQUENCES[name]
+        pattern = re.compile(rf"^{re.escape(prefix)}(\d+)$")
+        highest = 0
+        rows = conn.execute(
+            model.__table__.select()
+            .with_only_columns(model.__table__.c.id)
+            .where(model.__table__.c.id.like(f"{prefix}%"))
+        )
+        for (row_id,) in rows:
+            match = pattern.match(row_id)
+            if match:
+                highest = max(highest, int(match.group(1)))
+        return highest
+
+
+# Shared allocator used by every creation path
+id_allocator = IdAllocator(engine)
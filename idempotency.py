@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import re
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.concurrency import run_in_threadpool
+from cache import make_backend, CACHE_BACKEND
+
+# Where completed responses are kept: memory (per process), redis (shared by
+# every worker, recommended when running more than one) or none (disabled)
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", CACHE_BACKEND)
+# How long a key replays its response, and how many keys the memory store keeps
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "100000"))
+# A key stays reserved this long while its first request runs; it is freed
+# sooner when that request finishes or fails, so this only matters if a worker dies
+IDEMPOTENCY_LOCK_SECONDS = float(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+# POS/robot writes that honour Idempotency-Key
+IDEMPOTENT_ROUTES = [re.compile(pattern) for pattern in (
+    r"^/api/cards/issue$",
+    r"^/api/cards/[^/]+/reload$",
+    r"^/api/cards/[^/]+/products$",
+    r"^/api/crm/cards/sync$",
+    r"^/api/crm/customers/[^/]+/register$",
+)]
+
+idempotency_store = make_backend(IDEMPOTENCY_BACKEND, IDEMPOTENCY_MAX_KEYS, prefix="crm:idempotency:")
+
+# Set while an idempotent request runs; flipped once any of its transactions commits
+_write_committed = ContextVar("idempotency_write_committed", default=None)
+
+
+@event.listens_for(Engine, "commit")
+def _mark_committed(conn):
+    # Fires for ORM and Core commits alike; the context is copied into the
+    # threadpool running sync routes, so the flag is the request's own
+    committed = _write_committed.get()
+    if committed is not None:
+        committed["value"] = True
+
+
+def _fingerprint(method, path, body):
+    return hashlib.sha256(method.encode() + b" " + path.encode() + b"\n" + body).hexdigest()
+
+
+def _is_success(status, body):
+    if status != 200:
+        return False
+    try:
+        return json.loads(body).get("status") == "success"
+    except (ValueError, AttributeError):
+        return False
+
+
+def _should_store(committed, status, body):
+    """Keep any response given after the request committed a write, whatever it
+    says, so a retry can't apply the write twice. A response with nothing
+    committed may be retried, unless it was a success anyway.
+    """
+    return committed or _is_success(status, body)
+
+
+async def _call(func, *args):
+    # Redis calls block, so keep them off the event loop
+    if idempotency_store.name == "redis":
+        return await run_in_threadpool(func, *args)
+    return func(*args)
+
+
+class IdempotencyMiddleware:
+    """ASGI middleware that replays the stored response of a repeated Idempotency-Key.
+
+    The first request with a key reserves it, runs normally and, if it
+    committed a write or succeeded, stores its status and body for
+    IDEMPOTENCY_TTL_SECONDS. A retry
+    with the same key and payload gets that response back (with the original
+    transactionId) without reaching the route or the database. The same key
+    with a different payload is rejected with 422, and a retry that arrives
+    while the first request is still running gets 409.
+    """
+
+    def __init__(self, app, store=None):
+        self.app = app
+        self.store = store or idempotency_store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self.app(scope, receive, send)
+        key = dict(scope["headers"]).get(IDEMPOTENCY_HEADER.lower().encode())
+        path = scope.get("path", "")
+        if key is None or not any(route.match(path) for route in IDEMPOTENT_ROUTES):
+            return await self.app(scope, receive, send)
+        key = key.decode("latin-1")
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return await self._respond(send, 400, {"detail": f"{IDEMPOTENCY_HEADER} must be 1-{MAX_KEY_LENGTH} characters"})
+
+        body = await self._read_body(receive)
+        fingerprint = _fingerprint(scope["method"], path, body)
+        stored_key = f"idempotency:{key}"
+        pending = {"state": "pending", "fingerprint": fingerprint}
+        if not await _call(self.store.add, stored_key, pending, IDEMPOTENCY_LOCK_SECONDS):
+            stored = await _call(self.store.get, stored_key)
+            if stored is not None:
+                if stored["fingerprint"] != fingerprint:
+                    return await self._respond(send, 422, {
+                        "detail": f"{IDEMPOTENCY_HEADER} was already used with a different request"
+                    })
+                if stored["state"] == "pending":
+                    return await self._respond(send, 409, {
+                        "detail": f"A request with this {IDEMPOTENCY_HEADER} is still being processed"
+                    })
+                return await self._replay(send, stored)
+            # Expired between the two calls; fall through and run it
+            await _call(self.store.set, stored_key, pending, IDEMPOTENCY_LOCK_SECONDS)
+
+        response = {"status": 500, "headers": [], "body": []}
+        body_sent = False
+
+        async def replay_body():
+            nonlocal body_sent
+            if body_sent:
+                return {"type": "http.disconnect"}
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+            await send(message)
+
+        committed = {"value": False}
+        token = _write_committed.set(committed)
+        try:
+            await self.app(scope, replay_body, capture)
+        except BaseException:
+            # Once something was written the key stays reserved until the lock
+            # expires, so a retry can't write it again
+            if not committed["value"]:
+                await _call(self.store.delete, stored_key)
+            raise
+        finally:
+            _write_committed.reset(token)
+        content = b"".join(response["body"])
+        if _should_store(committed["value"], response["status"], content):
+            content_type = dict(response["headers"]).get(b"content-type", b"application/json").decode("latin-1")
+            await _call(self.store.set, stored_key, {
+                "state": "done",
+                "fingerprint": fingerprint,
+                "status": response["status"],
+                "content_type": content_type,
+                "body": content.decode("utf-8"),
+            }, IDEMPOTENCY_TTL_SECONDS)
+        else:
+            await _call(self.store.delete, stored_key)
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    @staticmethod
+    async def _replay(send, stored):
+        body = stored["body"].encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": stored["status"],
+            "headers": [
+                (b"content-type", stored["content_type"].encode("latin-1")),
+                (b"content-length", str(len(body)).encode()),
+                (REPLAYED_HEADER.lower().encode(), b"true"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    @staticmethod
+    async def _respond(send, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,144 @@
+from sqlalchemy import select, inspect
+from database import Base, engine
+from models import Customer, Card, Trip, Case, TapHistory, FareDispute, User, CardTransaction, CardBalanceSnapshot
+from cache import card_with_customer_statement
+from case_queries import _agent_queue_statement
+from customer_overview import SECTIONS, OVERVIEW_SECTION_LIMIT
+import search
+
+# Representative query shape for each router read path. Keep this list in
+# step with the endpoints in api.py / routers/ so new filters and sorts get
+# checked against the declared indexes. Where a module builds its statement
+# in a function, the shape comes from that function; a callable value is
+# called with the dialect name for statements that differ per dialect.
+QUERY_SHAPES = {
+    "get_card": select(Card).where(Card.id == "sample"),
+    "get_crm_card_status": card_with_customer_statement("sample"),
+    "get_crm_customer_status": select(Customer.id, Card.id)
+        .select_from(Customer)
+        .outerjoin(Card, Card.customer_id == Customer.id)
+        .where(Customer.id == "sample"),
+    "get_card_transactions.trips": select(Card.balance, Trip.id)
+        .select_from(Card)
+        .outerjoin(Trip, Trip.card_id == Card.id)
+        .where(Card.id == "sample")
+        .order_by(Trip.start_time.desc()),
+    "ledger_tail.snapshot": select(CardBalanceSnapshot)
+        .where(CardBalanceSnapshot.card_id == "sample")
+        .order_by(CardBalanceSnapshot.sequence.desc())
+        .limit(1),
+    "ledger_tail.entries": select(CardTransaction)
+        .where(CardTransaction.card_id == "sample", CardTransaction.sequence > 0)
+        .order_by(CardTransaction.sequence),
+    "get_card_transactions.taps": select(TapHistory)
+        .where(TapHistory.customer_id == "sample")
+        .order_by(TapHistory.tap_time.desc()),
+    "get_tap_history": select(TapHistory).where(TapHistory.customer_id == "sample").limit(100),
+    "get_cases": select(Case).order_by(Case.created_date.desc()).limit(100),
+    "get_cases.by_status": select(Case).where(Case.case_status == "sample")
+        .order_by(Case.created_date.desc()).limit(100),
+    "get_case_queue.agent": _agent_queue_statement("sample", 10),
+    "get_random_card": select(Card).where(Card.sample_key >= 0.5).order_by(Card.sample_key).limit(10),
+    "get_random_card.by_status": select(Card).where(Card.status == "sample", Card.sample_key >= 0.5)
+        .order_by(Card.sample_key).limit(10),
+    "get_random_card.wrap": select(Card).where(Card.sample_key < 0.5).order_by(Card.sample_key).limit(10),
+    "search": lambda dialect_name: (
+        search._postgresql_statement(["sample"], None, 20) if dialect_name == "postgresql"
+        else search._sqlite_statement([["sample"]], None, 20)
+    ),
+    "fare_disputes.by_card": select(FareDispute).where(FareDispute.card_id == "sample"),
+    "fare_disputes.by_trip": select(FareDispute).where(FareDispute.trip_id == "sample"),
+    "create_customer.duplicate_check": select(Customer).where(Customer.email == "sample"),
+    "login": select(User).where(User.email == "sample"),
+}
+# Customer overview sections, first page of each in its keyset order
+for _name, _section in SECTIONS.items():
+    QUERY_SHAPES[f"customer_overview.{_name}"] = (
+        select(*_section.fields.values())
+        .where(_section.criteria("sample"))
+        .order_by(*[
+            column.desc() if _section.descending else column
+            for column in (_section.sort_column, _section.id_column) if column is not None
+        ])
+        .limit(OVERVIEW_SECTION_LIMIT)
+    )
+
+
+def ensure_indexes(bind=engine):
+    """Create indexes declared on the models that are missing from an existing database.
+
+    `create_all` only creates indexes together with new tables, so databases
+    created before an index was declared never receive it otherwise.
+    """
+    inspector = inspect(bind)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=bind)
+                created.append(index.name)
+    return created
+
+
+def explain(stmt, bind=engine):
+    """Return the query plan lines for a statement on the current database."""
+    sql = str(stmt.compile(dialect=bind.dialect, compile_kwargs={"literal_binds": True}))
+    with bind.connect() as conn:
+        if bind.dialect.name == "sqlite":
+            return [row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")]
+        return [row[0] for row in conn.exec_driver_sql(f"EXPLAIN {sql}")]
+
+
+def find_problems(plan, dialect_name):
+    """Pick out full-table scans and sorts that no index satisfies."""
+    problems = []
+    for line in plan:
+        detail = line.strip()
+        if dialect_name == "sqlite":
+            # Scans of subquery results (anon_N) and FTS5 index lookups
+            # (VIRTUAL TABLE INDEX) read no table row by row
+            if (detail.startswith("SCAN ") and "USING" not in detail and "VIRTUAL TABLE INDEX" not in detail
+                    and not detail.split()[1].startswith(("anon_", "("))):
+                problems.append(detail)
+            elif "USE TEMP B-TREE" in detail:
+                problems.append(detail)
+        elif "Seq Scan" in detail:
+            problems.append(detail)
+    return problems
+
+
+def run_advisor(bind=engine):
+    """EXPLAIN every registered query shape and report sequential scans.
+
+    On PostgreSQL the planner picks a Seq Scan for small tables even when an
+    index exists, so results are only meaningful on a realistically sized
+    database.
+    """
+    report = []
+    for name, stmt in QUERY_SHAPES.items():
+        try:
+            if callable(stmt):
+                stmt = stmt(bind.dialect.name)
+            plan = explain(stmt, bind)
+        except Exception as e:
+            report.append({"query": name, "ok": False, "error": str(e)})
+            continue
+        problems = find_problems(plan, bind.dialect.name)
+        report.append({"query": name, "ok": not problems, "problems": problems, "plan": plan})
+    return report
+
+
+def print_report(report):
+    flagged = [entry for entry in report if not entry["ok"]]
+    if not flagged:
+        print(f"Index advisor: all {len(report)} query shapes use an index")
+        return
+    for entry in flagged:
+        print(f"Index advisor: {entry['query']}: {entry.get('problems') or entry.get('error')}")
+
+
+if __name__ == "__main__":
+    print_report(run_advisor())
@@ -1,11 +1,53 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, FileResponse
+from starlette.concurrency import run_in_threadpool
 from api import router
-from database import Base, engine
+from database import Base, engine, USE_ASYNC_DB, async_engine
 from routers import auth
+from tap_ingest import tap_ingestor, TAP_INGEST_MODE
+from pagination import NEXT_CURSOR_HEADER, PREV_CURSOR_HEADER
+from query_logging import QueryLogContextMiddleware, query_logging_enabled
+from index_advisor import ensure_indexes, run_advisor, print_report
+from transaction_ledger import ensure_month_partitions
+from dashboard_counters import ensure_counters, counter_reconciler
+from analytics import ensure_rollups, rollup_refresher
+from search import ensure_search_index
+from card_sampling import ensure_sample_keys
+from idempotency import IdempotencyMiddleware, REPLAYED_HEADER
+from request_metrics import RequestMetricsMiddleware, metrics_enabled, registry as metrics_registry
+from profiling import (
+    ProfilingMiddleware, ProfilingDisabled, ProfileNotFound, PROFILE_ID_HEADER, PROFILE_SAMPLE_INTERVAL_MS,
+    profiling_enabled, check_token, profile_store, process_sampler,
+)
+from typing import Optional
 import models
+import os
+
+INDEX_ADVISOR_ON_STARTUP = os.getenv("INDEX_ADVISOR_ON_STARTUP", "false").lower() == "true"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if TAP_INGEST_MODE == "batched":
+        tap_ingestor.start()
+    if INDEX_ADVISOR_ON_STARTUP:
+        print_report(await run_in_threadpool(run_advisor))
+    counter_reconciler.start()
+    rollup_refresher.start()
+    yield
+    await run_in_threadpool(counter_reconciler.stop)
+    await run_in_threadpool(rollup_refresher.stop)
+    # Flush any queued taps before the process exits
+    await run_in_threadpool(tap_ingestor.stop)
+    if async_engine is not None:
+        await async_engine.dispose()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Replays the stored response of POS/robot writes retried with the same
+# Idempotency-Key (added before CORS so its responses get the CORS headers)
+app.add_middleware(IdempotencyMiddleware)
 
 # Add CORS middleware
 app.add_middleware(
@@ -14,10 +56,41 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, PREV_CURSOR_HEADER, REPLAYED_HEADER, PROFILE_ID_HEADER],
 )
 
+# Per-request sampling decision for the structured query log
+if query_logging_enabled():
+    app.add_middleware(QueryLogContextMiddleware)
+
+# On-demand profiles of single requests (X-Profile + X-Profile-Token headers)
+if profiling_enabled():
+    app.add_middleware(ProfilingMiddleware)
+
+# Per-route latency, DB time and statement counts for /admin/metrics. Added
+# last so it is outermost and times every other middleware too.
+if metrics_enabled():
+    app.add_middleware(RequestMetricsMiddleware)
+
 # Create tables
 Base.metadata.create_all(bind=engine)
+# Random sampling keys for cards created before the column existed
+ensure_sample_keys(engine)
+# Add indexes declared after an existing database was created
+ensure_indexes(engine)
+# Monthly ledger partitions (PostgreSQL with LEDGER_PARTITION_BY_MONTH=true only)
+ensure_month_partitions(engine)
+# Dashboard counters, seeded from a full scan the first time
+ensure_counters(engine)
+# Full-text search index, filled from the existing rows the first time
+ensure_search_index(engine)
+# Ridership rollups, so /analytics/ridership has data before the first scheduled refresh
+ensure_rollups(engine)
+
+# Async hot-path endpoints shadow their sync versions in api.py when enabled
+if USE_ASYNC_DB:
+    from routers import async_api
+    app.include_router(async_api.router)
 
 # Include the API router
 app.include_router(router)
@@ -26,6 +99,51 @@ app.include_router(router)
 app.include_router(auth.router, prefix="/auth", tags=["auth"])
 
 # --- Admin endpoints for DB management ---
+@app.get("/admin/tap-ingest")
+def get_tap_ingest_stats():
+    return {"status": "success", **tap_ingestor.stats()}
+
+@app.get("/admin/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Per-route request metrics in Prometheus text format"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+def require_profiling_token(x_profile_token: Optional[str] = Header(None)):
+    try:
+        check_token(x_profile_token)
+    except ProfilingDisabled as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
+@app.get("/admin/profile", dependencies=[Depends(require_profiling_token)])
+def list_profiles():
+    """Saved request and process profiles, newest first"""
+    return {"status": "success", "running_session": process_sampler.running, "profiles": profile_store.list()}
+
+@app.post("/admin/profile/sample", dependencies=[Depends(require_profiling_token)])
+def start_process_profile(seconds: float = 10, interval_ms: float = PROFILE_SAMPLE_INTERVAL_MS):
+    """Sample every thread of this worker for `seconds`; download the result from /admin/profile/{id}"""
+    try:
+        profile_id = process_sampler.start(seconds, interval_ms)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "success", "id": profile_id, "seconds": seconds, "download": f"/admin/profile/{profile_id}"}
+
+@app.get("/admin/profile/{profile_id}", dependencies=[Depends(require_profiling_token)])
+def download_profile(profile_id: str):
+    """A saved profile: pstats for cprofile, collapsed stacks (flamegraph input) for sample"""
+    try:
+        path, metadata = profile_store.path(profile_id)
+    except ProfileNotFound:
+        if profile_id == process_sampler.running:
+            raise HTTPException(status_code=409, detail="Sampling session is still running")
+        raise HTTPException(status_code=404, detail="Profile not found")
+    media_type = "text/plain" if metadata["mode"] == "sample" else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=metadata["file"])
+
 @app.get("/admin/db-info")
 def get_db_info():
     try:
@@ -39,6 +157,58 @@ def get_db_info():
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+@app.get("/admin/db-pool")
+def get_db_pool_stats():
+    """Connection pool checkout/wait statistics for sizing DB_POOL_SIZE"""
+    try:
+        from engine_config import pool_stats, sqlite_pragmas
+        return {
+            "status": "success",
+            "pool": pool_stats.snapshot(engine.pool),
+            "sqlite_pragmas": sqlite_pragmas(engine)
+        }
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+@app.get("/admin/cache")
+def get_cache_stats():
+    """Hit/miss counters for the Card/Customer lookup cache"""
+    from cache import entity_cache
+    return {"status": "success", **entity_cache.snapshot()}
+
+@app.get("/admin/dashboard-counters")
+def get_dashboard_counters():
+    """Last reconciliation report for the /reports/summary counters"""
+    from dashboard_counters import counter_reconciler
+    return {"status": "success", "last_report": counter_reconciler.last_result}
+
+@app.post("/admin/dashboard-counters/reconcile")
+def reconcile_dashboard_counters(repair: bool = True):
+    """Recompute the dashboard totals from scratch and report (and by default repair) drift"""
+    try:
+        from dashboard_counters import counter_reconciler
+        return {"status": "success", **counter_reconciler.run_once(repair)}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+@app.post("/admin/analytics/refresh")
+def refresh_analytics(rebuild: bool = False):
+    """Fold new trips and taps into the ridership rollups now (rebuild=true starts over)"""
+    try:
+        from analytics import rollup_refresher
+        return {"status": "success", **rollup_refresher.run_once(rebuild=rebuild)}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+@app.post("/admin/search/rebuild")
+def rebuild_search():
+    """Recreate the search documents from the customer, card and case tables"""
+    try:
+        from search import rebuild_search_index
+        return {"status": "success", "documents": rebuild_search_index(engine)}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
 @app.get("/admin/db-test")
 def test_db_connection():
     try:
@@ -55,6 +225,19 @@ def test_db_connection():
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+@app.get("/admin/index-advisor")
+def get_index_advice():
+    """EXPLAIN the hot query shapes and report sequential scans"""
+    try:
+        report = run_advisor()
+        return {
+            "status": "success",
+            "flagged": [entry["query"] for entry in report if not entry["ok"]],
+            "queries": report
+        }
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
 @app.get("/admin/schema-info")
 def get_schema_info():
     try:
@@ -88,11 +271,28 @@ def get_schema_info():
         return {"status": "error", "message": str(e)}
 
 @app.post("/admin/generate-data")
-def generate_data():
+def generate_data(
+    customers: int = Query(None, ge=1, description="Customers to generate (one card each)"),
+    trips_per_card: str = Query(None, description="N or MIN-MAX"),
+    cases_per_customer: str = Query(None, description="N or MIN-MAX"),
+    taps_per_customer: str = Query(None, description="N or MIN-MAX"),
+    workers: int = Query(None, ge=1, description="Worker processes"),
+    seed: int = Query(None),
+    chunk_size: int = Query(None, ge=1, description="Customers per transaction"),
+):
+    from generate_data import main as generate_main, parse_count_range
+    try:
+        for value in (trips_per_card, cases_per_customer, taps_per_customer):
+            if value is not None:
+                parse_count_range(value)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     try:
-        from generate_data import main as generate_main
-        generate_main()
-        return {"status": "success", "message": "Data generated"}
+        counts = generate_main(
+            customers=customers, trips_per_card=trips_per_card, cases_per_customer=cases_per_customer,
+            taps_per_customer=taps_per_customer, workers=workers, seed=seed, chunk_size=chunk_size,
+        )
+        return {"status": "success", "message": "Data generated", "counts": counts}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -103,6 +303,14 @@ def reset_database():
         print("Resetting database schema...")
         Base.metadata.drop_all(bind=engine)
         Base.metadata.create_all(bind=engine)
+        ensure_month_partitions(engine)
+        ensure_counters(engine)
+        ensure_search_index(engine)
+        ensure_rollups(engine)
+        from id_allocator import id_allocator
+        from cache import entity_cache
+        id_allocator.reset()
+        entity_cache.clear()
         return {"status": "success", "message": "Database schema reset successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,8 +1,13 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, text, UniqueConstraint, Text
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, text, UniqueConstraint, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
+import os
+import random
+
+# Range-partition card_transactions by month on PostgreSQL (see transaction_ledger.py)
+LEDGER_PARTITION_BY_MONTH = os.getenv("LEDGER_PARTITION_BY_MONTH", "false").lower() == "true"
 
 class Customer(Base):
     __tablename__ = "customers"
@@ -20,23 +25,35 @@ class Customer(Base):
 
 class Card(Base):
     __tablename__ = "cards"
+    __table_args__ = (
+        # /cards/random?status=: a range of sample keys within one status
+        Index("ix_cards_status_sample_key", "status", "sample_key"),
+    )
 
     id = Column(String, primary_key=True)
     type = Column(String, nullable=False)
     status = Column(String, nullable=False)
     balance = Column(Float, nullable=False)
     issue_date = Column(DateTime, nullable=False, default=datetime.now)
-    customer_id = Column(String, ForeignKey("customers.id", ondelete="CASCADE"), nullable=False)
+    customer_id = Column(String, ForeignKey("customers.id", ondelete="CASCADE"), nullable=False, index=True)
+    # Uniform random key for constant-time sampling (see card_sampling.py)
+    sample_key = Column(Float, nullable=True, default=random.random, index=True)
     
     # Relationships
     customer = relationship("Customer", back_populates="cards")
     trips = relationship("Trip", back_populates="card", cascade="all, delete-orphan")
+    transactions = relationship("CardTransaction", cascade="all, delete-orphan")
+    balance_snapshots = relationship("CardBalanceSnapshot", cascade="all, delete-orphan")
 
 class Trip(Base):
     __tablename__ = "trips"
+    __table_args__ = (
+        # get_card_transactions: WHERE card_id = ? ORDER BY start_time DESC
+        Index("ix_trips_card_id_start_time", "card_id", "start_time"),
+    )
 
     id = Column(String, primary_key=True)  # Trip ID
-    start_time = Column(DateTime, nullable=False)
+    start_time = Column(DateTime, nullable=False, index=True)
     end_time = Column(DateTime, nullable=False)
     entry_location = Column(String, nullable=False)
     exit_location = Column(String, nullable=False)
@@ -52,9 +69,20 @@ class Trip(Base):
 
 class Case(Base):
     __tablename__ = "cases"
+    __table_args__ = (
+        # Customer overview: a customer's cases, newest first
+        Index("ix_cases_customer_id_created_date", "customer_id", "created_date"),
+        # /cases/ filtered on one column, newest first
+        Index("ix_cases_case_status_created_date", "case_status", "created_date"),
+        Index("ix_cases_priority_created_date", "priority", "created_date"),
+        Index("ix_cases_category_created_date", "category", "created_date"),
+        Index("ix_cases_assigned_agent_created_date", "assigned_agent", "created_date"),
+        # /cases/queue: covers every column the queue reads
+        Index("ix_cases_agent_queue", "case_status", "assigned_agent", "priority", "created_date", "id"),
+    )
 
     id = Column(String, primary_key=True)
-    created_date = Column(DateTime, nullable=False, default=datetime.now)
+    created_date = Column(DateTime, nullable=False, default=datetime.now, index=True)
     last_updated = Column(DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
     customer_id = Column(String, ForeignKey("customers.id", ondelete="CASCADE"), nullable=False)
     card_id = Column(String, ForeignKey("cards.id", ondelete="CASCADE"), nullable=True)
@@ -70,9 +98,13 @@ class Case(Base):
 
 class TapHistory(Base):
     __tablename__ = "tap_history"
+    __table_args__ = (
+        # Tap history per customer, newest first
+        Index("ix_tap_history_customer_id_tap_time", "customer_id", "tap_time"),
+    )
 
     id = Column(String, primary_key=True)
-    tap_time = Column(DateTime, nullable=False, default=datetime.now)
+    tap_time = Column(DateTime, nullable=False, default=datetime.now, index=True)
     location = Column(String, nullable=False)
     device_id = Column(String, nullable=False)  # Reader xxx, Kiosk xxx, Gate xxx, Validator xxx
     transit_mode = Column(String, nullable=False)
@@ -88,16 +120,102 @@ class FareDispute(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     dispute_date = Column(DateTime, nullable=False, default=datetime.now)
-    card_id = Column(String, ForeignKey("cards.id", ondelete="CASCADE"), nullable=False)
+    card_id = Column(String, ForeignKey("cards.id", ondelete="CASCADE"), nullable=False, index=True)
     amount = Column(Float, nullable=False)
     description = Column(Text, nullable=True)
-    trip_id = Column(String, ForeignKey("trips.id", ondelete="CASCADE"), nullable=False)
+    trip_id = Column(String, ForeignKey("trips.id", ondelete="CASCADE"), nullable=False, index=True)
     dispute_type = Column(String, nullable=False)
 
     # Relationships
     card = relationship("Card")
     trip = relationship("Trip")
 
+class CardTransaction(Base):
+    """Append-only record of every change to a card's balance"""
+    __tablename__ = "card_transactions"
+    __table_args__ = (
+        Index("ix_card_transactions_card_id_sequence", "card_id", "sequence"),
+        {"postgresql_partition_by": "RANGE (created_at)"} if LEDGER_PARTITION_BY_MONTH else {},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    card_id = Column(String, ForeignKey("cards.id", ondelete="CASCADE"), nullable=False)
+    sequence = Column(Integer, nullable=False)  # Per-card entry number, starting at 1
+    # Partitioned tables need the partition key in the primary key
+    created_at = Column(DateTime, nullable=False, default=datetime.now, primary_key=LEDGER_PARTITION_BY_MONTH)
+    kind = Column(String, nullable=False)  # opening, reload, product, payment, tap, sync, adjustment
+    amount = Column(Float, nullable=False)  # Credits positive, debits negative
+    reference = Column(String, nullable=True)  # Tap ID or POS transaction ID
+
+class CardBalanceSnapshot(Base):
+    """Materialised card balance after a given ledger entry"""
+    __tablename__ = "card_balance_snapshots"
+    __table_args__ = (
+        Index("ix_card_balance_snapshots_card_id_sequence", "card_id", "sequence"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    card_id = Column(String, ForeignKey("cards.id", ondelete="CASCADE"), nullable=False)
+    sequence = Column(Integer, nullable=False)  # Last ledger entry included in the balance
+    balance = Column(Float, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+
+class DashboardCounter(Base):
+    """Running totals behind /reports/summary, split into shards to spread write contention"""
+    __tablename__ = "dashboard_counters"
+
+    name = Column(String, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    value = Column(Float, nullable=False, default=0.0)
+
+class RidershipRollup(Base):
+    """Trips, taps and fare revenue per hour or day, station, route, operator and mode"""
+    __tablename__ = "ridership_rollups"
+    __table_args__ = (
+        Index("ix_ridership_rollups_granularity_bucket_start", "granularity", "bucket_start"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    granularity = Column(String, nullable=False)  # hour or day
+    bucket_start = Column(DateTime, nullable=False)
+    station = Column(String, nullable=False)  # Trip entry location or tap location
+    route = Column(String, nullable=False)  # Empty for taps
+    operator = Column(String, nullable=False)  # Empty for taps
+    transit_mode = Column(String, nullable=False)
+    trips = Column(Integer, nullable=False, default=0)
+    taps = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0.0)
+
+class RollupState(Base):
+    """High-water mark of the fact rows already folded into a rollup"""
+    __tablename__ = "rollup_state"
+
+    name = Column(String, primary_key=True)
+    high_water = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+
+class RollupDirtyBucket(Base):
+    """An hour whose rollup buckets must be recomputed because older facts changed"""
+    __tablename__ = "rollup_dirty_buckets"
+
+    # Append-only: concurrent writers marking the same hour never conflict
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    bucket_start = Column(DateTime, nullable=False)
+    marked_at = Column(DateTime, nullable=False, default=datetime.now)
+
+class SearchDocument(Base):
+    """Searchable text of one customer, card or case; full-text indexed by search.py"""
+    __tablename__ = "search_documents"
+    __table_args__ = (
+        Index("ix_search_documents_entity_entity_id", "entity", "entity_id", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    entity = Column(String, nullable=False)  # customer, card or case
+    entity_id = Column(String, nullable=False)
+    title = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+
 class User(Base):
     __tablename__ = "users"
     
@@ -107,3 +225,9 @@ class User(Base):
     name = Column(String)
     created_at = Column(DateTime)
     last_login = Column(DateTime, nullable=True) 
+
+class IdCounter(Base):
+    __tablename__ = "id_counters"
+
+    name = Column(String, primary_key=True)  # customer, trip, case, tap, user
+    next_value = Column(Integer, nullable=False)
@@ -0,0 +1,124 @@
+import base64
+import json
+import os
+from datetime import datetime
+from sqlalchemy import DateTime, and_, or_
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "500"))
+
+# Response headers carrying the opaque cursors for the neighbouring pages
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+PREV_CURSOR_HEADER = "X-Prev-Cursor"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values, direction, order):
+    """Opaque cursor for the row keyed by `values`; `order` names the sort it was issued under."""
+    payload = json.dumps({"v": values, "d": direction, "o": order}, default=lambda v: v.isoformat())
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, order):
+    """(values, direction) of a cursor; InvalidCursor unless it was issued for the same `order`."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        values, direction, cursor_order = payload["v"], payload["d"], payload["o"]
+    except (ValueError, KeyError, TypeError):
+        raise InvalidCursor("Invalid pagination cursor")
+    if direction not in ("next", "prev") or not isinstance(values, list):
+        raise InvalidCursor("Invalid pagination cursor")
+    if cursor_order != order:
+        raise InvalidCursor("Pagination cursor was issued for a different sort order")
+    return values, direction
+
+
+def sort_order(columns, descending):
+    """Cursor tag for an ordering, e.g. "cases.created_date,cases.id desc"."""
+    return ",".join(str(column) for column in columns) + (" desc" if descending else "")
+
+
+def clamp_limit(limit):
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+class KeysetPage:
+    """One page of a keyset-paginated query plus the cursors around it."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def apply_headers(self, response):
+        if self.next_cursor:
+            response.headers[NEXT_CURSOR_HEADER] = self.next_cursor
+        if self.prev_cursor:
+            response.headers[PREV_CURSOR_HEADER] = self.prev_cursor
+
+
+def paginate(query, id_column, limit=DEFAULT_PAGE_SIZE, cursor=None, skip=0, sort_column=None, descending=False):
+    """Page through `query` ordered by (sort_column, id_column).
+
+    With a cursor the page is found with a range predicate on the ordering
+    columns, so the cost stays constant however deep the page is. Without
+    one, `skip` is honoured as a plain OFFSET for older clients.
+    """
+    limit = clamp_limit(limit)
+    columns = [sort_column, id_column] if sort_column is not None else [id_column]
+    order = sort_order(columns, descending)
+
+    direction = "next"
+    if cursor:
+        values, direction = decode_cursor(cursor, order)
+        if len(values) != len(columns):
+            raise InvalidCursor("Invalid pagination cursor")
+        values = [_coerce(column, value) for column, value in zip(columns, values)]
+        # Walking backwards flips the comparison and the sort order
+        forward = (direction == "next") != descending
+        query = query.filter(_after(columns, values, forward))
+    reverse = direction == "prev"
+    ordering_desc = descending != reverse
+    query = query.order_by(*[column.desc() if ordering_desc else column.asc() for column in columns])
+    if not cursor and skip:
+        query = query.offset(skip)
+
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if reverse:
+        rows.reverse()
+
+    def key(row):
+        return [getattr(row, column.key) for column in columns]
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more if direction == "next" else bool(cursor):
+            next_cursor = encode_cursor(key(rows[-1]), "next", order)
+        if (bool(cursor) or skip > 0) if direction == "next" else has_more:
+            prev_cursor = encode_cursor(key(rows[0]), "prev", order)
+    return KeysetPage(rows, next_cursor, prev_cursor)
+
+
+def _after(columns, values, forward):
+    """Row-value comparison (a, b) > (x, y), spelled out for every backend."""
+    first, first_value = columns[0], values[0]
+    strictly = first > first_value if forward else first < first_value
+    if len(columns) == 1:
+        return strictly
+    rest = _after(columns[1:], values[1:], forward)
+    return or_(strictly, and_(first == first_value, rest))
+
+
+def _coerce(column, value):
+    if isinstance(column.type, DateTime) and isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            raise InvalidCursor("Invalid pagination cursor")
+    return value
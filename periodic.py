@@ -0,0 +1,42 @@
+import threading
+
+
+class PeriodicJob:
+    """Runs `func` on a daemon thread every `interval` seconds (0 disables it).
+
+    Errors are printed and the job keeps going; the last successful result is
+    kept on `last_result` for the admin endpoints.
+    """
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.last_result = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def run_once(self, *args, **kwargs):
+        self.last_result = self.func(*args, **kwargs)
+        return self.last_result
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"{self.name} failed: {e}")
@@ -0,0 +1,389 @@
+import cProfile
+import functools
+import hmac
+import inspect
+import itertools
+import json
+import os
+import pstats
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+
+# Shared secret for every profiling feature; profiling is off while it is empty
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+# Where captured profiles are written. Point every worker at the same
+# directory so a profile can be downloaded from whichever worker answers.
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "crm-profiles"))
+# Newest profiles kept on disk; older ones are deleted as new ones are saved
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+# Longest whole-process sampling session an admin can start
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+# Default time between stack samples
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+
+PROFILE_HEADER = "X-Profile"  # cprofile or sample
+PROFILE_QUERY_PARAM = "_profile"
+TOKEN_HEADER = "X-Profile-Token"
+PROFILE_ID_HEADER = "X-Profile-Id"
+PROFILE_MODES = ("cprofile", "sample")
+
+# Profile files are named <id>.<extension>; ids never contain path separators
+PROFILE_EXTENSIONS = {"cprofile": "pstats", "sample": "collapsed"}
+_PROFILE_ID = re.compile(r"^[0-9]{8}T[0-9]{6}-[0-9]+-[0-9]+$")
+
+# Profile of the request being handled, if it asked for one
+_session = ContextVar("request_profile", default=None)
+_sequence = itertools.count(1)
+# cProfile hooks are per thread and don't nest, so one profiled request at a time
+_request_slot = threading.Lock()
+
+
+class ProfilingDisabled(Exception):
+    pass
+
+
+class ProfileNotFound(Exception):
+    pass
+
+
+def profiling_enabled():
+    return bool(PROFILING_TOKEN)
+
+
+def check_token(token):
+    """Raise ProfilingDisabled without a token configured, PermissionError for a wrong one."""
+    if not profiling_enabled():
+        raise ProfilingDisabled("Profiling is disabled; set PROFILING_TOKEN to enable it")
+    if not token or not hmac.compare_digest(token.encode(), PROFILING_TOKEN.encode()):
+        raise PermissionError(f"Missing or invalid {TOKEN_HEADER}")
+
+
+def _new_profile_id():
+    return f"{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}-{next(_sequence)}"
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Background thread that counts the call stacks of other threads.
+
+    Stacks are kept in collapsed form ("root;caller;callee count" per line),
+    which flamegraph.pl, speedscope and inferno read directly. With
+    `thread_ids` only those threads are sampled; it may change while the
+    sampler runs.
+    """
+
+    def __init__(self, interval_ms=PROFILE_SAMPLE_INTERVAL_MS, thread_ids=None):
+        self.interval = max(interval_ms, 0.1) / 1000
+        self.thread_ids = thread_ids
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            wanted = self.thread_ids
+            for ident, frame in sys._current_frames().items():
+                # Leave out the profiler's own threads
+                if names.get(ident, "").startswith("profile-") or (wanted is not None and ident not in wanted):
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                labels.append(names.get(ident, f"thread-{ident}"))
+                self.stacks[";".join(reversed(labels))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class ProfileStore:
+    """Profile files and their metadata in PROFILE_DIR."""
+
+    def __init__(self, directory=PROFILE_DIR, keep=PROFILE_KEEP):
+        self.directory = directory
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def save(self, profile_id, mode, write, **metadata):
+        """Write one profile with `write(path)` and record its metadata; returns the metadata."""
+        os.makedirs(self.directory, exist_ok=True)
+        filename = f"{profile_id}.{PROFILE_EXTENSIONS[mode]}"
+        write(os.path.join(self.directory, filename))
+        metadata = {"id": profile_id, "mode": mode, "file": filename,
+                    "created": datetime.now().isoformat(timespec="seconds"), **metadata}
+        with open(os.path.join(self.directory, f"{profile_id}.json"), "w") as f:
+            json.dump(metadata, f)
+        self._prune()
+        return metadata
+
+    def list(self):
+        profiles = []
+        if not os.path.isdir(self.directory):
+            return profiles
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        profiles.append(json.load(f))
+                except (OSError, ValueError):
+                    continue  # Pruned or still being written by another worker
+        return sorted(profiles, key=lambda profile: profile["created"], reverse=True)
+
+    def path(self, profile_id):
+        """(path, metadata) of a saved profile; raises ProfileNotFound."""
+        if not _PROFILE_ID.match(profile_id):
+            raise ProfileNotFound(profile_id)
+        try:
+            with open(os.path.join(self.directory, f"{profile_id}.json")) as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            raise ProfileNotFound(profile_id)
+        path = os.path.join(self.directory, metadata["file"])
+        if not os.path.exists(path):
+            raise ProfileNotFound(profile_id)
+        return path, metadata
+
+    def _prune(self):
+        with self._lock:
+            for metadata in self.list()[self.keep:]:
+                for filename in (metadata["file"], f"{metadata['id']}.json"):
+                    try:
+                        os.remove(os.path.join(self.directory, filename))
+                    except OSError:
+                        pass
+
+
+profile_store = ProfileStore()
+
+
+class RequestProfile:
+    """Profile of one request across the event loop thread and the threadpool
+    threads running its sync endpoint.
+
+    cprofile runs a cProfile.Profile in each of those threads and merges them;
+    on the event loop thread it also sees whatever other requests the loop
+    ran meanwhile. sample runs a StackSampler restricted to those threads.
+    """
+
+    def __init__(self, mode, interval_ms=PROFILE_SAMPLE_INTERVAL_MS):
+        self.mode = mode
+        self.id = _new_profile_id()
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._thread_ids = set()
+        self._sampler = StackSampler(interval_ms, self._thread_ids) if mode == "sample" else None
+        self._main = None
+
+    def start(self):
+        self._main = self._enter()
+        if self._sampler is not None:
+            self._sampler.start()
+
+    def stop(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+        self._leave(self._main)
+
+    def _enter(self):
+        if self.mode == "cprofile":
+            profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+            profile.enable()
+            return profile
+        self._thread_ids.add(threading.get_ident())
+        return None
+
+    def _leave(self, profile):
+        if profile is not None:
+            profile.disable()
+        else:
+            self._thread_ids.discard(threading.get_ident())
+
+    def run_in_thread(self, func, *args, **kwargs):
+        profile = self._enter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._leave(profile)
+
+    def write(self, path):
+        if self.mode == "sample":
+            with open(path, "w") as f:
+                f.write(self._sampler.collapsed())
+            return
+        stats = pstats.Stats(self._profiles[0])
+        for profile in self._profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+
+def profiled(endpoint):
+    """Wrap a sync endpoint so a profiled request also covers the threadpool thread it runs on."""
+    if inspect.iscoroutinefunction(endpoint):
+        # Async endpoints run on the event loop thread, which the middleware already covers
+        return endpoint
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        session = _session.get()
+        if session is None:
+            return endpoint(*args, **kwargs)
+        return session.run_in_thread(endpoint, *args, **kwargs)
+
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    """APIRoute whose endpoint can be profiled per request (see ProfilingMiddleware)."""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, profiled(endpoint), **kwargs)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles single requests on demand.
+
+    A request with `X-Profile: cprofile|sample` (or `?_profile=...`) and a
+    matching `X-Profile-Token` header is profiled; the response carries an
+    X-Profile-Id header naming the file to fetch from /admin/profile/{id}.
+    A profile flag with a wrong token is rejected with 403.
+    """
+
+    def __init__(self, app, store=profile_store):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        mode = headers.get(PROFILE_HEADER.lower().encode(), b"").decode("latin-1") or _query_mode(scope)
+        if not mode:
+            return await self.app(scope, receive, send)
+        token = headers.get(TOKEN_HEADER.lower().encode(), b"").decode("latin-1")
+        try:
+            check_token(token)
+        except (ProfilingDisabled, PermissionError) as e:
+            return await _respond(send, 403, {"detail": str(e)})
+        if mode not in PROFILE_MODES:
+            return await _respond(send, 400, {"detail": f"{PROFILE_HEADER} must be one of: {', '.join(PROFILE_MODES)}"})
+        if not _request_slot.acquire(blocking=False):
+            return await _respond(send, 409, {"detail": "Another profiled request is still running; retry shortly"})
+
+        session = RequestProfile(mode)
+        status = {"code": 500}
+
+        async def tag(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message = {**message, "headers": list(message.get("headers", [])) + [
+                    (PROFILE_ID_HEADER.lower().encode(), session.id.encode()),
+                ]}
+            await send(message)
+
+        token = _session.set(session)
+        started = time.perf_counter()
+        session.start()
+        try:
+            await self.app(scope, receive, tag)
+        finally:
+            session.stop()
+            _session.reset(token)
+            _request_slot.release()
+            duration_ms = round((time.perf_counter() - started) * 1000, 3)
+            await run_in_threadpool(
+                self.store.save, session.id, mode, session.write,
+                kind="request", method=scope["method"], path=scope.get("path", ""),
+                status=status["code"], duration_ms=duration_ms,
+            )
+
+
+def _query_mode(scope):
+    for pair in scope.get("query_string", b"").decode("latin-1").split("&"):
+        name, _, value = pair.partition("=")
+        if name == PROFILE_QUERY_PARAM:
+            return value
+    return ""
+
+
+async def _respond(send, status, payload):
+    body = json.dumps(payload).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class ProcessSampler:
+    """One time-boxed, whole-process sampling session at a time per worker."""
+
+    def __init__(self, store=profile_store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._running = None
+
+    def start(self, seconds, interval_ms=PROFILE_SAMPLE_INTERVAL_MS):
+        """Sample every thread for `seconds` in the background; returns the profile id.
+
+        Raises ValueError for a bad duration and RuntimeError while a session runs.
+        """
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            raise ValueError(f"seconds must be between 0 and {PROFILE_MAX_SECONDS:g}")
+        with self._lock:
+            if self._running is not None:
+                raise RuntimeError(f"Sampling session {self._running} is still running")
+            profile_id = self._running = _new_profile_id()
+        sampler = StackSampler(interval_ms).start()
+
+        def finish():
+            time.sleep(seconds)
+            sampler.stop()
+            try:
+                self.store.save(
+                    profile_id, "sample", lambda path: _write_text(path, sampler.collapsed()),
+                    kind="process", pid=os.getpid(), seconds=seconds, samples=sampler.samples,
+                )
+            finally:
+                with self._lock:
+                    self._running = None
+
+        threading.Thread(target=finish, name="profile-session", daemon=True).start()
+        return profile_id
+
+    @property
+    def running(self):
+        return self._running
+
+
+def _write_text(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+process_sampler = ProcessSampler()
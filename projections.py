@@ -0,0 +1,68 @@
+from models import Card, Customer, Trip, TapHistory, CardTransaction, CardBalanceSnapshot
+
+# Response fields mapped to the columns they come from. Selecting these
+# labelled columns returns plain Row tuples, so the composite read endpoints
+# build their dicts without ORM instances or identity-map bookkeeping.
+
+TRIP_FIELDS = {
+    "trip_id": Trip.id,
+    "start_time": Trip.start_time,
+    "end_time": Trip.end_time,
+    "entry_location": Trip.entry_location,
+    "exit_location": Trip.exit_location,
+    "fare": Trip.fare,
+    "route": Trip.route,
+    "operator": Trip.operator,
+    "transit_mode": Trip.transit_mode,
+}
+
+TAP_FIELDS = {
+    "tap_id": TapHistory.id,
+    "tap_time": TapHistory.tap_time,
+    "location": TapHistory.location,
+    "device_id": TapHistory.device_id,
+    "transit_mode": TapHistory.transit_mode,
+    "direction": TapHistory.direction,
+    "result": TapHistory.result,
+}
+
+LEDGER_FIELDS = {
+    "sequence": CardTransaction.sequence,
+    "created_at": CardTransaction.created_at,
+    "kind": CardTransaction.kind,
+    "amount": CardTransaction.amount,
+    "reference": CardTransaction.reference,
+}
+
+SNAPSHOT_FIELDS = {
+    "sequence": CardBalanceSnapshot.sequence,
+    "balance": CardBalanceSnapshot.balance,
+    "created_at": CardBalanceSnapshot.created_at,
+}
+
+
+def labelled(fields, prefix=""):
+    """Columns of `fields` labelled with their response names, for select()."""
+    return [column.label(prefix + name) for name, column in fields.items()]
+
+
+def model_fields(model, exclude=()):
+    """Every mapped column of `model` not in `exclude`, keyed by attribute name."""
+    return {
+        column.key: getattr(model, column.key) for column in model.__table__.columns if column.key not in exclude
+    }
+
+
+# sample_key only serves /cards/random (card_sampling.py) and stays internal
+CARD_FIELDS = model_fields(Card, exclude=("sample_key",))
+CUSTOMER_FIELDS = model_fields(Customer)
+
+
+def project(row, fields, prefix=""):
+    """Dict of `fields` taken from a Row selected with labelled(fields, prefix)."""
+    mapping = row._mapping
+    return {name: mapping[prefix + name] for name in fields}
+
+
+def project_all(rows, fields, prefix=""):
+    return [project(row, fields, prefix) for row in rows]
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import random
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from sqlalchemy import event
+
+# Fraction of requests whose every statement is logged (0 disables sampling)
+QUERY_LOG_SAMPLE_RATE = float(os.getenv("QUERY_LOG_SAMPLE_RATE", "0"))
+# Per-route overrides as "path_prefix=rate" pairs, e.g. "/simulate/cardTap=0.001,/reports=1"
+QUERY_LOG_ROUTE_RATES = os.getenv("QUERY_LOG_ROUTE_RATES", "")
+# Statements slower than this are always logged (0 disables)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))
+
+logger = logging.getLogger("crm.query")
+
+_route = ContextVar("query_log_route", default=None)
+_sampled = ContextVar("query_log_sampled", default=False)
+
+
+def parse_route_rates(spec):
+    rates = {}
+    for pair in spec.split(","):
+        if "=" not in pair:
+            continue
+        prefix, rate = pair.split("=", 1)
+        rates[prefix.strip()] = float(rate)
+    # Longest prefix wins
+    return sorted(rates.items(), key=lambda item: len(item[0]), reverse=True)
+
+
+ROUTE_RATES = parse_route_rates(QUERY_LOG_ROUTE_RATES)
+
+
+def query_logging_enabled():
+    return QUERY_LOG_SAMPLE_RATE > 0 or SLOW_QUERY_MS > 0 or any(rate > 0 for _, rate in ROUTE_RATES)
+
+
+def sample_rate_for(path):
+    for prefix, rate in ROUTE_RATES:
+        if path.startswith(prefix):
+            return rate
+    return QUERY_LOG_SAMPLE_RATE
+
+
+def redact(parameters):
+    """Keep the shape of bound parameters but replace every value with its type name."""
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            # executemany: report the first row's shape and the row count
+            return {"rows": len(parameters), "first": redact(parameters[0])}
+        return [type(value).__name__ for value in parameters]
+    return None
+
+
+class QueryLogContextMiddleware:
+    """ASGI middleware that decides once per request whether its queries are sampled."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope.get("path", "")
+        route_token = _route.set(path)
+        sampled_token = _sampled.set(random.random() < sample_rate_for(path))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _route.reset(route_token)
+            _sampled.reset(sampled_token)
+
+
+def install_query_logging(engine):
+    """Hook structured query logging onto an engine's cursor events.
+
+    Nothing is attached when sampling and the slow-query threshold are both
+    off, so the request path pays no cost by default.
+    """
+    if not query_logging_enabled():
+        return False
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_log_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_log_start"].pop()
+        duration_ms = (time.perf_counter() - started) * 1000
+        slow = SLOW_QUERY_MS > 0 and duration_ms >= SLOW_QUERY_MS
+        if not (slow or _sampled.get()):
+            return
+        logger.info(json.dumps({
+            "ts": datetime.now().isoformat(),
+            "event": "slow_query" if slow else "query",
+            "route": _route.get(),
+            "duration_ms": round(duration_ms, 3),
+            "statement": " ".join(statement.split()),
+            "params": redact(parameters),
+            "executemany": executemany,
+            "rowcount": cursor.rowcount,
+        }))
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        # A failed statement never reaches after_cursor_execute
+        conn = exception_context.connection
+        if exception_context.execution_context is not None and conn is not None and conn.info.get("query_log_start"):
+            conn.info["query_log_start"].pop()
+
+    return True
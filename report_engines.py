@@ -0,0 +1,317 @@
+import math
+import os
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import select, func, case, cast, type_coerce, Integer, String
+from database import engine
+from models import TapHistory, Trip
+
+# Default engine for /reports/taps and /reports/fares: "sql" (GROUP BY in the
+# database) or "numpy" (columns streamed into arrays and aggregated here)
+REPORT_ENGINE = os.getenv("REPORT_ENGINE", "sql")
+REPORT_CHUNK_SIZE = int(os.getenv("REPORT_CHUNK_SIZE", "100000"))
+# How long the NumPy engine reuses its in-memory column snapshot
+REPORT_SNAPSHOT_TTL_SECONDS = float(os.getenv("REPORT_SNAPSHOT_TTL_SECONDS", "60"))
+REPORT_ENGINES = ("sql", "numpy")
+# Fare histogram limits: fares are in cents, and the response lists every non-empty bin
+MIN_FARE_BIN_WIDTH = 0.01
+MAX_FARE_BINS = int(os.getenv("REPORT_MAX_FARE_BINS", "10000"))
+
+TAP_DIMENSIONS = {
+    "location": TapHistory.location,
+    "transit_mode": TapHistory.transit_mode,
+    "direction": TapHistory.direction,
+    "result": TapHistory.result,
+    "device_id": TapHistory.device_id,
+}
+FARE_DIMENSIONS = {
+    "operator": Trip.operator,
+    "route": Trip.route,
+    "transit_mode": Trip.transit_mode,
+    "entry_location": Trip.entry_location,
+}
+# Tap results that count as a successful tap (generated data and /simulate/cardTap)
+SUCCESS_RESULTS = ("Success", "Tap Successful")
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("REPORT_ENGINE=numpy requires the 'numpy' package")
+    return numpy
+
+
+def _check(dimension, dimensions, engine_name):
+    if dimension not in dimensions:
+        raise ValueError(f"group_by must be one of: {', '.join(dimensions)}")
+    if engine_name not in REPORT_ENGINES:
+        raise ValueError(f"engine must be one of: {', '.join(REPORT_ENGINES)}")
+
+
+def _time_range(query, column, start, end):
+    if start is not None:
+        query = query.where(column >= start)
+    if end is not None:
+        query = query.where(column < end)
+    return query
+
+
+# Both engines build their results with these helpers so the output is identical
+
+def _tap_result(dimension, engine_name, groups):
+    """`groups` is an iterable of (value, taps, successful)."""
+    rows = [
+        {"value": value, "taps": int(taps), "successful": int(successful),
+         "success_rate": round(successful / taps, 4) if taps else 0.0}
+        for value, taps, successful in sorted(groups, key=lambda group: group[0])
+        if taps
+    ]
+    taps = sum(row["taps"] for row in rows)
+    successful = sum(row["successful"] for row in rows)
+    return {
+        "group_by": dimension,
+        "engine": engine_name,
+        "rows": rows,
+        "totals": {"taps": taps, "successful": successful,
+                   "success_rate": round(successful / taps, 4) if taps else 0.0},
+    }
+
+
+def _fare_result(dimension, engine_name, groups, bins, bin_width):
+    """`groups` is an iterable of (value, trips, fare_total); `bins` of (bin_index, trips)."""
+    bins = [(index, count) for index, count in bins if count]
+    if len(bins) > MAX_FARE_BINS:
+        raise ValueError(f"bin_width {bin_width} gives {len(bins)} fare bins, more than {MAX_FARE_BINS}; use a wider bin")
+    rows = [
+        {"value": value, "trips": int(trips), "fare_total": round(float(total), 2),
+         "fare_average": round(float(total) / trips, 2) if trips else 0.0}
+        for value, trips, total in sorted(groups, key=lambda group: group[0])
+        if trips
+    ]
+    trips = sum(row["trips"] for row in rows)
+    total = sum(float(group_total) for _, _, group_total in groups)
+    return {
+        "group_by": dimension,
+        "engine": engine_name,
+        "rows": rows,
+        "totals": {"trips": trips, "fare_total": round(total, 2),
+                   "fare_average": round(total / trips, 2) if trips else 0.0},
+        "histogram": {
+            "bin_width": bin_width,
+            "bins": [
+                {"from": round(index * bin_width, 2), "to": round((index + 1) * bin_width, 2), "trips": int(count)}
+                for index, count in sorted(bins)
+            ],
+        },
+    }
+
+
+def _fare_bin(bind, bin_width):
+    if bind.dialect.name == "postgresql":
+        return cast(func.floor(Trip.fare / bin_width), Integer)
+    # SQLite has no floor() in older builds; CAST truncates, which is the same for fares >= 0
+    return cast(Trip.fare / bin_width, Integer)
+
+
+def sql_tap_report(dimension, start=None, end=None, bind=engine):
+    column = TAP_DIMENSIONS[dimension]
+    query = select(
+        column,
+        func.count(),
+        func.sum(case((TapHistory.result.in_(SUCCESS_RESULTS), 1), else_=0)),
+    ).group_by(column)
+    with bind.connect() as conn:
+        groups = conn.execute(_time_range(query, TapHistory.tap_time, start, end)).all()
+    return _tap_result(dimension, "sql", [(value, taps, successful or 0) for value, taps, successful in groups])
+
+
+def sql_fare_report(dimension, start=None, end=None, bin_width=1.0, bind=engine):
+    column = FARE_DIMENSIONS[dimension]
+    fare_bin = _fare_bin(bind, bin_width)
+    groups_query = _time_range(
+        select(column, func.count(), func.sum(Trip.fare)).group_by(column), Trip.start_time, start, end
+    )
+    bins_query = _time_range(
+        select(fare_bin, func.count()).where(Trip.fare >= 0).group_by(fare_bin), Trip.start_time, start, end
+    )
+    with bind.connect() as conn:
+        groups = conn.execute(groups_query).all()
+        bins = conn.execute(bins_query).all()
+    return _fare_result(dimension, "sql", [tuple(group) for group in groups], [tuple(b) for b in bins], bin_width)
+
+
+class _Codes(dict):
+    def __missing__(self, value):
+        code = self[value] = len(self)
+        return code
+
+
+class DictionaryEncoder:
+    """Maps the strings of a low-cardinality column to dense integer codes."""
+
+    def __init__(self):
+        self.codes = _Codes()
+
+    @property
+    def values(self):
+        return list(self.codes)
+
+    def encode(self, np, column):
+        return np.fromiter(map(self.codes.__getitem__, column), dtype=np.int32, count=len(column))
+
+
+def _chunks(bind, query, chunk_size):
+    with bind.connect() as conn:
+        result = conn.execution_options(yield_per=chunk_size).execute(query)
+        for partition in result.partitions():
+            yield list(zip(*partition))
+
+
+def _naive(value):
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+
+def _as_datetime64(np, values):
+    if values and isinstance(values[0], datetime) and values[0].tzinfo is not None:
+        values = [_naive(value) for value in values]
+    return np.array(values, dtype="datetime64[us]")
+
+
+class ColumnSnapshot:
+    """Immutable set of column arrays plus the dictionaries for the encoded ones."""
+
+    __slots__ = ("arrays", "dictionaries", "rows")
+
+    def __init__(self, arrays, dictionaries):
+        self.arrays = arrays
+        self.dictionaries = dictionaries
+        self.rows = len(arrays["time"])
+
+    def select(self, np, start, end):
+        """Row mask for [start, end), or None for every row."""
+        mask = None
+        times = self.arrays["time"]
+        if start is not None:
+            mask = times >= np.datetime64(_naive(start), "us")
+        if end is not None:
+            before = times < np.datetime64(_naive(end), "us")
+            mask = before if mask is None else mask & before
+        return mask
+
+
+class ColumnarTable:
+    """In-memory, dictionary-encoded copy of the report columns of one table.
+
+    Loaded `chunk_size` rows at a time and reloaded once it is older than
+    `ttl` seconds, so NumPy reports can lag the database by up to `ttl`.
+    Fetching rows out of SQLite costs more than SQLite's own GROUP BY, so the
+    win comes from answering every report from the same loaded arrays.
+    """
+
+    def __init__(self, time_column, string_columns, number_columns=None, ttl=REPORT_SNAPSHOT_TTL_SECONDS):
+        self.time_column = time_column
+        self.string_columns = string_columns
+        self.number_columns = number_columns or {}
+        self.ttl = ttl
+        self.loaded_at = None
+        self.snapshot = None
+        self._lock = threading.Lock()
+
+    def load(self, bind=engine, chunk_size=REPORT_CHUNK_SIZE):
+        np = _numpy()
+        names = list(self.string_columns) + list(self.number_columns)
+        time_column = self.time_column
+        if bind.dialect.name == "sqlite":
+            # Let NumPy parse SQLite's ISO text instead of building datetime objects
+            time_column = type_coerce(time_column, String)
+        query = select(time_column, *self.string_columns.values(), *self.number_columns.values())
+        encoders = {name: DictionaryEncoder() for name in self.string_columns}
+        parts = {name: [] for name in ["time"] + names}
+        for times, *columns in _chunks(bind, query, chunk_size):
+            parts["time"].append(_as_datetime64(np, times))
+            for name, values in zip(names, columns):
+                if name in encoders:
+                    parts[name].append(encoders[name].encode(np, values))
+                else:
+                    parts[name].append(np.asarray(values, dtype=np.float64))
+        empty = {"time": np.zeros(0, dtype="datetime64[us]")}
+        arrays = {
+            name: np.concatenate(chunks) if chunks else empty.get(name, np.zeros(0, dtype=np.int32))
+            for name, chunks in parts.items()
+        }
+        self.snapshot = ColumnSnapshot(arrays, {name: encoder.values for name, encoder in encoders.items()})
+        self.loaded_at = time.monotonic()
+        return self.snapshot
+
+    def fresh(self, bind=engine):
+        """Current snapshot, reloaded first if it is missing or expired."""
+        with self._lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+                self.load(bind)
+            return self.snapshot
+
+
+tap_columns = ColumnarTable(TapHistory.tap_time, TAP_DIMENSIONS)
+trip_columns = ColumnarTable(Trip.start_time, FARE_DIMENSIONS, {"fare": Trip.fare})
+
+
+def numpy_tap_report(dimension, start=None, end=None, table=None):
+    """Same result as sql_tap_report, aggregated with NumPy bincounts over a tap_columns snapshot."""
+    np = _numpy()
+    table = table or tap_columns.fresh()
+    codes = table.arrays[dimension]
+    results = table.arrays["result"]
+    mask = table.select(np, start, end)
+    if mask is not None:
+        codes = codes[mask]
+        results = results[mask]
+    # Success lookup table indexed by result code
+    is_success = np.array([value in SUCCESS_RESULTS for value in table.dictionaries["result"]], dtype=bool)
+    values = table.dictionaries[dimension]
+    taps = np.bincount(codes, minlength=len(values))
+    successful = np.bincount(codes[is_success[results]] if len(is_success) else codes[:0], minlength=len(values))
+    return _tap_result(dimension, "numpy", [
+        (value, taps[code], successful[code]) for code, value in enumerate(values)
+    ])
+
+
+def numpy_fare_report(dimension, start=None, end=None, bin_width=1.0, table=None):
+    """Same result as sql_fare_report: fare sums per group and a fare histogram."""
+    np = _numpy()
+    table = table or trip_columns.fresh()
+    codes = table.arrays[dimension]
+    fares = table.arrays["fare"]
+    mask = table.select(np, start, end)
+    if mask is not None:
+        codes = codes[mask]
+        fares = fares[mask]
+    values = table.dictionaries[dimension]
+    trips = np.bincount(codes, minlength=len(values))
+    totals = np.bincount(codes, weights=fares, minlength=len(values))
+    # Only the non-empty bins, like the SQL GROUP BY; a dense bincount would
+    # allocate max_fare / bin_width slots
+    bins, counts = np.unique((fares[fares >= 0] / bin_width).astype(np.int64), return_counts=True)
+    return _fare_result(
+        dimension, "numpy",
+        [(value, trips[code], totals[code]) for code, value in enumerate(values)],
+        list(zip(bins.tolist(), counts.tolist())),
+        bin_width,
+    )
+
+
+def tap_report(dimension, start=None, end=None, engine_name=REPORT_ENGINE):
+    _check(dimension, TAP_DIMENSIONS, engine_name)
+    report = numpy_tap_report if engine_name == "numpy" else sql_tap_report
+    return report(dimension, start, end)
+
+
+def fare_report(dimension, start=None, end=None, bin_width=1.0, engine_name=REPORT_ENGINE):
+    _check(dimension, FARE_DIMENSIONS, engine_name)
+    if not math.isfinite(bin_width) or bin_width < MIN_FARE_BIN_WIDTH:
+        raise ValueError(f"bin_width must be at least {MIN_FARE_BIN_WIDTH}")
+    report = numpy_fare_report if engine_name == "numpy" else sql_fare_report
+    return report(dimension, start, end, bin_width)
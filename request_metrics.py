@@ -0,0 +1,266 @@
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+
+# Fraction of requests measured (0 disables the middleware and the engine
+# hooks entirely, 1 measures every request). Counts in /admin/metrics are of
+# measured requests only; scale by the sample rate to estimate totals.
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "0"))
+# Add a Server-Timing header (app and db time) to measured responses
+METRICS_SERVER_TIMING = os.getenv("METRICS_SERVER_TIMING", "true").lower() == "true"
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Requests that match no route share one label so bad URLs can't add series
+UNMATCHED_ROUTE = "unmatched"
+
+# Per-request totals for the request being measured; None when it is not
+_current = ContextVar("request_metrics", default=None)
+
+
+def metrics_enabled():
+    return METRICS_SAMPLE_RATE > 0
+
+
+class RequestStats:
+    """What one measured request spent in the database."""
+
+    __slots__ = ("db_seconds", "statements", "rows", "_lock")
+
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        # Customer overview sections run their statements on several threads at once
+        self._lock = threading.Lock()
+
+    def add(self, seconds, rows):
+        with self._lock:
+            self.db_seconds += seconds
+            self.statements += 1
+            self.rows += rows
+
+    def add_rows(self, rows):
+        with self._lock:
+            self.rows += rows
+
+
+class CountingCursor:
+    """DBAPI cursor proxy that adds every row fetched through it to a RequestStats.
+
+    cursor.rowcount is -1 for SELECTs on SQLite (and the rows a query returns
+    are not known until they are fetched anyway), so reads are counted as the
+    result is consumed.
+    """
+
+    __slots__ = ("_cursor", "_stats")
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.add_rows(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._stats.add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats.add_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class RouteMetrics:
+    """Running totals for one (method, route, status) series."""
+
+    __slots__ = ("buckets", "count", "seconds", "db_seconds", "statements", "rows", "response_bytes")
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.db_seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.response_bytes = 0
+
+
+class MetricsRegistry:
+    """Per-route request metrics of this process, rendered in Prometheus text format.
+
+    Every worker process keeps its own registry; Prometheus sums the series
+    across the scraped instances.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def observe(self, method, route, status, seconds, stats, response_bytes):
+        key = (method, route, str(status))
+        with self._lock:
+            metrics = self._routes.get(key)
+            if metrics is None:
+                metrics = self._routes[key] = RouteMetrics()
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    metrics.buckets[i] += 1
+            metrics.count += 1
+            metrics.seconds += seconds
+            metrics.db_seconds += stats.db_seconds
+            metrics.statements += stats.statements
+            metrics.rows += stats.rows
+            metrics.response_bytes += response_bytes
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+    def render(self):
+        with self._lock:
+            routes = sorted(self._routes.items())
+            snapshots = [(key, list(m.buckets), m.count, m.seconds, m.db_seconds, m.statements, m.rows,
+                          m.response_bytes) for key, m in routes]
+        lines = [
+            "# HELP crm_metrics_sample_rate Fraction of requests measured.",
+            "# TYPE crm_metrics_sample_rate gauge",
+            f"crm_metrics_sample_rate {METRICS_SAMPLE_RATE}",
+            "# HELP crm_http_request_duration_seconds Time until the response finished, per route.",
+            "# TYPE crm_http_request_duration_seconds histogram",
+        ]
+        for key, buckets, count, seconds, *_ in snapshots:
+            labels = _labels(*key)
+            for bound, value in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f'crm_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {value}')
+            lines.append(f'crm_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"crm_http_request_duration_seconds_sum{{{labels}}} {seconds}")
+            lines.append(f"crm_http_request_duration_seconds_count{{{labels}}} {count}")
+        totals = (
+            ("crm_http_request_db_seconds_total", "Time spent executing SQL statements.", 4),
+            ("crm_http_request_db_statements_total", "SQL statements executed.", 5),
+            ("crm_http_request_db_rows_total", "Rows fetched by queries plus rows affected by writes.", 6),
+            ("crm_http_response_bytes_total", "Response body bytes sent.", 7),
+        )
+        for name, help_text, field in totals:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for snapshot in snapshots:
+                lines.append(f"{name}{{{_labels(*snapshot[0])}}} {snapshot[field]}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(method, route, status):
+    return f'method="{_escape(method)}",route="{_escape(route)}",status="{status}"'
+
+
+registry = MetricsRegistry()
+
+
+def _server_timing(app_seconds, stats):
+    return (
+        f"app;dur={app_seconds * 1000:.1f}, "
+        f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.statements} statements, {stats.rows} rows"'
+    )
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware that measures a sample of requests into `registry`.
+
+    A measured request gets a RequestStats in a ContextVar, which the engine
+    hooks from install_request_metrics() add to as statements run (the
+    context is copied into the threadpool running sync routes). Latency runs
+    until the last body chunk is sent, so streamed exports count in full.
+    """
+
+    def __init__(self, app, registry=registry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or random.random() >= METRICS_SAMPLE_RATE:
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        response = {"status": 500, "bytes": 0}
+
+        async def measure(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                if METRICS_SERVER_TIMING:
+                    headers = list(message.get("headers", []))
+                    timing = _server_timing(time.perf_counter() - started, stats)
+                    headers.append((b"server-timing", timing.encode("latin-1")))
+                    message = {**message, "headers": headers}
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, measure)
+        finally:
+            _current.reset(token)
+            route = scope.get("route")
+            self.registry.observe(
+                scope["method"], getattr(route, "path", UNMATCHED_ROUTE), response["status"],
+                time.perf_counter() - started, stats, response["bytes"],
+            )
+
+
+def install_request_metrics(engine):
+    """Hook per-request DB time, statement and row counts onto an engine.
+
+    Nothing is attached while METRICS_SAMPLE_RATE is 0; when it is on,
+    statements outside a measured request only pay for one ContextVar read.
+    """
+    if not metrics_enabled():
+        return False
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            conn.info.setdefault("request_metrics_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = _current.get()
+        if stats is None or not conn.info.get("request_metrics_start"):
+            return
+        seconds = time.perf_counter() - conn.info["request_metrics_start"].pop()
+        if cursor.description is None:
+            # No result rows: count the rows the write affected
+            stats.add(seconds, max(cursor.rowcount, 0))
+            return
+        stats.add(seconds, 0)
+        # The result is built from context.cursor right after this hook, so
+        # its rows are counted as they are fetched, however far it is consumed
+        if context is not None:
+            context.cursor = CountingCursor(cursor, stats)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        # A failed statement never reaches after_cursor_execute
+        conn = exception_context.connection
+        if _current.get() is not None and conn is not None and conn.info.get("request_metrics_start"):
+            _current.get().add(time.perf_counter() - conn.info["request_metrics_start"].pop(), 0)
+
+    return True
@@ -0,0 +1,267 @@
+from fastapi import APIRouter, HTTPException, Depends
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from datetime import datetime
+import uuid
+
+from database import get_async_db
+from models import Customer, Card, TapHistory
+from id_allocator import id_allocator
+from cache import entity_cache, card_to_dict, card_with_customer_statement
+from balance_ledger import credit_async, debit_async, InsufficientBalance, BalanceChange
+from tap_ingest import TAP_INGEST_MODE, MIN_FARE
+from api import (
+    verify_api_key, StandardResponse, IssueCardRequest, ReloadRequest, CardTapRequest, submit_tap
+)
+
+# Async versions of the hot endpoints in api.py. main.py mounts this router
+# ahead of api.router when USE_ASYNC_DB=true, so these handlers take over the
+# same paths while the sync ones stay available behind the setting.
+router = APIRouter()
+
+async def get_card_by_id(db: AsyncSession, card_id: str):
+    result = await db.execute(select(Card).where(Card.id == card_id))
+    return result.scalar_one_or_none()
+
+async def cache_call(func, *args):
+    """Call an entity_cache method without blocking the event loop.
+
+    The in-process backends are called directly; the Redis client does
+    blocking network I/O, so its calls run in the threadpool.
+    """
+    if entity_cache.backend.name == "redis":
+        return await run_in_threadpool(func, *args)
+    return func(*args)
+
+async def get_cached(db: AsyncSession, model, kind: str, entity_id: str, to_dict):
+    """Read-through lookup in the shared entity cache for async handlers"""
+    value = await cache_call(entity_cache.peek, kind, entity_id)
+    if value is None:
+        instance = await db.get(model, entity_id)
+        if instance is None:
+            return None
+        value = to_dict(instance)
+        await cache_call(entity_cache.put, kind, entity_id, value)
+    return value
+
+@router.get("/cards/{card_id}/balance")
+async def get_card_balance(card_id: str, db: AsyncSession = Depends(get_async_db)):
+    """Get card balance"""
+    card = await get_cached(db, Card, "card", card_id, card_to_dict)
+    if not card:
+        raise HTTPException(status_code=404, detail="Card not found")
+    return {
+        "card_id": card["id"],
+        "balance": card["balance"],
+        "status": card["status"],
+        "type": card["type"]
+    }
+
+@router.post("/simulate/cardTap")
+async def simulate_card_tap(req: CardTapRequest, db: AsyncSession = Depends(get_async_db)):
+    """Simulate a card tap event"""
+    if TAP_INGEST_MODE == "batched":
+        return await submit_tap(req)
+
+    # The allocator only touches the database once per leased block; lease
+    # before the balance UPDATE takes the write lock
+    tap_id = await run_in_threadpool(id_allocator.next_id, "tap")
+
+    try:
+        change = await debit_async(db, req.card_id, MIN_FARE, kind="tap", reference=tap_id)
+        result = "Tap Successful"
+    except InsufficientBalance as e:
+        change = BalanceChange(req.card_id, e.balance, e.customer_id)
+        result = "Insufficient Balance"
+    if change is None:
+        raise HTTPException(status_code=404, detail="Card not found")
+
+    tap_entry = TapHistory(
+        id=tap_id,
+        tap_time=datetime.now(),
+        location=req.location,
+        device_id=req.device_id,
+        transit_mode=req.transit_mode,
+        direction=req.direction,
+        customer_id=change.customer_id,
+        result=result
+    )
+    db.add(tap_entry)
+    await db.commit()
+    await cache_call(entity_cache.invalidate_card, req.card_id)
+
+    return {
+        "tap_id": tap_entry.id,
+        "card_id": req.card_id,
+        "result": result,
+        "location": req.location,
+        "transit_mode": req.transit_mode,
+        "direction": req.direction,
+        "remaining_balance": change.balance,
+        "tap_time": tap_entry.tap_time.isoformat()
+    }
+
+@router.get("/api/crm/cards/{card_id}", response_model=StandardResponse)
+async def get_crm_card_status(card_id: str, db: AsyncSession = Depends(get_async_db)):
+    """Get card status from CRM for POS/Robot"""
+    transaction_id = str(uuid.uuid4())
+    timestamp = datetime.now()
+
+    try:
+        # Card and customer from the cache, or together in one joined query
+        found = await cache_call(entity_cache.peek_card_with_customer, card_id)
+        if found is None:
+            row = (await db.execute(card_with_customer_statement(card_id))).first()
+            if row is not None:
+                found = await cache_call(entity_cache.put_card_with_customer, row)
+        if not found:
+            return StandardResponse(
+                status="error",
+                timestamp=timestamp,
+                transactionId=transaction_id,
+                message="Card not found",
+                data={"card_id": card_id}
+            )
+        card, customer = found
+
+        return StandardResponse(
+            status="success",
+            timestamp=timestamp,
+            transactionId=transaction_id,
+            message="Card status retrieved successfully",
+            data={
+                "card_id": card["id"],
+                "balance": card["balance"],
+                "status": card["status"],
+                "type": card["type"],
+                "issue_date": card["issue_date"].isoformat(),
+                "customer_id": card["customer_id"],
+                "customer_name": customer["name"] if customer else None
+            }
+        )
+
+    except Exception as e:
+        return StandardResponse(
+            status="error",
+            timestamp=timestamp,
+            transactionId=transaction_id,
+            message=f"Failed to get card status: {str(e)}",
+            data={"card_id": card_id}
+        )
+
+@router.post("/api/cards/issue", response_model=StandardResponse)
+async def issue_card_api(card_data: IssueCardRequest, db: AsyncSession = Depends(get_async_db), api_key: str = Depends(verify_api_key)):
+    """Issue a new transit card - POS API endpoint"""
+    transaction_id = str(uuid.uuid4())
+    timestamp = datetime.now()
+
+    try:
+        customer = await db.get(Customer, card_data.customer_id)
+        if not customer:
+            return StandardResponse(
+                status="error",
+                timestamp=timestamp,
+                transactionId=transaction_id,
+                message="Customer not found",
+                data={"customer_id": card_data.customer_id}
+            )
+
+        if await get_card_by_id(db, card_data.card_id):
+            return StandardResponse(
+                status="error",
+                timestamp=timestamp,
+                transactionId=transaction_id,
+                message="Card ID already exists",
+                data={"card_id": card_data.card_id}
+            )
+
+        db_card = Card(
+            id=card_data.card_id,
+            type=card_data.card_type,
+            status="Active",
+            balance=card_data.balance,
+            customer_id=card_data.customer_id,
+            issue_date=datetime.fromisoformat(card_data.issue_date.replace('Z', '+00:00'))
+        )
+        db.add(db_card)
+        await db.commit()
+
+        return StandardResponse(
+            status="success",
+            timestamp=timestamp,
+            transactionId=transaction_id,
+            message=f"Card {card_data.card_id} issued successfully",
+            data={
+                "card_id": db_card.id,
+                "type": db_card.type,
+                "status": db_card.status,
+                "balance": db_card.balance,
+                "customer_id": db_card.customer_id,
+                "customer_name": customer.name
+            }
+        )
+
+    except Exception as e:
+        await db.rollback()
+        return StandardResponse(
+            status="error",
+            timestamp=timestamp,
+            transactionId=transaction_id,
+            message=f"Card issuance failed: {str(e)}",
+            data={"card_id": card_data.card_id}
+        )
+
+@router.post("/api/cards/{card_id}/reload", response_model=StandardResponse)
+async def reload_card_api(card_id: str, req: ReloadRequest, db: AsyncSession = Depends(get_async_db), api_key: str = Depends(verify_api_key)):
+    """Reload funds onto a card - POS API endpoint"""
+    transaction_id = str(uuid.uuid4())
+    timestamp = datetime.now()
+
+    try:
+        if req.amount > 0:
+            change = await credit_async(db, card_id, req.amount, kind="reload", reference=transaction_id)
+        else:
+            change = await get_card_by_id(db, card_id)
+        if change is None:
+            return StandardResponse(
+                status="error",
+                timestamp=timestamp,
+                transactionId=transaction_id,
+                message="Card not found",
+                data={"card_id": card_id}
+            )
+
+        if req.amount <= 0:
+            return StandardResponse(
+                status="error",
+                timestamp=timestamp,
+                transactionId=transaction_id,
+                message="Amount must be positive",
+                data={"card_id": card_id, "amount": req.amount}
+            )
+
+        await db.commit()
+        await cache_call(entity_cache.invalidate_card, card_id)
+
+        return StandardResponse(
+            status="success",
+            timestamp=timestamp,
+            transactionId=transaction_id,
+            message=f"Card {card_id} reloaded with ${req.amount}",
+            data={
+                "card_id": card_id,
+                "amount_reloaded": req.amount,
+                "new_balance": change.balance,
+                "previous_balance": change.balance - req.amount
+            }
+        )
+
+    except Exception as e:
+        return StandardResponse(
+            status="error",
+            timestamp=timestamp,
+            transactionId=transaction_id,
+            message=f"Reload failed: {str(e)}",
+            data={"card_id": card_id}
+        )
@@ -8,6 +8,7 @@ from typing import Optional
 
 from database import SessionLocal
 from models import User
+from id_allocator import id_allocator
 
 router = APIRouter()
 
@@ -62,7 +63,7 @@ def signup(user: UserCreate, db: Session = Depends(get_db)):
     # Create new user
     hashed_password = hash_password(user.password)
     db_user = User(
-        id=f"U{str(len(db.query(User).all()) + 1).zfill(3)}",
+        id=id_allocator.next_id("user"),
         email=user.email,
         password=hashed_password,
         name=user.name,
@@ -0,0 +1,322 @@
+import os
+import re
+from collections import defaultdict
+from sqlalchemy import (
+    event, select, insert, delete, and_, or_, func, literal, literal_column, table, column, text, bindparam,
+)
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
+from models import SearchDocument, Customer, Card, Case
+from pagination import encode_cursor, decode_cursor, clamp_limit, InvalidCursor
+
+# Shortest term the trigram indexes can look up
+MIN_TERM_LENGTH = 3
+# SQLite bm25 column weights (entity, title, body): title hits outrank body-only
+# hits, and the entity column used by the type filter doesn't count
+BM25_WEIGHTS = (0.0, 10.0, 1.0)
+# Cursor tag for the (score desc, id) result order, so list cursors are rejected here
+SEARCH_ORDER = "search.score desc,search.id"
+# SQLite typo fallback: vocabulary words compared per misspelt term, and how
+# similar (padded-trigram Jaccard, as in pg_trgm) a correction must be
+SEARCH_FUZZY_CANDIDATES = int(os.getenv("SEARCH_FUZZY_CANDIDATES", "2000"))
+SEARCH_FUZZY_MIN_SIMILARITY = float(os.getenv("SEARCH_FUZZY_MIN_SIMILARITY", "0.3"))
+SEARCH_FUZZY_SUGGESTIONS = 3
+
+# Text each entity contributes: (model, title, body, attributes that feed them)
+SOURCES = {
+    "customer": (Customer, Customer.name, Customer.email + " " + Customer.phone + " " + Customer.id,
+                 ("name", "email", "phone")),
+    "card": (Card, Card.id, Card.type + " " + Card.status + " " + Card.customer_id,
+             ("type", "status", "customer_id")),
+    "case": (Case, Case.category + " " + Case.id,
+             Case.assigned_agent + " " + Case.case_status + " " + func.coalesce(Case.notes, ""),
+             ("category", "assigned_agent", "case_status", "notes")),
+}
+ENTITIES = {model: name for name, (model, _, _, _) in SOURCES.items()}
+
+_documents = SearchDocument.__table__
+# SQLite only: FTS5 index over search_documents (external content, trigram
+# tokenizer), plus the vocabulary of title words used to correct typos
+_fts = table("search_fts", column("search_fts"), column("rowid"), column("entity"), column("title"), column("body"))
+_words = table("search_words", column("id"), column("word"))
+_words_fts = table("search_words_fts", column("search_words_fts"), column("rowid"), column("word"))
+
+TERM = re.compile(r"\w[\w@.+-]*")
+VOCABULARY_WORD = re.compile(r"[^\W\d_]{3,}")
+
+
+def _source_rows(entity, ids=None):
+    model, title, body, _ = SOURCES[entity]
+    query = select(literal(entity), model.id, title, body)
+    if ids is not None:
+        query = query.where(model.id.in_(ids))
+    return query
+
+
+def _matching(entity, ids):
+    return and_(_documents.c.entity == entity, _documents.c.entity_id.in_(ids))
+
+
+def _add_words(conn, titles):
+    words = {word for title in titles for word in VOCABULARY_WORD.findall(title.lower())}
+    if not words:
+        return
+    known = set(conn.execute(select(_words.c.word).where(_words.c.word.in_(words))).scalars())
+    new = sorted(words - known)
+    if new:
+        conn.execute(insert(_words), [{"word": word} for word in new])
+        conn.execute(insert(_words_fts).from_select(
+            ["rowid", "word"], select(_words.c.id, _words.c.word).where(_words.c.word.in_(new))
+        ))
+
+
+def _remove(conn, entity, ids):
+    if conn.dialect.name == "sqlite":
+        # External-content FTS5 deletes need the old text to find the index entries
+        conn.execute(insert(_fts).from_select(
+            ["search_fts", "rowid", "entity", "title", "body"],
+            select(literal("delete"), _documents.c.id, _documents.c.entity, _documents.c.title, _documents.c.body)
+            .where(_matching(entity, ids)),
+        ))
+    conn.execute(delete(_documents).where(_matching(entity, ids)))
+
+
+def _add(conn, entity, ids):
+    conn.execute(insert(_documents).from_select(["entity", "entity_id", "title", "body"], _source_rows(entity, ids)))
+    if conn.dialect.name == "sqlite":
+        conn.execute(insert(_fts).from_select(
+            ["rowid", "entity", "title", "body"],
+            select(_documents.c.id, _documents.c.entity, _documents.c.title, _documents.c.body)
+            .where(_matching(entity, ids)),
+        ))
+        # Words are never removed; a stale one only suggests a term with no hits
+        _add_words(conn, conn.execute(select(_documents.c.title).where(_matching(entity, ids))).scalars())
+
+
+def reindex(conn, entity, ids):
+    """Refresh the documents of these rows; ids that no longer exist drop out."""
+    ids = list(ids)
+    if ids:
+        _remove(conn, entity, ids)
+        _add(conn, entity, ids)
+
+
+def rebuild_search_index(bind):
+    """Recreate every document (and on SQLite the vocabulary) from the customer, card and case tables."""
+    counts = {}
+    with bind.begin() as conn:
+        conn.execute(delete(_documents))
+        for entity in SOURCES:
+            counts[entity] = conn.execute(
+                insert(_documents).from_select(["entity", "entity_id", "title", "body"], _source_rows(entity))
+            ).rowcount
+        if conn.dialect.name == "sqlite":
+            conn.execute(insert(_fts).values(search_fts="rebuild"))
+            words = set()
+            for title in conn.execute(select(_documents.c.title)).scalars():
+                words.update(VOCABULARY_WORD.findall(title.lower()))
+            conn.execute(delete(_words))
+            if words:
+                conn.execute(insert(_words), [{"word": word} for word in sorted(words)])
+            conn.execute(insert(_words_fts).values(search_words_fts="rebuild"))
+    return counts
+
+
+def ensure_search_index(bind):
+    """Create the dialect's full-text indexes and fill them on first use."""
+    with bind.begin() as conn:
+        if conn.dialect.name == "sqlite":
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5("
+                "entity, title, body, content='search_documents', content_rowid='id', tokenize='trigram')"
+            ))
+            conn.execute(text("CREATE TABLE IF NOT EXISTS search_words (id INTEGER PRIMARY KEY, word TEXT NOT NULL UNIQUE)"))
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS search_words_fts USING fts5("
+                "word, content='search_words', content_rowid='id', tokenize='trigram')"
+            ))
+        elif conn.dialect.name == "postgresql":
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_search_documents_tsv ON search_documents "
+                "USING gin (to_tsvector('simple', title || ' ' || body))"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_search_documents_trgm ON search_documents "
+                "USING gin ((title || ' ' || body) gin_trgm_ops)"
+            ))
+        empty = conn.execute(select(_documents.c.id).limit(1)).first() is None
+    # Also clears a stale FTS index left behind by a schema reset
+    if empty:
+        rebuild_search_index(bind)
+
+
+def _terms(q):
+    terms = [term for term in TERM.findall(q.lower()) if len(term) >= MIN_TERM_LENGTH]
+    if not terms:
+        raise ValueError(f"q needs at least one term of {MIN_TERM_LENGTH} or more characters")
+    return terms
+
+
+def _quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _trigrams(term):
+    return {term[i:i + 3] for i in range(len(term) - 2)}
+
+
+def _similarity(a, b):
+    """pg_trgm-style similarity: Jaccard index of the padded trigrams."""
+    a, b = _trigrams(f"  {a} "), _trigrams(f"  {b} ")
+    return len(a & b) / len(a | b)
+
+
+def _corrections(db, term):
+    """Vocabulary words close to `term`, best first; just the term if it is a known word."""
+    candidates = db.execute(
+        text(
+            "SELECT w.word FROM search_words_fts JOIN search_words w ON w.id = search_words_fts.rowid "
+            "WHERE search_words_fts MATCH :match ORDER BY bm25(search_words_fts) LIMIT :limit"
+        ),
+        {"match": " OR ".join(map(_quote, sorted(_trigrams(term)))), "limit": SEARCH_FUZZY_CANDIDATES},
+    ).scalars().all()
+    if term in candidates:
+        return [term]
+    scored = sorted(((_similarity(term, word), word) for word in candidates), key=lambda item: (-item[0], item[1]))
+    return [word for similarity, word in scored[:SEARCH_FUZZY_SUGGESTIONS] if similarity >= SEARCH_FUZZY_MIN_SIMILARITY]
+
+
+def _after(score, document_id, after):
+    """Keyset condition for rows that sort after `after` = (score, id): score descending, then id."""
+    if after is None:
+        return None
+    last_score, last_id = after
+    return or_(score < last_score, and_(score == last_score, document_id > last_id))
+
+
+def _sqlite_statement(groups, entities, limit, after=None):
+    """Documents containing a term of every group (each a list of alternatives), best first."""
+    match = "{title body} : (" + " AND ".join(
+        "(" + " OR ".join(map(_quote, group)) + ")" for group in groups
+    ) + ")"
+    if entities:
+        match += " AND entity : (" + " OR ".join(map(_quote, entities)) + ")"
+    # bm25 is lower for better matches; negate it so every dialect sorts score descending
+    ranked = (
+        select(_documents.c.id, _documents.c.entity, _documents.c.entity_id, _documents.c.title,
+               _documents.c.body, (-func.bm25(literal_column("search_fts"), *BM25_WEIGHTS)).label("score"))
+        .select_from(_fts.join(_documents, _documents.c.id == _fts.c.rowid))
+        .where(literal_column("search_fts").op("MATCH")(match))
+        .subquery()
+    )
+    query = select(ranked).order_by(ranked.c.score.desc(), ranked.c.id).limit(limit)
+    after = _after(ranked.c.score, ranked.c.id, after)
+    return query.where(after) if after is not None else query
+
+
+def _postgresql_statement(terms, entities, limit, after=None):
+    # Prefix matches on whole words, or trigram word similarity for typos
+    where = (
+        "(to_tsvector('simple', d.title || ' ' || d.body) @@ to_tsquery('simple', :prefixes) "
+        "OR :q <% (d.title || ' ' || d.body))"
+    )
+    if entities:
+        where += " AND d.entity IN :entities"
+    ranked = (
+        "SELECT d.id, d.entity, d.entity_id, d.title, d.body, greatest("
+        "ts_rank(to_tsvector('simple', d.title || ' ' || d.body), to_tsquery('simple', :prefixes)), "
+        f"word_similarity(:q, d.title || ' ' || d.body))::float8 AS score FROM search_documents d WHERE {where}"
+    )
+    keyset = " WHERE score < :last_score OR (score = :last_score AND id > :last_id)" if after else ""
+    stmt = text(
+        f"SELECT * FROM ({ranked}) ranked{keyset} ORDER BY score DESC, id LIMIT :limit"
+    ).bindparams(prefixes=" & ".join(re.sub(r"\W", "", term) + ":*" for term in terms if re.sub(r"\W", "", term)),
+                 q=" ".join(terms), limit=limit)
+    if after:
+        stmt = stmt.bindparams(last_score=after[0], last_id=after[1])
+    if entities:
+        stmt = stmt.bindparams(bindparam("entities", value=list(entities), expanding=True))
+    return stmt
+
+
+def search(db, q, entities=None, limit=20, cursor=None):
+    """Ranked matches for `q` across customers, cards and cases, one page at a time.
+
+    Ranking happens in the database over every match (FTS5 bm25 on SQLite,
+    ts_rank / word_similarity on PostgreSQL), and pages continue from the
+    last (score, id) seen, so deep pages cost no more than the first one.
+    On SQLite every term must occur as a substring (trigram FTS5). When
+    nothing matches, misspelt terms are swapped for the closest words of the
+    title vocabulary and the search runs again (`fuzzy` in the result). On
+    PostgreSQL prefix word matches and pg_trgm word similarity are ranked
+    together.
+    """
+    terms = _terms(q)
+    unknown = [entity for entity in entities or () if entity not in SOURCES]
+    if unknown:
+        raise ValueError(f"Unknown type(s): {', '.join(unknown)}; expected {', '.join(SOURCES)}")
+    limit = clamp_limit(limit)
+    after, fuzzy = None, False
+    if cursor:
+        values, _ = decode_cursor(cursor, SEARCH_ORDER)
+        if (len(values) != 3 or not isinstance(values[0], (int, float)) or isinstance(values[0], bool)
+                or not isinstance(values[1], int) or isinstance(values[1], bool)):
+            raise InvalidCursor("Invalid pagination cursor")
+        after, fuzzy = (values[0], values[1]), bool(values[2])
+
+    suggestion = None
+    if db.get_bind().dialect.name == "postgresql":
+        rows = db.execute(_postgresql_statement(terms, entities, limit + 1, after)).all()
+    else:
+        rows = []
+        if not fuzzy:
+            rows = db.execute(_sqlite_statement([[term] for term in terms], entities, limit + 1, after)).all()
+        if fuzzy or (not rows and not cursor):
+            fuzzy = True
+            groups = [_corrections(db, term) or [term] for term in terms]
+            suggestion = " ".join(group[0] for group in groups)
+            rows = db.execute(_sqlite_statement(groups, entities, limit + 1, after)).all()
+
+    page = rows[:limit]
+    return {
+        "query": q,
+        "fuzzy": fuzzy,
+        "did_you_mean": suggestion,
+        "results": [
+            {"type": row.entity, "id": row.entity_id, "title": row.title, "detail": row.body,
+             "score": round(row.score, 4)}
+            for row in page
+        ],
+        "next_cursor": encode_cursor([page[-1].score, page[-1].id, fuzzy], "next", SEARCH_ORDER) if len(rows) > limit else None,
+    }
+
+
+@event.listens_for(Session, "after_flush")
+def _index_flushed_rows(session, flush_context):
+    """Re-index customers, cards and cases whose searchable columns were written.
+
+    Runs in the flushing transaction, so the index commits or rolls back with
+    the change. Core writes to these tables must call reindex() themselves.
+    """
+    changed = defaultdict(set)
+    for instance in session.new:
+        entity = ENTITIES.get(type(instance))
+        if entity:
+            changed[entity].add(instance.id)
+    for instance in session.dirty:
+        entity = ENTITIES.get(type(instance))
+        # Balance-only card updates (every tap and reload) skip the index
+        if entity and any(
+            get_history(instance, name, passive=PASSIVE_NO_INITIALIZE).has_changes()
+            for name in SOURCES[entity][3]
+        ):
+            changed[entity].add(instance.id)
+    for instance in session.deleted:
+        entity = ENTITIES.get(type(instance))
+        if entity:
+            changed[entity].add(instance.id)
+    if changed:
+        conn = session.connection()
+        for entity, ids in changed.items():
+            reindex(conn, entity, ids)
@@ -0,0 +1,86 @@
+import json
+import os
+from datetime import date, datetime
+from fastapi.responses import StreamingResponse
+from database import engine
+
+# Rows fetched from the server-side cursor per round trip
+STREAM_YIELD_PER = int(os.getenv("STREAM_YIELD_PER", "1000"))
+
+STREAM_FORMATS = ("json", "ndjson")
+MEDIA_TYPES = {"json": "application/json", "ndjson": "application/x-ndjson"}
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value):
+    return json.dumps(value, default=_default)
+
+
+def iter_statement(stmt, yield_per=STREAM_YIELD_PER):
+    """Yield rows of a Core select as dicts, fetching `yield_per` rows at a time.
+
+    Uses its own connection so the stream outlives the request's session and
+    never builds ORM objects or an identity map.
+    """
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=yield_per).execute(stmt)
+        for row in result:
+            yield dict(row._mapping)
+
+
+def iter_array(rows, fmt):
+    """Encode an iterable of dicts as one JSON array or as NDJSON lines."""
+    if fmt == "ndjson":
+        for row in rows:
+            yield dumps(row) + "\n"
+        return
+    yield "["
+    first = True
+    for row in rows:
+        yield dumps(row) if first else "," + dumps(row)
+        first = False
+    yield "]"
+
+
+def iter_object(fields, sections, fmt):
+    """Encode an object with scalar `fields` and large list `sections`.
+
+    JSON mode produces {"field": ..., "section": [...], ...}. NDJSON mode
+    emits the scalar fields on the first line, then one line per row tagged
+    with its section name.
+    """
+    if fmt == "ndjson":
+        yield dumps(fields) + "\n"
+        for name, rows in sections:
+            for row in rows:
+                yield dumps({"section": name, **row}) + "\n"
+        return
+    yield dumps(fields)[:-1]
+    for name, rows in sections:
+        yield f',{dumps(name)}:'
+        yield from iter_array(rows, "json")
+    yield "}"
+
+
+def buffered(chunks, size=65536):
+    """Join small encoded pieces into writes of roughly `size` characters."""
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def streaming_response(chunks, fmt):
+    return StreamingResponse(buffered(chunks), media_type=MEDIA_TYPES[fmt])
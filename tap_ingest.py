@@ -0,0 +1,304 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import select, insert, update, bindparam
+from database import engine
+from models import Card, TapHistory
+from id_allocator import id_allocator
+from cache import entity_cache
+from transaction_ledger import record_many
+from dashboard_counters import increment
+
+# Minimum fare deducted for a successful tap
+MIN_FARE = 2.50
+
+# "sync" writes every tap in its own transaction (the original behaviour),
+# "batched" hands taps to the background TapIngestor below.
+TAP_INGEST_MODE = os.getenv("TAP_INGEST_MODE", "sync")
+TAP_INGEST_BATCH_SIZE = int(os.getenv("TAP_INGEST_BATCH_SIZE", "500"))
+TAP_INGEST_INTERVAL_MS = int(os.getenv("TAP_INGEST_INTERVAL_MS", "20"))
+TAP_INGEST_QUEUE_SIZE = int(os.getenv("TAP_INGEST_QUEUE_SIZE", "10000"))
+TAP_INGEST_ACK_TIMEOUT = float(os.getenv("TAP_INGEST_ACK_TIMEOUT", "5"))
+
+
+class IngestQueueFull(Exception):
+    """Raised when the ingest queue stays full for longer than the enqueue timeout."""
+
+
+class IngestTimeout(Exception):
+    """Raised when a tap was not picked up within the ack timeout.
+
+    The tap has been taken out of the queue by then and is never written,
+    so the client can safely retry it.
+    """
+
+
+class CardNotFound(Exception):
+    pass
+
+
+# PendingTap.state: waiting in the queue, taken by the writer, or withdrawn by a timed-out caller
+QUEUED, WRITING, CANCELLED = "queued", "writing", "cancelled"
+
+
+class PendingTap:
+    """A queued tap plus the event (or asyncio future) its caller waits on for the durable ack."""
+
+    __slots__ = ("card_id", "location", "device_id", "transit_mode", "direction",
+                 "tap_time", "response", "error", "done", "state", "loop", "future")
+
+    def __init__(self, card_id, location, device_id, transit_mode, direction):
+        self.card_id = card_id
+        self.location = location
+        self.device_id = device_id
+        self.transit_mode = transit_mode
+        self.direction = direction
+        self.tap_time = datetime.now()
+        self.response = None
+        self.error = None
+        self.done = threading.Event()
+        self.state = QUEUED
+        self.loop = None
+        self.future = None
+
+    def resolve(self):
+        self.done.set()
+        if self.future is not None:
+            try:
+                self.loop.call_soon_threadsafe(_set_done, self.future)
+            except RuntimeError:
+                pass  # the caller's event loop has already shut down
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class TapIngestor:
+    """Coalesces card taps into one transaction per batch.
+
+    A single writer thread drains the queue every `interval_ms` or as soon as
+    `batch_size` taps are waiting, inserts all TapHistory rows with one
+    multi-row INSERT, applies one balance UPDATE per card, appends the ledger
+    entries and commits once.
+    Callers wait until their batch is committed, so a returned response is
+    always durable. A caller whose tap is still queued when the ack timeout
+    runs out withdraws it before giving up, so a timed-out tap is never
+    charged later; once the writer has taken a tap its caller waits for the
+    batch to finish. Async callers (submit_async) wait on a future, not a
+    threadpool thread. The bounded queue provides backpressure.
+    """
+
+    def __init__(self, bind, batch_size=TAP_INGEST_BATCH_SIZE, interval_ms=TAP_INGEST_INTERVAL_MS,
+                 queue_size=TAP_INGEST_QUEUE_SIZE):
+        self.bind = bind
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000.0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        # Guards PendingTap.state between the writer and timed-out callers
+        self._state_lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._start_lock:
+            if self.running:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="tap-ingestor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Flush every queued tap and stop the writer thread."""
+        with self._start_lock:
+            if not self.running:
+                return
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, card_id, location, device_id, transit_mode, direction,
+               enqueue_timeout=1.0, ack_timeout=TAP_INGEST_ACK_TIMEOUT):
+        """Queue a tap and wait until it has been committed.
+
+        Returns the same body as the synchronous tap endpoint.
+        """
+        if not self.running:
+            self.start()
+        tap = PendingTap(card_id, location, device_id, transit_mode, direction)
+        try:
+            self._queue.put(tap, timeout=enqueue_timeout)
+        except queue.Full:
+            raise IngestQueueFull("Tap ingest queue is full")
+        if not tap.done.wait(ack_timeout):
+            if self._withdraw(tap):
+                raise IngestTimeout("Tap was not processed in time and was not recorded")
+            tap.done.wait()
+        return self._result(tap)
+
+    async def submit_async(self, card_id, location, device_id, transit_mode, direction,
+                           enqueue_timeout=1.0, ack_timeout=TAP_INGEST_ACK_TIMEOUT):
+        """submit() for the event loop: waits on a future instead of holding a thread."""
+        if not self.running:
+            self.start()
+        tap = PendingTap(card_id, location, device_id, transit_mode, direction)
+        tap.loop = asyncio.get_running_loop()
+        tap.future = tap.loop.create_future()
+        deadline = time.monotonic() + enqueue_timeout
+        while True:
+            try:
+                self._queue.put_nowait(tap)
+                break
+            except queue.Full:
+                if time.monotonic() >= deadline:
+                    raise IngestQueueFull("Tap ingest queue is full")
+                await asyncio.sleep(self.interval)
+        try:
+            await asyncio.wait_for(asyncio.shield(tap.future), ack_timeout)
+        except asyncio.TimeoutError:
+            if self._withdraw(tap):
+                raise IngestTimeout("Tap was not processed in time and was not recorded")
+            await tap.future
+        return self._result(tap)
+
+    def _withdraw(self, tap):
+        """Cancel a tap the writer has not taken yet; False if it is already being written."""
+        with self._state_lock:
+            if tap.state != QUEUED:
+                return False
+            tap.state = CANCELLED
+            return True
+
+    def _claim(self, batch):
+        with self._state_lock:
+            claimed = [tap for tap in batch if tap.state == QUEUED]
+            for tap in claimed:
+                tap.state = WRITING
+        return claimed
+
+    @staticmethod
+    def _result(tap):
+        if tap.error is not None:
+            raise tap.error
+        return tap.response
+
+    def stats(self):
+        return {
+            "mode": TAP_INGEST_MODE,
+            "running": self.running,
+            "queued": self._queue.qsize(),
+            "queue_size": self._queue.maxsize,
+            "batch_size": self.batch_size,
+            "interval_ms": int(self.interval * 1000),
+        }
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._claim(self._collect())
+            if batch:
+                self._write(batch)
+
+    def _collect(self):
+        try:
+            first = self._queue.get(timeout=self.interval)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            # Lease IDs before opening the write transaction so the allocator
+            # never waits on our own lock.
+            tap_ids = [id_allocator.next_id("tap") for _ in batch]
+            with self.bind.begin() as conn:
+                card_ids = {tap.card_id for tap in batch}
+                balances = {
+                    row.id: [row.balance, row.customer_id]
+                    for row in conn.execute(
+                        select(Card.id, Card.balance, Card.customer_id)
+                        .where(Card.id.in_(card_ids))
+                        .with_for_update()
+                    )
+                }
+                tap_rows = []
+                deductions = defaultdict(float)
+                ledger_entries = defaultdict(list)
+                for tap, tap_id in zip(batch, tap_ids):
+                    card = balances.get(tap.card_id)
+                    if card is None:
+                        tap.error = CardNotFound(tap.card_id)
+                        continue
+                    if card[0] < MIN_FARE:
+                        result = "Insufficient Balance"
+                    else:
+                        result = "Tap Successful"
+                        card[0] -= MIN_FARE
+                        deductions[tap.card_id] += MIN_FARE
+                        ledger_entries[tap.card_id].append(("tap", -MIN_FARE, tap_id))
+                    tap_rows.append({
+                        "id": tap_id,
+                        "tap_time": tap.tap_time,
+                        "location": tap.location,
+                        "device_id": tap.device_id,
+                        "transit_mode": tap.transit_mode,
+                        "direction": tap.direction,
+                        "customer_id": card[1],
+                        "result": result,
+                    })
+                    tap.response = {
+                        "tap_id": tap_id,
+                        "card_id": tap.card_id,
+                        "result": result,
+                        "location": tap.location,
+                        "transit_mode": tap.transit_mode,
+                        "direction": tap.direction,
+                        "remaining_balance": card[0],
+                        "tap_time": tap.tap_time.isoformat(),
+                        "acknowledged": True,
+                    }
+                if tap_rows:
+                    conn.execute(insert(TapHistory), tap_rows)
+                if deductions:
+                    conn.execute(
+                        update(Card)
+                        .where(Card.id == bindparam("card_id"))
+                        .values(balance=Card.balance - bindparam("amount")),
+                        [{"card_id": card_id, "amount": amount} for card_id, amount in deductions.items()],
+                    )
+                    record_many(conn, {
+                        card_id: (entries, balances[card_id][0]) for card_id, entries in ledger_entries.items()
+                    })
+                increment(conn, {"total_tap_entries": len(tap_rows), "total_balance": -sum(deductions.values())})
+            if deductions:
+                entity_cache.invalidate_card(*deductions)
+        except Exception as e:
+            for tap in batch:
+                tap.response = None
+                tap.error = e
+        finally:
+            for tap in batch:
+                tap.resolve()
+
+
+# Shared ingestor used by /simulate/cardTap when TAP_INGEST_MODE=batched
+tap_ingestor = TapIngestor(engine)
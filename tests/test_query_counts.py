@@ -0,0 +1,90 @@
+"""Statement counts of the composite CRM reads, so an N-query pattern can't creep back in.
+
+Run from the repository root with ``python -m pytest tests``.
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+
+DB_DIR = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(DB_DIR, 'query_counts.db')}"
+os.environ["USE_ASYNC_DB"] = "false"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+import main  # noqa: E402
+from cache import entity_cache  # noqa: E402
+from database import engine  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as client:
+        customer_id = client.post("/customers/", json={"name": "Ada Lovelace", "email": "ada@example.com",
+                                                       "phone": "555-0100", "notifications": "email"}).json()["id"]
+        for card_id in ("QC1", "QC2", "QC3"):
+            client.post("/cards/", json={"id": card_id, "type": "Adult", "status": "Active",
+                                         "balance": 10, "customer_id": customer_id})
+        for fare in (2.5, 3.0):
+            client.post("/trips/", json={"card_id": "QC1", "start_time": "2024-01-02T08:00:00",
+                                         "end_time": "2024-01-02T08:30:00", "entry_location": "A",
+                                         "exit_location": "B", "fare": fare, "route": "R1",
+                                         "operator": "Metro", "transit_mode": "Subway",
+                                         "adjustable": "No"})
+        client.post("/cards/QC1/reload", json={"amount": 5})
+        client.customer_id = customer_id
+        yield client
+
+
+@contextmanager
+def count_statements():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def get(client, path):
+    with count_statements() as statements:
+        response = client.get(path)
+    assert response.status_code == 200, response.text
+    return response.json(), statements
+
+
+def test_crm_card_status_uses_one_joined_query(client):
+    entity_cache.clear()
+    body, statements = get(client, "/api/crm/cards/QC1")
+    assert body["status"] == "success", body["message"]
+    assert body["data"]["customer_name"] == "Ada Lovelace"
+    assert len(statements) == 1
+
+    # Both entries are cached now
+    body, statements = get(client, "/api/crm/cards/QC1")
+    assert body["status"] == "success"
+    assert statements == []
+
+
+def test_crm_customer_status_uses_one_query(client):
+    body, statements = get(client, f"/api/crm/customers/{client.customer_id}")
+    assert body["status"] == "success", body["message"]
+    assert body["data"]["total_cards"] == 3
+    assert len(statements) == 1
+
+
+def test_card_transactions_query_count(client):
+    body, statements = get(client, "/cards/QC1/transactions")
+    assert len(body["trips"]) == 2
+    assert body["ledger"]
+    # card with its trips, tap history, latest balance snapshot, ledger entries after it
+    assert len(statements) == 4
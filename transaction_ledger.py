@@ -0,0 +1,147 @@
+import os
+from datetime import datetime
+from sqlalchemy import select, insert, func, text
+from models import CardTransaction, CardBalanceSnapshot, LEDGER_PARTITION_BY_MONTH
+from projections import LEDGER_FIELDS, SNAPSHOT_FIELDS, labelled, project, project_all
+
+# Take a balance snapshot every N ledger entries per card, so rebuilding a
+# balance never reads more than N entries.
+LEDGER_SNAPSHOT_INTERVAL = int(os.getenv("LEDGER_SNAPSHOT_INTERVAL", "50"))
+# Monthly partitions created ahead of time when LEDGER_PARTITION_BY_MONTH=true
+LEDGER_PARTITIONS_AHEAD = int(os.getenv("LEDGER_PARTITIONS_AHEAD", "2"))
+
+
+def record(db, card_id, entries, balance_after, now=None):
+    """Append ledger entries for one card in the caller's transaction.
+
+    `entries` is a list of (kind, amount, reference) in the order they were
+    applied and `balance_after` is the card balance once all of them are.
+    `db` may be a Session or a Connection. Call this after the balance UPDATE:
+    the card row lock it holds serialises concurrent writers for the card, so
+    sequence numbers stay gap-free.
+
+    A card's first entry is preceded by an "opening" entry carrying the
+    balance it had before the ledger existed, so the ledger always sums to
+    the card balance.
+    """
+    record_many(db, {card_id: (entries, balance_after)}, now)
+
+
+def record_many(db, changes, now=None):
+    """Batch form of record(): `changes` maps card_id -> (entries, balance_after).
+
+    Costs one sequence lookup and one INSERT however many cards are involved.
+    """
+    now = now or datetime.now()
+    last_sequences = dict(db.execute(
+        select(CardTransaction.card_id, func.max(CardTransaction.sequence))
+        .where(CardTransaction.card_id.in_(list(changes)))
+        .group_by(CardTransaction.card_id)
+    ).all())
+
+    rows = []
+    snapshots = []
+    for card_id, (entries, balance_after) in changes.items():
+        last = last_sequences.get(card_id) or 0
+        entries = list(entries)
+        if last == 0:
+            opening = balance_after - sum(amount for _, amount, _ in entries)
+            entries.insert(0, ("opening", opening, None))
+        balance = balance_after - sum(amount for _, amount, _ in entries)
+        for offset, (kind, amount, reference) in enumerate(entries, start=1):
+            sequence = last + offset
+            balance += amount
+            rows.append({
+                "card_id": card_id,
+                "sequence": sequence,
+                "created_at": now,
+                "kind": kind,
+                "amount": amount,
+                "reference": reference,
+            })
+            if sequence % LEDGER_SNAPSHOT_INTERVAL == 0:
+                snapshots.append({"card_id": card_id, "sequence": sequence, "balance": balance, "created_at": now})
+
+    if rows:
+        db.execute(insert(CardTransaction), rows)
+    if snapshots:
+        db.execute(insert(CardBalanceSnapshot), snapshots)
+
+
+def latest_snapshot(db, card_id, at=None):
+    query = select(CardBalanceSnapshot).where(CardBalanceSnapshot.card_id == card_id)
+    if at is not None:
+        query = query.where(CardBalanceSnapshot.created_at <= at)
+    return db.execute(
+        query.order_by(CardBalanceSnapshot.sequence.desc()).limit(1)
+    ).scalar_one_or_none()
+
+
+def ledger_tail(db, card_id):
+    """Latest snapshot and the entries recorded after it (at most one snapshot interval).
+
+    Both come back as plain dicts; the snapshot is None before the first one is taken.
+    """
+    snapshot = db.execute(
+        select(*labelled(SNAPSHOT_FIELDS))
+        .where(CardBalanceSnapshot.card_id == card_id)
+        .order_by(CardBalanceSnapshot.sequence.desc())
+        .limit(1)
+    ).first()
+    query = select(*labelled(LEDGER_FIELDS)).where(CardTransaction.card_id == card_id)
+    if snapshot is not None:
+        query = query.where(CardTransaction.sequence > snapshot.sequence)
+    entries = db.execute(query.order_by(CardTransaction.sequence))
+    return (project(snapshot, SNAPSHOT_FIELDS) if snapshot is not None else None,
+            project_all(entries, LEDGER_FIELDS))
+
+
+def balance_as_of(db, card_id, at):
+    """Card balance at time `at` from the nearest snapshot plus a short tail.
+
+    Returns None when the card has no ledger entries at or before `at`.
+    """
+    snapshot = latest_snapshot(db, card_id, at)
+    query = select(func.count(), func.sum(CardTransaction.amount)).where(
+        CardTransaction.card_id == card_id,
+        CardTransaction.created_at <= at,
+    )
+    if snapshot is not None:
+        query = query.where(CardTransaction.sequence > snapshot.sequence)
+    count, total = db.execute(query).one()
+    if snapshot is None and count == 0:
+        return None
+    return (snapshot.balance if snapshot is not None else 0.0) + (total or 0.0)
+
+
+def _month_start(year, month):
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return datetime(year, month, 1)
+
+
+def ensure_month_partitions(bind, start=None, months_ahead=LEDGER_PARTITIONS_AHEAD):
+    """Create the monthly card_transactions partitions on PostgreSQL.
+
+    Covers the month of `start` (default: now) and `months_ahead` months after
+    it, plus a DEFAULT partition that catches rows outside every range so a
+    missed month never rejects a write. A no-op unless
+    LEDGER_PARTITION_BY_MONTH is set and the database is PostgreSQL.
+    """
+    if not LEDGER_PARTITION_BY_MONTH or bind.dialect.name != "postgresql":
+        return []
+    start = start or datetime.now()
+    created = []
+    with bind.begin() as conn:
+        for offset in range(months_ahead + 1):
+            lower = _month_start(start.year, start.month + offset)
+            upper = _month_start(start.year, start.month + offset + 1)
+            name = f"card_transactions_{lower:%Y_%m}"
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF card_transactions "
+                f"FOR VALUES FROM ('{lower:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')"
+            ))
+            created.append(name)
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS card_transactions_default PARTITION OF card_transactions DEFAULT"
+        ))
+    return created